@@ -0,0 +1,676 @@
+"""
+benchmarks.py
+-------------
+Micro-benchmarks for the bulletin board server.
+The benchmarks drive Server's handlers directly (no sockets), so each one
+isolates a single hot path. Run `python benchmarks.py --help` for the list.
+"""
+
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import importer
+import loadgen
+import protocol
+import search
+import server as server_module
+import storage
+from server import Server
+
+
+class BenchConnection:
+    """Stands in for a Connection: counts replies and notifications instead of sending them."""
+
+    def __init__(self) -> None:
+        self.replies = 0
+        self.notifications = 0
+        self.client_id = None
+        self.framed = True
+        self.bytes_in = self.bytes_out = 0
+
+    def reply(self, message):
+        self.replies += 1
+
+    def notify(self, message):
+        self.notifications += 1
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class CountingSocket:
+    """Stands in for a client socket: keeps every write, and when it was made."""
+
+    def __init__(self) -> None:
+        self.writes = []
+
+    def sendall(self, data):
+        self.writes.append((time.perf_counter(), data))
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+def report(text):
+    """Print a benchmark result. Results bypass the redirect that hides the server's own output."""
+    print(text, file=sys.__stdout__, flush=True)
+
+
+@contextlib.contextmanager
+def bench_server(**options):
+    """Start a Server (without listening) on a temporary data directory.
+    Its background threads aren't started, so nothing is left reading the
+    storage once it is closed; benchmarks that want compaction run it.
+    """
+    data_dir = tempfile.mkdtemp(prefix="bulletin-bench-")
+    try:
+        server = Server("127.0.0.1", 0, data_dir=data_dir, **options)
+        server.restore_groups(server.storage.recover())
+        yield server
+        server.storage.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def connect(server, name, group):
+    """Register a benchmark client with the server and return its client ID."""
+    return server.add_clients_groups(name, group, BenchConnection())
+
+
+def run_threads(target, count):
+    """Run target(index) on count threads at once and return the elapsed seconds."""
+    start = threading.Barrier(count + 1)
+
+    def worker(index):
+        start.wait()
+        target(index)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    began = time.perf_counter()
+    start.wait()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - began
+
+
+def post_concurrently(server, group_count, args):
+    """Have args.threads threads post args.posts times each, spread over
+    group_count groups. Returns the posts per second achieved.
+    """
+    client_ids = []
+    for index in range(args.threads):
+        group = "group%d" % (index % group_count)
+        client_ids.append((connect(server, "user%d" % (index), group), group))
+
+    def post(index):
+        client_id, group = client_ids[index]
+        for number in range(args.posts):
+            server.handle_post(client_id, group, "subject", "message", str(number))
+
+    elapsed = run_threads(post, args.threads)
+    return args.threads * args.posts / elapsed
+
+
+def bench_group_locking(args):
+    """Posting throughput of concurrent posters sharing one group vs each using their own group."""
+    report("%d threads, %d posts each" % (args.threads, args.posts))
+    for group_count in sorted({1, args.threads}):
+        # Keep fsync off the critical path so the locking is what's measured.
+        with bench_server(fsync_policy="interval") as server:
+            throughput = post_concurrently(server, group_count, args)
+        report("  %4d group(s): %8.0f posts/s" % (group_count, throughput))
+
+
+def bench_wal(args):
+    """Posting throughput under each write-ahead log fsync policy, and recovery time."""
+    report("%d threads posting to their own groups, %d posts each" % (args.threads, args.posts))
+    for policy in storage.FSYNC_POLICIES:
+        with bench_server(fsync_policy=policy) as server:
+            throughput = post_concurrently(server, args.threads, args)
+        report("  fsync %-8s: %8.0f posts/s" % (policy, throughput))
+    report(
+        "%d sessions posting over sockets (loadgen.py) for %gs, default fsync policy"
+        % (args.loadgen_sessions, args.loadgen_duration)
+    )
+    for label, server_args in (("threaded", ""), ("asyncio", "--asyncio")):
+        posts = loadgen_posts(args, "--fsync %s %s" % (storage.FSYNC_POLICY, server_args))
+        report(
+            "  %-8s: %8.0f posts/s (p50 %.2fms, p99 %.2fms, %d errors)"
+            % (label, posts["throughput"], posts["p50_ms"], posts["p99_ms"], posts["errors"])
+        )
+
+    data_dir = tempfile.mkdtemp(prefix="bulletin-bench-")
+    try:
+        server = Server("127.0.0.1", 0, data_dir=data_dir, fsync_policy="interval")
+        server.restore_groups(server.storage.recover())
+        client_id = connect(server, "user", "default")
+        for number in range(args.recovery_posts):
+            server.handle_post(client_id, "default", "subject", "message", str(number))
+        server.storage.close()
+
+        began = time.perf_counter()
+        server = Server("127.0.0.1", 0, data_dir=data_dir)
+        server.restore_groups(server.storage.recover())
+        report("  recovery of %d posts from the log:      %.2fs" % (args.recovery_posts, time.perf_counter() - began))
+        server.server_snapshot()
+        server.storage.close()
+
+        began = time.perf_counter()
+        server = Server("127.0.0.1", 0, data_dir=data_dir)
+        server.restore_groups(server.storage.recover())
+        report("  recovery of %d posts from a snapshot:   %.2fs" % (args.recovery_posts, time.perf_counter() - began))
+        server.storage.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def bench_fanout(args):
+    """Post notification fan-out with many connected clients: member index vs scanning every client."""
+    with bench_server(fsync_policy="interval") as server:
+        fanout(server, args)
+
+
+def fanout(server, args):
+    """Connect args.clients clients over args.groups groups and time both fan-out strategies."""
+    posters = {}
+    for index in range(args.clients):
+        group = "group%d" % (index % args.groups)
+        client_id = connect(server, "user%d" % (index), group)
+        posters.setdefault(group, client_id)
+    posters = list(posters.items())
+    report("%d clients in %d groups, %d posts" % (args.clients, args.groups, args.fanout_posts))
+
+    began = time.perf_counter()
+    for number in range(args.fanout_posts):
+        group, client_id = posters[number % len(posters)]
+        server.handle_post(client_id, group, "subject", "message")
+    indexed = time.perf_counter() - began
+
+    # What every post used to do: walk all connected clients and look each
+    # one up in the group's member list.
+    member_lists = {group: list(members) for group, members in server.groups.items()}
+    began = time.perf_counter()
+    for number in range(args.fanout_posts):
+        group, client_id = posters[number % len(posters)]
+        message = "New message posted in %s by %s with ID#%d." % (group, "user", number)
+        for cid, info in server.connected_clients.items():
+            if info["name"] in member_lists[group]:
+                info["connection"].notify(message)
+    scanned = time.perf_counter() - began
+
+    report("  member index: %8.0f posts/s" % (args.fanout_posts / indexed))
+    report("  client scan:  %8.0f posts/s (notification fan-out only)" % (args.fanout_posts / scanned))
+
+
+# Run in a fresh interpreter by bench_startup, so the peak resident memory
+# reported is the server's own: prints "<seconds> <peak RSS in KiB>". On
+# Linux ru_maxrss survives exec (it would report the benchmark's own peak),
+# so the probe reads VmHWM instead where it can.
+STARTUP_PROBE = """
+import contextlib, os, resource, sys, time
+from server import Server
+began = time.perf_counter()
+with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+    server = Server("127.0.0.1", 0, data_dir=sys.argv[1], storage_engine=sys.argv[2])
+    server.restore_groups(server.storage.recover())
+elapsed = time.perf_counter() - began
+server.storage.close()
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if os.path.exists("/proc/self/status"):
+    for line in open("/proc/self/status"):
+        if line.startswith("VmHWM:"):
+            peak_rss = int(line.split()[1])
+print(elapsed, peak_rss)
+"""
+
+
+def bench_startup(args):
+    """Startup time and peak resident memory of each storage engine with a large board."""
+    data_dir = tempfile.mkdtemp(prefix="bulletin-bench-")
+    try:
+        # Write the posts as a pickle engine snapshot; the sqlite engine
+        # imports it the first time it starts on the same directory.
+        date = datetime.date.today()
+        engine = storage.PickleStorage(data_dir, fsync_policy="interval")
+        engine.recover()
+        for message_id in range(args.startup_posts):
+            post = {"sender": "user", "date": date, "subject": "subject", "message": "message %d" % (message_id)}
+            engine.apply(("post", "default", message_id, post))
+        groups = {"default": {"members": {"user": 0}, "past_memberships": {}, "next_message_id": args.startup_posts}}
+        engine.finish_snapshot(engine.begin_snapshot(groups))
+        engine.close()
+
+        def probe(engine):
+            output = subprocess.run(
+                [sys.executable, "-c", STARTUP_PROBE, data_dir, engine],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            elapsed, peak_rss = output.split()
+            return float(elapsed), int(peak_rss) / 1024
+
+        report("%d posts" % (args.startup_posts))
+        probe("sqlite")  # one-off import
+        for engine in storage.STORAGE_ENGINES:
+            elapsed, peak_rss = probe(engine)
+            report("  %-6s: %6.2fs to start, %7.1f MiB peak RSS" % (engine, elapsed, peak_rss))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+def bench_memory(args):
+    """Heap bytes per post: a dict per post vs the pickle engine's boards (bodies in the segment)."""
+    date = datetime.date.today()
+    body = "x" * args.body_size
+
+    def make_post(message_id):
+        # A fresh sender string per post, as a parsed command would give.
+        return {
+            "sender": "".join(["user", str(message_id % 100)]),
+            "date": date,
+            "subject": "subject %d" % (message_id),
+            "message": "%d %s" % (message_id, body),
+        }
+
+    report("%d posts with %d byte bodies" % (args.memory_posts, args.body_size))
+    tracemalloc.start()
+    began = tracemalloc.get_traced_memory()[0]
+    board = {message_id: make_post(message_id) for message_id in range(args.memory_posts)}
+    dicts = tracemalloc.get_traced_memory()[0] - began
+    del board
+
+    data_dir = tempfile.mkdtemp(prefix="bulletin-bench-")
+    try:
+        engine = storage.PickleStorage(data_dir)
+        engine.recover()
+        engine.apply(("create", "group"))
+        began = tracemalloc.get_traced_memory()[0]
+        for message_id in range(args.memory_posts):
+            engine.apply(("post", "group", message_id, make_post(message_id)))
+        boards = tracemalloc.get_traced_memory()[0] - began
+        engine.close()
+    finally:
+        shutil.rmtree(data_dir)
+    tracemalloc.stop()
+    report("  post dicts:   %6.0f bytes/post" % (dicts / args.memory_posts))
+    report("  board arrays: %6.0f bytes/post" % (boards / args.memory_posts))
+
+
+def bench_retention(args):
+    """Board memory and read latency with every post in memory vs a retention policy archiving the oldest."""
+    report(
+        "%d posts with %d byte bodies, %d reads of random posts, %d hot posts kept by the policy"
+        % (args.memory_posts, args.body_size, args.retention_reads, args.retain_posts)
+    )
+    body = "x" * args.body_size
+    for label, policy in (("everything", storage.RetentionPolicy()), ("retention", storage.RetentionPolicy(max_posts=args.retain_posts))):
+        with bench_server(
+            fsync_policy="interval", snapshot_records=float("inf"), snapshot_interval=float("inf"), retention=policy
+        ) as server:
+            client_id = connect(server, "user", "group")
+            tracemalloc.start()
+            began = tracemalloc.get_traced_memory()[0]
+            for number in range(args.memory_posts):
+                server.handle_post(client_id, "group", "subject", body, str(number))
+                if number % 10000 == 0:
+                    # What the background compaction thread does every second.
+                    server.archive_posts()
+            server.archive_posts()
+            heap = tracemalloc.get_traced_memory()[0] - began
+            tracemalloc.stop()
+
+            engine = server.storage
+            reads = {}
+            for kind, first, last in (("hot", engine.boards["group"].first, args.memory_posts), ("archived", 0, engine.boards["group"].first)):
+                if last <= first:
+                    continue
+                message_ids = [random.randrange(first, last) for _ in range(args.retention_reads)]
+                began = time.perf_counter()
+                for message_id in message_ids:
+                    engine.read_post("group", message_id)
+                reads[kind] = (time.perf_counter() - began) / len(message_ids)
+        report(
+            "  %-10s: %7.1f MiB heap after posting, %6d posts in memory, reads %s"
+            % (
+                label, heap / 2**20, args.memory_posts - engine.boards["group"].first,
+                ", ".join("%s %.1fus" % (kind, seconds * 1e6) for kind, seconds in reads.items()),
+            )
+        )
+
+
+def bench_search(args):
+    """Search index build time and query latency over a large board."""
+    # Words drawn from a Zipf-like distribution, so some are on most posts
+    # and most are rare, as in real text.
+    generator = random.Random(0)
+    vocabulary = ["word%d" % (rank) for rank in range(args.search_vocabulary)]
+    cumulative_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(args.search_vocabulary)))
+    report("%d posts, %d word vocabulary" % (args.search_posts, args.search_vocabulary))
+
+    index = search.GroupIndex()
+    began = time.perf_counter()
+    for message_id in range(args.search_posts):
+        words = generator.choices(vocabulary, cum_weights=cumulative_weights, k=12)
+        index.add(message_id, {"sender": "user%d" % (message_id % 100), "subject": words[0], "message": " ".join(words[1:])})
+    report("  index build: %.1fs" % (time.perf_counter() - began))
+
+    queries = {
+        "common word": "word0",
+        "rare word": "word%d" % (args.search_vocabulary - 1),
+        "two words": "word1 word50",
+        "three words": "word2 word10 word200",
+    }
+    for name, query in queries.items():
+        latencies = []
+        for repeat in range(args.search_queries):
+            began = time.perf_counter()
+            index.search(query, lambda message_id: True, 20)
+            latencies.append(time.perf_counter() - began)
+        latencies.sort()
+        report(
+            "  %-12s: p50 %8.2fms, p99 %8.2fms"
+            % (name, latencies[len(latencies) // 2] * 1000, latencies[len(latencies) * 99 // 100] * 1000)
+        )
+
+
+def bench_message_cache(args):
+    """Throughput of concurrent readers re-reading recent posts, with and without the message cache."""
+    report("%d threads, %d reads each over the %d newest posts" % (args.threads, args.reads, args.hot_posts))
+    for label, entries in (("no cache", 0), ("cache", server_module.MESSAGE_CACHE_ENTRIES)):
+        with bench_server(fsync_policy="interval", message_cache_entries=entries) as server:
+            poster = connect(server, "poster", "group")
+            for number in range(args.hot_posts):
+                server.handle_post(poster, "group", "subject", "message", "x" * args.body_size, str(number))
+            readers = [connect(server, "user%d" % (index), "group") for index in range(args.threads)]
+
+            def read(index):
+                for number in range(args.reads):
+                    server.handle_message(readers[index], "group", str(number % args.hot_posts))
+
+            elapsed = run_threads(read, args.threads)
+            message_cache = server.message_cache
+            report(
+                "  %-8s: %8.0f reads/s (%d hits, %d misses, %d evictions)"
+                % (label, args.threads * args.reads / elapsed, message_cache.hits, message_cache.misses, message_cache.evictions)
+            )
+
+
+def bench_metrics(args):
+    """Command throughput through the instrumented dispatch, with metrics on and off."""
+    report(
+        "%d threads posting and reading in their own groups, %d commands each (best of %d rounds)"
+        % (args.threads, args.posts, args.rounds)
+    )
+    best = {}
+    # Alternate the two so machine noise hits both alike.
+    for label, enabled in (("off", False), ("on", True)) * args.rounds:
+        # No compaction during the run, so it can't skew either side.
+        with bench_server(
+            fsync_policy="interval", snapshot_records=float("inf"), snapshot_interval=float("inf"), metrics_enabled=enabled
+        ) as server:
+            connections = []
+            for index in range(args.threads):
+                connection = BenchConnection()
+                connection.client_id = server.add_clients_groups("user%d" % (index), "group%d" % (index), connection)
+                connections.append(connection)
+
+            def run(index):
+                connection = connections[index]
+                for number in range(args.posts):
+                    if number % 2:
+                        server.run_command(connection, "groupmessage group%d %d" % (index, number // 2))
+                    else:
+                        server.run_command(connection, "grouppost group%d subject message %d" % (index, number))
+
+            elapsed = run_threads(run, args.threads)
+        best[label] = max(best.get(label, 0), args.threads * args.posts / elapsed)
+    for label, throughput in best.items():
+        report("  metrics %-3s: %8.0f commands/s" % (label, throughput))
+    report("  overhead   : %7.1f%%" % (100 * (1 - best["on"] / best["off"])))
+
+
+def bench_coalescing(args):
+    """Socket writes and delivery latency of a burst of posts, with notification coalescing off and on."""
+    report(
+        "%d posts in bursts of %d, %gms apart, to a group with %d connected members"
+        % (args.burst_posts, args.burst_size, args.burst_pause * 1000, args.burst_members)
+    )
+    for label, delay in (("off", 0), ("%gms" % (args.coalesce_delay * 1000), args.coalesce_delay)):
+        with bench_server(
+            fsync_policy="interval", snapshot_records=float("inf"), snapshot_interval=float("inf"), coalesce_delay=delay
+        ) as server:
+            sockets = []
+            for index in range(args.burst_members):
+                client_socket = CountingSocket()
+                connection = server_module.Connection(client_socket, on_overflow=server.count_overflow)
+                connection.framed = True
+                connection.start_writer()
+                server.add_clients_groups("user%d" % (index), "burst", connection)
+                sockets.append(client_socket)
+            poster = connect(server, "poster", "burst")
+            # Leave out the announcements of the members connecting.
+            time.sleep(0.1 + 2 * delay)
+            for client_socket in sockets:
+                client_socket.writes.clear()
+
+            posted = {}
+            for number in range(args.burst_posts):
+                if number and number % args.burst_size == 0:
+                    time.sleep(args.burst_pause)
+                posted[server.board_seqs["burst"]] = time.perf_counter()
+                server.handle_post(poster, "burst", "subject", "message", str(number))
+            time.sleep(0.5 + 2 * delay)
+
+            writes = messages = 0
+            latencies = []
+            for client_socket in sockets:
+                decoder = protocol.FrameDecoder()
+                writes += len(client_socket.writes)
+                for written, data in client_socket.writes:
+                    for frame_type, request_id, payload in decoder.feed(data):
+                        messages += 1
+                        latencies.extend(written - posted[message_id] for group, message_id in loadgen.posts_announced(payload.decode()))
+            latencies.sort()
+            report(
+                "  coalescing %-5s: %7d writes, %7d messages, %7d of %d posts delivered (%d dropped), latency p50 %.2fms, p99 %.2fms"
+                % (
+                    label, writes, messages, len(latencies), args.burst_posts * args.burst_members,
+                    server.overflow_counts["dropped"],
+                    loadgen.percentile(latencies, 0.5) * 1000, loadgen.percentile(latencies, 0.99) * 1000,
+                )
+            )
+
+
+def bench_resume(args):
+    """A reconnect storm: every client losing its connection at once and reconnecting with a full handshake vs resuming its session."""
+    report("%d clients in %d groups reconnecting at once" % (args.storm_clients, args.groups))
+    for label, timeout in (("handshake", 0), ("resume", server_module.RESUME_TIMEOUT)):
+        with bench_server(fsync_policy="interval", resume_timeout=timeout) as server:
+            sessions = []
+            for index in range(args.storm_clients):
+                connection = BenchConnection()
+                handshake = "user%d group%d" % (index, index % args.groups)
+                connection.client_id = server.register_client(handshake, connection)
+                sessions.append((handshake, connection.client_id))
+            tokens = [server.connected_clients[client_id].get("token") for handshake, client_id in sessions]
+            for handshake, client_id in sessions:
+                server.detach_session(client_id, server.connected_clients[client_id]["connection"])
+
+            connections = []
+            began = time.perf_counter()
+            for (handshake, client_id), token in zip(sessions, tokens):
+                connection = BenchConnection()
+                server.register_client(handshake if token is None else handshake + " " + token, connection)
+                connections.append(connection)
+            elapsed = time.perf_counter() - began
+            report(
+                "  %-9s: %6.2fs (%6.0f reconnects/s), %9d notifications sent"
+                % (label, elapsed, len(sessions) / elapsed, sum(connection.notifications for connection in connections))
+            )
+
+
+def bench_bulk(args):
+    """Posting throughput of %grouppost one message at a time vs %bulkpost batches, and of the offline JSONL importer."""
+    report("%d posts to a group with 100 connected members, default fsync policy" % (args.bulk_posts))
+    with bench_server(snapshot_records=float("inf"), snapshot_interval=float("inf")) as server:
+        poster = connect(server, "poster", "single")
+        for index in range(100):
+            connect(server, "member%d" % (index), "single")
+        began = time.perf_counter()
+        for number in range(args.bulk_posts):
+            server.handle_command(poster, "grouppost single subject message %d" % (number))
+        single = time.perf_counter() - began
+        poster = connect(server, "poster", "bulk")
+        for index in range(100):
+            connect(server, "member%d" % (index), "bulk")
+        lines = ["subject message %d" % (number) for number in range(args.bulk_size)]
+        began = time.perf_counter()
+        for number in range(args.bulk_posts // args.bulk_size):
+            server.handle_command(poster, "\n".join(["bulkpost bulk"] + lines))
+        bulk = time.perf_counter() - began
+    report("  grouppost:              %8.0f posts/s" % (args.bulk_posts / single))
+    report("  bulkpost of %-6d:     %8.0f posts/s" % (args.bulk_size, args.bulk_posts / bulk))
+
+    report("importing %d posts over %d groups from JSONL" % (args.import_posts, args.groups))
+    with tempfile.TemporaryDirectory(prefix="bulletin-bench-") as directory:
+        source = os.path.join(directory, "posts.jsonl")
+        with open(source, "w") as posts_file:
+            for number in range(args.import_posts):
+                item = {"group": "group%d" % (number % args.groups), "sender": "user%d" % (number % 1000), "subject": "subject", "message": "x" * args.body_size}
+                posts_file.write(json.dumps(item) + "\n")
+        for engine in storage.STORAGE_ENGINES:
+            data_dir = os.path.join(directory, engine)
+            began = time.perf_counter()
+            with open(source) as lines:
+                importer.import_posts(lines, importer.Importer(data_dir, engine))
+            elapsed = time.perf_counter() - began
+            report("  %-6s: %6.2fs (%8.0f posts/s)" % (engine, elapsed, args.import_posts / elapsed))
+
+
+def loadgen_posts(args, server_args):
+    """Run loadgen.py against a server it spawns with server_args, with
+    args.loadgen_sessions sessions posting to their own groups as fast as
+    replies come back. Returns loadgen.py's results for the post command.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadgen.py")
+    with tempfile.TemporaryDirectory(prefix="bulletin-bench-") as directory:
+        output = os.path.join(directory, "results.json")
+        subprocess.run(
+            [
+                sys.executable, script,
+                "--spawn-server",
+                "--server-args", server_args + " --log-level WARNING",
+                "--sessions", str(args.loadgen_sessions),
+                "--groups", str(args.loadgen_sessions),
+                "--mix", "post=1",
+                "--rate", "0",
+                "--duration", str(args.loadgen_duration),
+                "--output", output,
+            ],
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        with open(output) as results_file:
+            return json.load(results_file)["commands"]["post"]
+
+
+def bench_workers(args):
+    """Posting throughput over sockets, driven by loadgen.py, as the server runs more worker processes."""
+    report(
+        "%d sessions posting to their own groups as fast as replies come back, for %gs"
+        % (args.loadgen_sessions, args.loadgen_duration)
+    )
+    for workers in args.worker_counts:
+        posts = loadgen_posts(args, "--workers %d --fsync interval" % (workers))
+        report(
+            "  %2d worker(s): %8.0f posts/s (p50 %.2fms, p99 %.2fms, %d errors)"
+            % (workers, posts["throughput"], posts["p50_ms"], posts["p99_ms"], posts["errors"])
+        )
+
+
+BENCHMARKS = {
+    "group-locking": bench_group_locking,
+    "fanout": bench_fanout,
+    "wal": bench_wal,
+    "startup": bench_startup,
+    "memory": bench_memory,
+    "retention": bench_retention,
+    "search": bench_search,
+    "message-cache": bench_message_cache,
+    "metrics": bench_metrics,
+    "coalescing": bench_coalescing,
+    "resume": bench_resume,
+    "bulk": bench_bulk,
+    "workers": bench_workers,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulletin board server micro-benchmarks.")
+    parser.add_argument("benchmarks", nargs="*", help="benchmarks to run: %s (default: all)" % (", ".join(BENCHMARKS)))
+    parser.add_argument("--threads", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--posts", type=int, default=2000, help="posts (or commands) per thread")
+    parser.add_argument("--clients", type=int, default=10000, help="connected clients for the fanout benchmark")
+    parser.add_argument("--groups", type=int, default=500, help="groups the fanout clients are spread over")
+    parser.add_argument("--fanout-posts", type=int, default=2000, help="posts made in the fanout benchmark")
+    parser.add_argument("--recovery-posts", type=int, default=100000, help="posts recovered in the wal benchmark")
+    parser.add_argument("--startup-posts", type=int, default=1000000, help="posts stored in the startup benchmark")
+    parser.add_argument("--memory-posts", type=int, default=200000, help="posts stored in the memory benchmark")
+    parser.add_argument("--body-size", type=int, default=200, help="message body length in the memory benchmark")
+    parser.add_argument("--retain-posts", type=int, default=10000, help="posts kept in memory in the retention benchmark")
+    parser.add_argument("--retention-reads", type=int, default=20000, help="posts read in the retention benchmark")
+    parser.add_argument("--reads", type=int, default=20000, help="reads per thread in the message-cache benchmark")
+    parser.add_argument("--hot-posts", type=int, default=100, help="posts re-read in the message-cache benchmark")
+    parser.add_argument("--search-posts", type=int, default=1000000, help="posts indexed in the search benchmark")
+    parser.add_argument("--search-vocabulary", type=int, default=20000, help="distinct words in the search benchmark")
+    parser.add_argument("--burst-posts", type=int, default=1000, help="posts made in the coalescing benchmark")
+    parser.add_argument("--burst-size", type=int, default=100, help="posts per burst in the coalescing benchmark")
+    parser.add_argument("--burst-pause", type=float, default=0.05, help="seconds between bursts in the coalescing benchmark")
+    parser.add_argument("--burst-members", type=int, default=100, help="connected group members in the coalescing benchmark")
+    parser.add_argument("--coalesce-delay", type=float, default=0.05, help="coalescing window in the coalescing benchmark")
+    parser.add_argument("--bulk-posts", type=int, default=20000, help="posts made each way in the bulk benchmark")
+    parser.add_argument("--bulk-size", type=int, default=1000, help="posts per %%bulkpost in the bulk benchmark")
+    parser.add_argument("--import-posts", type=int, default=1000000, help="posts imported in the bulk benchmark")
+    parser.add_argument("--storm-clients", type=int, default=2000, help="clients reconnecting in the resume benchmark")
+    parser.add_argument("--worker-counts", type=lambda text: [int(count) for count in text.split(",")], default=[1, 2, 4], help="comma separated worker counts for the workers benchmark")
+    parser.add_argument("--loadgen-sessions", type=int, default=200, help="sessions loadgen.py opens in the wal and workers benchmarks")
+    parser.add_argument("--loadgen-duration", type=float, default=10, help="seconds loadgen.py posts for in the wal and workers benchmarks")
+    parser.add_argument("--rounds", type=int, default=5, help="rounds of each side in the metrics benchmark")
+    parser.add_argument("--search-queries", type=int, default=20, help="times each search benchmark query is run")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark '%s'" % (name))
+
+    # The server prints as it goes; keep that out of the results.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name in args.benchmarks or BENCHMARKS:
+            report("== %s: %s" % (name, BENCHMARKS[name].__doc__))
+            BENCHMARKS[name](args)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
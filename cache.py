@@ -0,0 +1,66 @@
+"""
+cache.py
+--------
+Bounded LRU cache used by the server for encoded message responses.
+"""
+
+import collections
+import threading
+
+
+class LRUCache:
+    """Least recently used cache of bytes values, bounded both by the number
+    of entries and by the total size of the values. Safe to share between
+    threads. A cache with max_entries or max_bytes of 0 stores nothing.
+    """
+
+    def __init__(self, max_entries, max_bytes) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the value cached for key (marking it recently used), or None."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used entries to make room.
+        Values bigger than the whole cache are not cached.
+        """
+        if len(value) > self.max_bytes or self.max_entries == 0:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop the value cached for key, if any."""
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+
+    def invalidate_matching(self, predicate):
+        """Drop every value whose key satisfies predicate(key)."""
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self.size -= len(self.entries.pop(key))
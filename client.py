@@ -13,23 +13,108 @@ import threading
 import sys
 import signal
 import time
+import argparse
+import concurrent.futures
+import os
+import random
+import re
+import sqlite3
+import protocol
+
+# Where fetched messages are cached by default (see MessageCache).
+CACHE_FILE = os.path.join(os.path.expanduser("~"), ".bulletin-board-cache.db")
+# A post in a %messages, %latest or %since listing: "#<ID> <post>".
+LISTING_LINE = re.compile(r"#(\d+) (.*)")
+# How often the client tries to resume its session after losing the
+# connection, and how long it waits before the first try. The wait doubles
+# every try and is randomized, so the clients of a server that went away
+# don't all come back at once.
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5
+
+
+class MessageCache:
+    """On-disk cache of the messages a client has fetched, keyed by server,
+    user name, group and message ID, so reading one again needs no round
+    trip. What a user may read depends on when they were a member, so users
+    never share cached messages, and the file is readable by its owner
+    only. Posts never change once made, so cached messages are never
+    refreshed. Safe to share between threads.
+    """
+
+    def __init__(self, path) -> None:
+        self.database = sqlite3.connect(path, check_same_thread=False)
+        os.chmod(path, 0o600)
+        self.lock = threading.Lock()
+        with self.lock, self.database:
+            self.database.execute(
+                "CREATE TABLE IF NOT EXISTS messages"
+                " (server TEXT, user TEXT, grp TEXT, id INTEGER, text TEXT, PRIMARY KEY (server, user, grp, id))"
+            )
+
+    def get(self, server, user, group, message_id):
+        """Return the cached text of a message, or None."""
+        with self.lock:
+            row = self.database.execute(
+                "SELECT text FROM messages WHERE server = ? AND user = ? AND grp = ? AND id = ?",
+                (server, user, group, message_id),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, server, user, group, messages):
+        """Cache messages, given as (message ID, text) pairs."""
+        with self.lock, self.database:
+            self.database.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                [(server, user, group, message_id, text) for message_id, text in messages],
+            )
+
+    def newest(self, server, user, group):
+        """Return the highest message ID cached for a group, or None."""
+        with self.lock:
+            return self.database.execute(
+                "SELECT MAX(id) FROM messages WHERE server = ? AND user = ? AND grp = ?", (server, user, group)
+            ).fetchone()[0]
 
 
 class Client:
     prefix = "%"
 
-    def __init__(self, username, group) -> None:
-        """Initialize the client."""
+    def __init__(self, username, group, framed=True, cache=None) -> None:
+        """Initialize the client. cache is the MessageCache to use, if any."""
         self.id = -1
         self.username = username
         self.group = group
         self.client_socket = None
+        # Speak the framed protocol (see protocol.py) or the legacy plain text one.
+        self.framed = framed
+        self.decoder = protocol.FrameDecoder()
+        self.next_request_id = protocol.HANDSHAKE_REQUEST_ID
+        # Requests that have been sent but not answered yet, as request ID ->
+        # Future resolved with the reply. Plain text replies carry no request
+        # ID, so they answer the requests in the order they were sent.
+        self.outstanding_requests = {}
+        self.requests_lock = threading.Lock()
+        # Commands and answers to heartbeats are sent from different threads.
+        self.send_lock = threading.Lock()
         self.client_running = False
         # Thread for handling responses from the server.
         self.cmd_thread = None
         self.data_read = threading.Event()
         self.cmd_kill_listener = threading.Event()
         self.recent_groups = ""
+        # Server the client is connected to, as "host:port", and the cache
+        # of the messages fetched from it.
+        self.server = None
+        self.cache = cache
+        # Token the session can be resumed with after losing the connection,
+        # if the server issued one, and whether the client is trying to.
+        self.session_token = None
+        self.reconnecting = False
+        # Set by the reader thread when it loses a connection whose session
+        # can be resumed. Only the thread sending commands reconnects (see
+        # client_send_commands), so a reconnect never races a disconnect.
+        self.connection_lost = threading.Event()
 
     def client_shutdown(self, signum=None, frame=None):
         """Shutdown the client and disconnect them from server if need be."""
@@ -45,10 +130,17 @@ class Client:
         """Disconnect client from the server."""
         # Send the exit command to the server telling them that we're either
         # just disconnecting from the server or fully shutting down the
-        # client (the server doesn't care about this distinction though)
-        self.client_socket.send("exit".encode())
-        while not self.data_read.is_set():
-            time.sleep(0.1)
+        # client (the server doesn't care about this distinction though).
+        # The session ends, so there's nothing to resume once it's closed.
+        self.session_token = None
+        if not self.connection_lost.is_set():
+            try:
+                self.client_send_commands(["exit"])
+            except OSError:
+                # Lost meanwhile: there's nobody left to tell.
+                pass
+            self.data_read.wait()
+        self.connection_lost.clear()
         self.cmd_kill_listener.set()
         self.cmd_thread.join()
         self.client_socket.close()
@@ -95,7 +187,8 @@ class Client:
                 match u_command[1:]:
                     case "help":
                         if self.id > -1:
-                            self.client_socket.send(u_command[1:].encode())
+                            self.client_send_commands([u_command[1:]])
+                            self.data_read.wait()
                         else:
                             print(
                                 "A %connect command followed by the address and port number of a running bulletin board server to connect to.\n"
@@ -118,27 +211,17 @@ class Client:
                                 host = str(u_parameters[0])
                                 port = int(u_parameters[1])
                                 print("Connecting to %s:%d..." % (host, port))
-                                # Instantiate a socket for the client
-                                self.client_socket = socket.socket()
-                                self.client_socket.connect((host, port))
-                                # Start the command processing thread.
-                                self.cmd_kill_listener.clear()
-                                self.cmd_thread = threading.Thread(target=self.client_read_server_response)
-                                self.cmd_thread.start()
-                                # Client has been connected, send username and group if applicable.
-                                self.client_socket.send(
-                                    (self.username + " " + self.group).encode()
-                                )
-                                # Wait for the ID to be set.
-                                while not self.data_read.is_set():
-                                    time.sleep(0.1)
+                                try:
+                                    self.client_connect(host, port)
+                                except (OSError, ConnectionError) as error:
+                                    print("Couldn't connect to %s:%d: %s" % (host, port, error))
+                                    continue
                                 # Print message to client terminal.
                                 print(
                                     "Success! Connected to %s:%s as ID #%d."
                                     % (host, port, self.id)
                                 )
                                 print(self.recent_groups)
-                                self.data_read.clear()
 
                     case "exit":
                         if self.id > -1:
@@ -153,48 +236,416 @@ class Client:
                             command_str = u_command[1:]
                             for param in u_parameters:
                                 command_str += " %s" % param
-                            self.client_socket.send(command_str.encode())
-                            # Wait for the server to respond and wait for the
-                            # client to read the data.
-                            while not self.data_read.is_set():
-                                time.sleep(0.1)
-                            self.data_read.clear()
+                            self.client_send_commands([command_str])
+                            # Wait for the server to respond and for the
+                            # reply to be printed.
+                            self.data_read.wait()
                         else:
                             print("Please connect to a server first.")
 
+    def client_connect(self, host, port):
+        """Connect to a server, perform the handshake and wait for the client ID."""
+        # Instantiate a socket for the client
+        self.client_socket = socket.socket()
+        self.client_socket.connect((host, port))
+        self.server = "%s:%d" % (host, port)
+        self.decoder = protocol.FrameDecoder()
+        self.next_request_id = protocol.HANDSHAKE_REQUEST_ID
+        # Start the command processing thread.
+        self.cmd_kill_listener.clear()
+        self.cmd_thread = threading.Thread(target=self.client_read_server_response)
+        self.cmd_thread.start()
+        # Client has been connected, send username and group if applicable
+        # (and the token of the session to resume, if any), and wait for the
+        # ID to be set.
+        handshake = self.username + " " + self.group
+        if self.session_token is not None:
+            handshake += " " + self.session_token
+        reply = self.client_send_commands([handshake])[0].result()
+        if not reply.startswith("id "):
+            # Turned away, such as by a full server.
+            self.cmd_kill_listener.set()
+            try:
+                self.client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.cmd_thread.join()
+            self.client_socket.close()
+            raise ConnectionError(reply)
+
+    def client_reconnect(self):
+        """Reconnect to the server after losing the connection, resuming the
+        session. Returns True once reconnected.
+        """
+        host, port = self.server.rsplit(":", 1)
+        delay = RECONNECT_DELAY
+        self.reconnecting = True
+        print("Reconnecting to %s..." % (self.server))
+        self.cmd_thread.join()
+        self.client_socket.close()
+        try:
+            for attempt in range(RECONNECT_ATTEMPTS):
+                time.sleep(random.uniform(0, delay))
+                delay *= 2
+                try:
+                    self.client_connect(host, int(port))
+                except (OSError, ConnectionError):
+                    self.client_socket.close()
+                    continue
+                print("Reconnected to %s as ID #%d." % (self.server, self.id))
+                return True
+        finally:
+            self.reconnecting = False
+        print("Couldn't reconnect to %s. Please connect again." % (self.server))
+        self.session_token = None
+        self.id = -1
+        return False
+
+    def client_run_batch(self, lines, concurrency=1, delay=0, timeout=None):
+        """Run the commands in lines (one per line, written as at the prompt;
+        blank lines and lines starting with # are skipped) without waiting
+        for input. Up to concurrency commands are in flight at once, a new
+        command is sent at most every delay seconds, and a command not
+        answered within timeout seconds fails the batch. Replies are printed
+        as they arrive and a summary is written to stderr. Returns the number
+        of commands that failed: timed out, went unanswered or were answered
+        with an error.
+        """
+        window = threading.Semaphore(concurrency)
+        sent = []
+        failures = 0
+        began = time.perf_counter()
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if not line.startswith(self.prefix):
+                print("Invalid command: %s" % (line), file=sys.stderr)
+                failures += 1
+                continue
+            command = line[len(self.prefix):]
+            if command == "exit":
+                break
+            if not window.acquire(timeout=timeout):
+                print("Timed out waiting for replies, stopping.", file=sys.stderr)
+                failures += 1
+                break
+            if delay and sent:
+                time.sleep(max(0, sent[-1][1] + delay - time.perf_counter()))
+            sent_at = time.perf_counter()
+            future = self.client_send_commands([command])[0]
+            sent.append((command, sent_at, future))
+            future.add_done_callback(lambda future: window.release())
+        latencies = []
+        for command, sent_at, future in sent:
+            try:
+                reply = future.result(timeout=max(0, sent_at + timeout - time.perf_counter()) if timeout else None)
+            except (concurrent.futures.TimeoutError, ConnectionError) as error:
+                print("%%%s: %s" % (command, str(error) or "Timed out."), file=sys.stderr)
+                failures += 1
+                continue
+            latencies.append(future.answered_at - sent_at)
+            if reply.startswith(("Error", "Invalid")):
+                failures += 1
+        elapsed = time.perf_counter() - began
+        latencies.sort()
+        print(
+            "%d command(s) in %.2fs (%.0f/s), %d failed. Latency p50 %.1fms, p99 %.1fms."
+            % (
+                len(sent),
+                elapsed,
+                len(sent) / elapsed if elapsed else 0,
+                failures,
+                latencies[len(latencies) // 2] * 1000 if latencies else 0,
+                latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0,
+            ),
+            file=sys.stderr,
+        )
+        return failures
+
+    def client_send_commands(self, commands):
+        """Send one or more commands to the server in a single write.
+        Every command gets its own request ID and the commands are pipelined:
+        data_read is cleared until every outstanding command is answered.
+        Returns a Future per command, resolved with its reply.
+        Messages already in the cache are answered from it without being sent.
+        If the connection was lost, the session is resumed first; if that
+        fails, the Futures fail with ConnectionError.
+        """
+        if self.connection_lost.is_set():
+            self.connection_lost.clear()
+            if not self.client_reconnect():
+                futures = [concurrent.futures.Future() for command in commands]
+                for future in futures:
+                    future.set_exception(ConnectionError("Disconnected from the server."))
+                return futures
+        frames = b""
+        futures = []
+        sending = []
+        cached = []
+        with self.requests_lock:
+            for command in commands:
+                command = self.client_complete_since(command)
+                command = self.client_read_bulkpost(command)
+                future = concurrent.futures.Future()
+                # The command, for caching its reply (None for the handshake).
+                future.command = command if self.id >= 0 else None
+                futures.append(future)
+                text = self.client_cached_message(command)
+                if text is not None:
+                    cached.append((future, text))
+                    continue
+                sending.append(command)
+                request_id = self.next_request_id
+                self.next_request_id = (self.next_request_id + 1) % 2**32
+                if self.framed:
+                    frames += protocol.encode_frame(protocol.REQUEST, request_id, command)
+                else:
+                    frames += command.encode()
+                self.outstanding_requests[request_id] = future
+            if sending:
+                self.data_read.clear()
+            elif not self.outstanding_requests:
+                self.data_read.set()
+        for future, text in cached:
+            print(text)
+            future.answered_at = time.perf_counter()
+            future.set_result(text)
+        if not sending:
+            return futures
+        with self.send_lock:
+            if self.framed:
+                self.client_socket.sendall(frames)
+            else:
+                # Plain text commands aren't delimited, so each needs its own send.
+                for command in sending:
+                    self.client_socket.sendall(command.encode())
+        return futures
+
+    def client_complete_since(self, command):
+        """Fill in the last seen message ID of a %since command given only a
+        group, from the newest message cached for the group.
+        """
+        params = command.split(" ")
+        groups = [param for param in params[1:] if param != "--bodies"]
+        if self.cache is None or self.id < 0 or params[0] != "since" or len(groups) != 1:
+            return command
+        newest = self.cache.newest(self.server, self.username, groups[0])
+        command = "since %s %d" % (groups[0], -1 if newest is None else newest)
+        return command + " --bodies" if "--bodies" in params else command
+
+    def client_read_bulkpost(self, command):
+        """Turn a %bulkpost command naming a group and a file into the command
+        the server takes: the group, then the file's lines (one message each,
+        its subject then its content).
+        """
+        params = command.split(" ")
+        if self.id < 0 or params[0] != "bulkpost" or len(params) != 3:
+            return command
+        if not self.framed:
+            # The server can't tell where a long plain text command ends, and
+            # turns %bulkpost down; don't send it the file.
+            return "bulkpost " + params[1]
+        try:
+            with open(params[2]) as posts_file:
+                lines = posts_file.read().splitlines()
+        except OSError as error:
+            print("Couldn't read %s: %s" % (params[2], error.strerror))
+            lines = []
+        return "\n".join(["bulkpost " + params[1]] + lines)
+
+    def client_cached_message(self, command):
+        """Return the cached reply to a %message or %groupmessage command, or None."""
+        params = command.split(" ")
+        if self.cache is None or self.id < 0:
+            # Not connected yet: this is the handshake.
+            return None
+        if params[0] == "message" and len(params) == 2:
+            group, message_id = "default", params[1]
+        elif params[0] == "groupmessage" and len(params) == 3:
+            group, message_id = params[1:]
+        else:
+            return None
+        if not message_id.isdigit():
+            return None
+        return self.cache.get(self.server, self.username, group, int(message_id))
+
+    def client_cache_reply(self, command, reply, final=True):
+        """Cache the messages in the reply (or, for a streamed listing, the
+        part of it) to a command. Only framed replies are cached: a plain
+        text read can hold a notification along with the reply, or instead
+        of it.
+        """
+        if self.cache is None or not self.framed or command is None or reply.startswith(("Error", "Invalid")):
+            return
+        params = command.split(" ")
+        if params[0] in ("message", "groupmessage") and final:
+            message_id = params[-1]
+            group = "default" if params[0] == "message" else params[1]
+            if len(params) == (2 if params[0] == "message" else 3) and message_id.isdigit():
+                self.cache.put(self.server, self.username, group, [(int(message_id), reply)])
+        elif params[0] in ("messages", "latest", "since") and "--bodies" in params and len(params) > 1:
+            lines = reply.split("\n")
+            if final:
+                # The last line sums up the listing.
+                lines = lines[:-1]
+            messages = []
+            for line in lines:
+                match = LISTING_LINE.match(line)
+                if match:
+                    messages.append([int(match.group(1)), match.group(2)])
+                elif messages:
+                    # A post whose message runs over several lines.
+                    messages[-1][1] += "\n" + line
+            self.cache.put(self.server, self.username, params[1], messages)
+
+    def client_complete_request(self, request_id, reply):
+        """Resolve an outstanding request's Future (the oldest one's when
+        request_id is None), and set data_read once none are left.
+        """
+        with self.requests_lock:
+            if request_id is None:
+                request_id = next(iter(self.outstanding_requests), None)
+            future = self.outstanding_requests.pop(request_id, None)
+            if not self.outstanding_requests:
+                self.data_read.set()
+        if future is not None:
+            self.client_cache_reply(future.command, reply)
+            # When the reply arrived, for the batch mode's latencies.
+            future.answered_at = time.perf_counter()
+            future.set_result(reply)
+
     def client_read_server_response(self):
         """Read response from server and print to terminal."""
-        # if the client is running,
-        while not self.cmd_kill_listener.is_set():
-            # we constantly check for data being sent from the server.
-            data = self.client_socket.recv(1024).decode()
-            # If we have data that starts with "id ", this is from
-            # the server response containing our client ID on connect.
-            if data.startswith("id "):
-                # Read the data and set the client ID.
-                self.id = int(data.split(" ")[1])
-                # Print the example groups 
-                self.recent_groups = (" ".join(data.split(" ")[2:]))
-                # Resume command input--data has been handled
-                self.data_read.set()
-            # All other non-nothing data is sent here.
-            elif data:
-                # Print whatever the result of the command was recieved
-                # as data from the server.
-                print(data)
-                # Resume command input--data has been handled
+        try:
+            # if the client is running,
+            while not self.cmd_kill_listener.is_set():
+                # we wait for data being sent from the server.
+                data = self.client_socket.recv(4096)
+                if not data:
+                    # The server closed the connection.
+                    break
+                if self.framed:
+                    for frame_type, request_id, payload in self.decoder.feed(data):
+                        self.client_handle_frame(frame_type, request_id, payload.decode())
+                else:
+                    self.client_handle_data(data.decode())
+        except (OSError, protocol.ProtocolError):
+            # Lost, or the server sent something that isn't a frame.
+            pass
+        finally:
+            # Nothing more will be answered: fail whatever is still waiting.
+            with self.requests_lock:
+                futures = list(self.outstanding_requests.values())
+                self.outstanding_requests.clear()
                 self.data_read.set()
+            for future in futures:
+                future.set_exception(ConnectionError("Disconnected from the server."))
+        if self.session_token is not None and not self.cmd_kill_listener.is_set() and not self.reconnecting:
+            # The connection was lost, not closed by %exit: the session is
+            # resumed before the next command is sent.
+            print("Lost the connection to %s. The session will be resumed with your next command." % (self.server))
+            self.connection_lost.set()
         return 0
 
+    def client_handle_frame(self, frame_type, request_id, data):
+        """Handle a single frame received with the framed protocol."""
+        if frame_type == protocol.HEARTBEAT:
+            # The server checking that we're still here.
+            with self.send_lock:
+                self.client_socket.sendall(protocol.encode_frame(protocol.HEARTBEAT, protocol.HANDSHAKE_REQUEST_ID, ""))
+            return
+        self.client_check_session_ended(data)
+        if frame_type in (protocol.NOTIFICATION, protocol.RESPONSE_PART):
+            # Broadcasts and the first parts of a streamed reply never
+            # release the prompt, they are just printed.
+            print(data)
+            if frame_type == protocol.RESPONSE_PART:
+                with self.requests_lock:
+                    future = self.outstanding_requests.get(request_id)
+                if future is not None:
+                    self.client_cache_reply(future.command, data, final=False)
+            return
+        if request_id == protocol.HANDSHAKE_REQUEST_ID and data.startswith("id "):
+            self.client_read_handshake(data)
+        else:
+            print(data)
+        # Resume command input once every pipelined command is answered
+        self.client_complete_request(request_id, data)
+
+    def client_handle_data(self, data):
+        """Handle data received with the plain text protocol."""
+        self.client_check_session_ended(data)
+        # If we have data that starts with "id ", this is from
+        # the server response containing our client ID on connect.
+        if data.startswith("id "):
+            self.client_read_handshake(data)
+            # Resume command input--data has been handled
+            self.client_complete_request(None, data)
+        # All other non-nothing data is sent here.
+        elif data:
+            # Print whatever the result of the command was recieved
+            # as data from the server.
+            print(data)
+            # Resume command input--data has been handled
+            self.client_complete_request(None, data)
+
+    def client_check_session_ended(self, data):
+        """Forget the session token if the server ended the session (such as
+        an idle session it closed), so the client doesn't try to resume it.
+        """
+        if data.startswith("You have been disconnected from the server"):
+            self.session_token = None
+
+    def client_read_handshake(self, data):
+        """Read the client ID, session token and example groups from the handshake reply."""
+        fields = data.split(" ")
+        self.id = int(fields[1])
+        if fields[2:3] == ["token"]:
+            self.session_token = fields[3]
+            fields = fields[2:]
+        else:
+            self.session_token = None
+        self.recent_groups = " ".join(fields[2:])
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Bulletin board terminal client.")
+    parser.add_argument("--plain", action="store_true", help="use the legacy plain text protocol instead of framed messages")
+    parser.add_argument("--username", help="username (prompted if omitted)")
+    parser.add_argument("--group", help="group to join on connect (prompted if omitted)")
+    parser.add_argument("--batch", metavar="FILE", help="run the commands in FILE ('-' for stdin) instead of prompting, then exit")
+    parser.add_argument("--host", default="127.0.0.1", help="server to connect to with --batch")
+    parser.add_argument("--port", type=int, default=1024, help="server port to connect to with --batch")
+    parser.add_argument("--concurrency", type=int, default=1, help="commands in flight at once with --batch")
+    parser.add_argument("--delay", type=float, default=0, help="seconds between sending commands with --batch")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each reply with --batch (0 for no limit)")
+    parser.add_argument("--cache-file", default=CACHE_FILE, help="file the messages already fetched are cached in")
+    parser.add_argument("--no-cache", action="store_true", help="don't cache fetched messages")
+    args = parser.parse_args()
+    if args.batch is not None and args.username is None:
+        parser.error("--batch needs --username")
+    if args.plain and args.concurrency > 1:
+        # Plain text replies can only be told apart by their order.
+        parser.error("--concurrency needs the framed protocol")
     # Get input from user, username and group
-    username = input("Enter username: ")
-    group = input("Enter group (RETURN if n/a): ")
+    username = args.username if args.username is not None else input("Enter username: ")
+    group = args.group if args.group is not None else ("" if args.batch is not None else input("Enter group (RETURN if n/a): "))
     # Instantiate client interface
     if group == "":
         group = "default"
-    client = Client(username, group)
+    client = Client(username, group, framed=not args.plain, cache=None if args.no_cache else MessageCache(args.cache_file))
+    if args.batch is not None:
+        lines = sys.stdin if args.batch == "-" else open(args.batch)
+        try:
+            client.client_connect(args.host, args.port)
+        except (OSError, ConnectionError) as error:
+            print("Couldn't connect to %s:%d: %s" % (args.host, args.port, error), file=sys.stderr)
+            return 1
+        failures = client.client_run_batch(lines, args.concurrency, args.delay, args.timeout or None)
+        if client.cmd_thread.is_alive():
+            client.client_disconnect_from_server()
+        return 1 if failures else 0
     # Register the Ctrl+C signal handler
     # Here we're doing an IMMEDIATE client shutdown on Ctrl+C,
     # where the user will be disconnected from the server in the event
@@ -209,4 +660,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,376 @@
+"""
+cluster.py
+----------
+Multi-process mode for the bulletin board server.
+
+With --workers N the server runs N worker processes on one host. Every worker
+listens on the same port (SO_REUSEPORT lets the kernel spread connections
+over them) and serves its own clients, so command handling isn't capped at
+the one core a single process can use.
+
+Groups are partitioned between the workers by a hash of their name. The
+worker that owns a group keeps its board, its membership and its part of the
+storage (in its own data directory), and runs every command on the group: a
+worker that gets a command for a group it doesn't own forwards it to the
+owner over a local channel, and the owner sends the replies back. Most
+clients mostly use the group they connect with, so a worker that accepts a
+connection whose handshake names a group it doesn't own hands the socket
+itself over to the group's owner before answering it. Every
+worker keeps a replica of the membership of the groups it doesn't own, kept
+up to date from the owner's create, join and leave records, so it can list
+groups and members itself and knows which of its own clients a group
+notification is for. Workers also tell each other when a user gets their
+first session on them or loses their last one, so the owner of a group only
+sends its notifications on to the workers with sessions of its members.
+Server-wide announcements are sent to every worker.
+
+Workers talk over Unix domain sockets in the data directory, with messages
+pickled by multiprocessing.connection. Every worker has one link to every
+other worker, and messages on a link are handled in the order they were
+sent, so a client always sees the effect of a join before the reply to it.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing.connection
+import multiprocessing.reduction
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+
+import storage
+
+log = logging.getLogger("server")
+
+# Threads per worker running commands forwarded by the other workers.
+FORWARDED_COMMAND_THREADS = 32
+# Seconds a starting worker waits for the others to come up.
+STARTUP_TIMEOUT = 30
+
+
+def group_owner(group, workers):
+    """Return the index of the worker that owns a group."""
+    return zlib.crc32(group.encode()) % workers
+
+
+def worker_data_dir(data_dir, index):
+    """Return the directory a worker keeps its part of the storage in."""
+    return os.path.join(data_dir, "worker-%d" % (index))
+
+
+def check_data_layout(data_dir, workers):
+    """Raise ValueError unless the data in data_dir was written by the same
+    number of workers. Groups are owned by a hash of their name modulo the
+    number of workers, so with any other number the server would silently
+    start without some (or, going from one process to several, all) of them.
+    """
+    indexes = set()
+    if os.path.isdir(data_dir):
+        for name in os.listdir(data_dir):
+            match = re.fullmatch(r"worker-(\d+)", name)
+            if match and os.path.isdir(os.path.join(data_dir, name)):
+                indexes.add(int(match.group(1)))
+    if workers > 1 and storage.holds_data(data_dir):
+        raise ValueError(
+            "%s holds the data of a single server process, which %d workers wouldn't use. "
+            "Start the server without --workers, or with a new --data-dir." % (data_dir, workers)
+        )
+    if indexes and indexes != set(range(workers)):
+        raise ValueError(
+            "%s holds the data of %d workers, not %d. Start the server with --workers %d, or with a new --data-dir."
+            % (data_dir, max(indexes) + 1, workers, max(indexes) + 1)
+        )
+
+
+def socket_path(data_dir, index):
+    return os.path.join(data_dir, "worker-%d.sock" % (index))
+
+
+class Peer:
+    """Link to another worker. Messages are queued and sent in order by a
+    writer thread, so a sender (possibly holding a group lock) never blocks
+    on the socket. A message can take a client socket along, which is then
+    passed to the other worker and closed here.
+    """
+
+    def __init__(self, index, address, authkey) -> None:
+        self.index = index
+        self.outbound = queue.SimpleQueue()
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while True:
+            try:
+                self.connection = multiprocessing.connection.Client(address, "AF_UNIX", authkey=authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The other worker hasn't started listening yet.
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        threading.Thread(target=self.write_outbound, daemon=True).start()
+
+    def send(self, message, client_socket=None):
+        self.outbound.put((message, client_socket))
+
+    def write_outbound(self):
+        while True:
+            message, client_socket = self.outbound.get()
+            try:
+                self.connection.send(message)
+                if client_socket is not None:
+                    multiprocessing.reduction.send_handle(self.connection, client_socket.fileno(), None)
+            except OSError:
+                return
+            finally:
+                if client_socket is not None:
+                    client_socket.close()
+
+
+class RemoteConnection:
+    """Stands in for the Connection of a client on another worker while a
+    forwarded command runs: replies and notifications are sent back to that
+    worker to deliver.
+    """
+
+    # Forwarded commands come whole, however the client sent them.
+    framed = True
+
+    def __init__(self, peer, client_id) -> None:
+        self.peer = peer
+        self.client_id = client_id
+
+    def reply(self, message):
+        self.peer.send(("reply", self.client_id, message))
+
+    def reply_part(self, message):
+        self.peer.send(("reply_part", self.client_id, message))
+
+    def notify(self, message):
+        self.peer.send(("notify", self.client_id, message))
+
+
+class Cluster:
+    """This worker's view of the other workers."""
+
+    def __init__(self, server, index, workers, socket_dir, authkey) -> None:
+        self.server = server
+        self.index = index
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.authkey = authkey
+        # Worker index -> Peer, for every other worker.
+        self.peers = {}
+        # Forwarded requests waiting for their answer, as token -> (worker, Future).
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.tokens = itertools.count()
+        self.forwarded = concurrent.futures.ThreadPoolExecutor(FORWARDED_COMMAND_THREADS)
+        # Set once every other worker has sent the membership of its groups.
+        self.synced = threading.Event()
+        self.syncs = 0
+        # Which workers each group notification has to go to. Both are
+        # guarded by the server's clients_lock.
+        #   user_workers    user name -> indexes of the other workers with sessions of the user
+        #   group_workers   owned group -> Counter of worker index -> members with sessions there
+        self.user_workers = collections.defaultdict(set)
+        self.group_workers = collections.defaultdict(collections.Counter)
+
+    def owns(self, group):
+        return group_owner(group, self.workers) == self.index
+
+    def start(self):
+        """Connect to the other workers and exchange group memberships.
+        Called after the worker has recovered its own groups and before it
+        accepts clients; returns once every replica is up to date.
+        """
+        path = socket_path(self.socket_dir, self.index)
+        if os.path.exists(path):
+            os.remove(path)
+        listener = multiprocessing.connection.Listener(path, "AF_UNIX", authkey=self.authkey)
+        threading.Thread(target=self.accept_peers, args=(listener,), daemon=True).start()
+        for index in range(self.workers):
+            if index != self.index:
+                self.peers[index] = Peer(index, socket_path(self.socket_dir, index), self.authkey)
+                self.peers[index].send(("hello", self.index))
+        with self.server.groups_lock:
+            owned = {
+                group: list(self.server.groups[group]) for group in self.server.groups if self.owns(group)
+            }
+        self.publish(("sync", owned))
+        if self.workers > 1 and not self.synced.wait(STARTUP_TIMEOUT):
+            raise RuntimeError("Timed out waiting for the other workers to start.")
+        log.info("Worker %d of %d ready.", self.index, self.workers)
+
+    def accept_peers(self, listener):
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=self.read_peer, args=(connection,), daemon=True).start()
+
+    def publish(self, message):
+        """Send a message to every other worker."""
+        for peer in self.peers.values():
+            peer.send(message)
+
+    def request(self, index, message):
+        """Send a request to a worker and return a Future for its answer."""
+        token = next(self.tokens)
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending[token] = (index, future)
+        self.peers[index].send((message[0], token) + message[1:])
+        return future
+
+    def forward(self, group, message):
+        """Send a request to the owner of group and wait for its answer."""
+        return self.request(group_owner(group, self.workers), message).result()
+
+    def announce_presence(self, client_name, present):
+        """Tell the other workers that a user got their first session here
+        (present) or lost their last one. Called with the server's
+        clients_lock held, so announcements go out in the order the sessions
+        changed. Returns Futures that are done once each worker has taken a
+        user's arrival into account; departures aren't acknowledged, as a
+        notification sent to a worker with no sessions for it is harmless.
+        """
+        if not present:
+            self.publish(("presence", None, client_name, False))
+            return []
+        return [self.request(index, ("presence", client_name, True)) for index in self.peers]
+
+    def member_changed(self, group, client_name, joined):
+        """Count a new or former member of an owned group towards the
+        workers the group's notifications go to. Called with the server's
+        clients_lock held.
+        """
+        if self.owns(group):
+            step = 1 if joined else -1
+            for index in self.user_workers[client_name]:
+                self.group_workers[group][index] += step
+
+    def presence_changed(self, index, client_name, present):
+        """Apply another worker's announcement of a user's presence there.
+        Called with the server's clients_lock held.
+        """
+        workers = self.user_workers[client_name]
+        if present == (index in workers):
+            return
+        if present:
+            workers.add(index)
+        else:
+            workers.discard(index)
+        step = 1 if present else -1
+        for group in self.server.user_groups[client_name]:
+            if self.owns(group):
+                self.group_workers[group][index] += step
+
+    def notify_group(self, group, message):
+        """Send a group notification to the workers with sessions of the
+        group's members. Called with the server's clients_lock held.
+        """
+        for index, members in self.group_workers[group].items():
+            if members > 0:
+                self.peers[index].send(message)
+
+    def hand_off(self, group, client_socket, data):
+        """Pass a client connection to the owner of group, along with the
+        data received on it so far (which the owner processes as if it had
+        received it itself). The socket is closed here once it's sent.
+        """
+        self.peers[group_owner(group, self.workers)].send(("adopt", data), client_socket)
+
+    def forward_command(self, group, client_id, client_name, data):
+        """Have the owner of group run a client's command. Returns what
+        handle_command returned there, or False if the owner is gone.
+        """
+        try:
+            return self.forward(group, ("command", client_id, client_name, data))
+        except ConnectionError:
+            self.server.connected_clients[client_id]["connection"].reply(
+                "Error: The server process handling group '%s' is unavailable." % (group)
+            )
+            return True
+
+    def forward_join(self, group, client_name):
+        """Have the owner of group add a connecting client to it."""
+        try:
+            self.forward(group, ("join", client_name, group))
+        except ConnectionError:
+            log.warning("Couldn't add %s to group %s: its worker is unavailable.", client_name, group)
+
+    def read_peer(self, connection):
+        """Handle the messages from one other worker, in the order they were sent."""
+        origin = None
+        try:
+            while True:
+                message = connection.recv()
+                kind = message[0]
+                if kind == "hello":
+                    origin = message[1]
+                elif kind == "adopt":
+                    handle = multiprocessing.reduction.recv_handle(connection)
+                    self.server.adopt_connection(handle, message[1])
+                elif kind in ("command", "join"):
+                    self.forwarded.submit(self.run_forwarded, self.peers[origin], message)
+                elif kind == "done":
+                    with self.pending_lock:
+                        owner, future = self.pending.pop(message[1])
+                    future.set_result(message[2])
+                elif kind in ("reply", "reply_part", "notify"):
+                    session = self.server.connected_clients.get(message[1])
+                    if session is not None:
+                        getattr(session["connection"], kind)(message[2])
+                elif kind == "notify_group":
+                    self.server.deliver_group(*message[1:])
+                elif kind == "presence":
+                    token, client_name, present = message[1:]
+                    with self.server.clients_lock:
+                        self.presence_changed(origin, client_name, present)
+                    if token is not None:
+                        self.peers[origin].send(("done", token, True))
+                elif kind == "broadcast":
+                    self.server.deliver_all(*message[1:])
+                elif kind == "record":
+                    self.server.apply_replica(message[1])
+                elif kind == "sync":
+                    for group, members in message[1].items():
+                        self.server.apply_replica(("create", group))
+                        for member in members:
+                            self.server.apply_replica(("join", group, member))
+                    self.syncs += 1
+                    if self.syncs == self.workers - 1:
+                        self.synced.set()
+        except (EOFError, OSError):
+            log.warning("Lost the link to worker %s.", origin)
+            # Nothing more will be answered by that worker.
+            with self.pending_lock:
+                lost = [token for token, (owner, future) in self.pending.items() if owner == origin]
+                futures = [self.pending.pop(token)[1] for token in lost]
+            for future in futures:
+                future.set_exception(ConnectionError("Worker %s is unavailable." % (origin)))
+
+    def run_forwarded(self, peer, message):
+        """Run a request forwarded by another worker and send back the answer."""
+        kind, token = message[0], message[1]
+        result = True
+        try:
+            if kind == "join":
+                client_name, group = message[2:]
+                self.server.ensure_member(group, client_name)
+            else:
+                client_id, client_name, data = message[2:]
+                self.server.remote_sessions[client_id] = {
+                    "name": client_name,
+                    "connection": RemoteConnection(peer, client_id),
+                }
+                try:
+                    result = self.server.handle_command(client_id, data)
+                finally:
+                    self.server.remote_sessions.pop(client_id, None)
+        except Exception:
+            log.exception("Forwarded %s failed.", kind)
+        finally:
+            peer.send(("done", token, result))
@@ -0,0 +1,166 @@
+"""
+coalescing.py
+-------------
+Coalescing of notifications during bursts, for the bulletin board server.
+
+Notifications are passed around as tuples rather than text, so several can
+be summarized in one message:
+    ("post", group, message ID, sender)
+    ("posts", group, first message ID, last message ID + 1, sender)
+    ("join", group, user name)
+    ("leave", group, user name)
+    ("connect", None, user name, client ID)
+
+With coalescing on, every recipient has a window per group (and one for
+server-wide announcements). The first notification is sent right away and
+opens the window. Whatever arrives for the same recipient and group while
+the window is open is held back, then sent as a single digest such as
+"12 new messages posted in X (IDs 340-351)." when the window closes, or
+as soon as batch_size notifications are waiting. A window that closed
+with something to send opens again, so a steady stream of notifications
+reaches a client at most once per window. An isolated notification is
+never delayed.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+
+def describe(notification):
+    """Return the text sent for a single notification."""
+    match notification:
+        case ("post", group, message_id, sender):
+            return f"New message posted in {group} by {sender} with ID#{message_id}."
+        case ("posts", group, first, last, sender):
+            return "%d new messages posted in %s (IDs %d-%d) by %s." % (last - first, group, first, last - 1, sender)
+        case ("join", group, client_name):
+            return f"New member {client_name} has joined group '{group}'."
+        case ("leave", group, client_name):
+            return f"User {client_name} has left group '{group}'."
+        case ("connect", None, client_name, client_id):
+            return "%s has joined the server (client ID #%d). " % (client_name, client_id)
+
+
+def summarize(notifications):
+    """Return the text of a digest of several notifications for one group:
+    one line for each kind of notification, in the order they first came.
+    """
+    kinds = {}
+    for notification in notifications:
+        kinds.setdefault(notification[0], []).append(notification)
+    lines = []
+    for kind, batch in kinds.items():
+        if len(batch) == 1:
+            lines.append(describe(batch[0]))
+            continue
+        group = batch[0][1]
+        match kind:
+            case "post":
+                lines.append("%d new messages posted in %s (%s)." % (len(batch), group, format_ids([n[2] for n in batch])))
+            case "posts":
+                message_ids = [message_id for n in batch for message_id in range(n[2], n[3])]
+                lines.append("%d new messages posted in %s (%s)." % (len(message_ids), group, format_ids(message_ids)))
+            case "join":
+                lines.append("%d new members have joined group '%s': %s." % (len(batch), group, ", ".join(n[2] for n in batch)))
+            case "leave":
+                lines.append("%d users have left group '%s': %s." % (len(batch), group, ", ".join(n[2] for n in batch)))
+            case "connect":
+                lines.append(
+                    "%d clients have joined the server: %s."
+                    % (len(batch), ", ".join("%s (client ID #%d)" % (n[2], n[3]) for n in batch))
+                )
+    return "\n".join(lines)
+
+
+def format_ids(message_ids):
+    """Format message IDs as a list, with runs of consecutive IDs as ranges."""
+    runs = []
+    for message_id in message_ids:
+        if runs and message_id == runs[-1][1] + 1:
+            runs[-1][1] = message_id
+        else:
+            runs.append([message_id, message_id])
+    return "IDs " + ", ".join(str(first) if first == last else "%d-%d" % (first, last) for first, last in runs)
+
+
+class NotificationCoalescer:
+    """Holds back notifications sent during a burst and sends them on as
+    digests (see the module docstring). A scheduler thread closes the
+    windows as their time runs out, taking them from a heap ordered by
+    deadline.
+    """
+
+    def __init__(self, delay, batch_size) -> None:
+        self.delay = delay
+        self.batch_size = batch_size
+        # (connection, group) -> notifications held back in its open window
+        self.windows = {}
+        # Heap of (deadline, sequence number, connection, group) for the open windows.
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.lock = threading.Condition()
+        # Notifications held back and folded into digests, and digests sent.
+        self.coalesced = 0
+        self.digests = 0
+        threading.Thread(target=self.close_windows, daemon=True).start()
+
+    def notify(self, connections, notification):
+        """Send a notification to several connections, or hold it back for
+        those with an open window for its group.
+        """
+        key_group = notification[1]
+        text = None
+        with self.lock:
+            for connection in connections:
+                key = (connection, key_group)
+                pending = self.windows.get(key)
+                if pending is None:
+                    # Nothing recent for this recipient: send it now and open a window.
+                    if text is None:
+                        text = describe(notification)
+                    connection.notify(text)
+                    self.open_window(key)
+                    continue
+                pending.append(notification)
+                if len(pending) >= self.batch_size:
+                    self.flush(key, pending)
+                    self.windows[key] = []
+
+    def open_window(self, key):
+        """Called with lock held."""
+        self.windows[key] = []
+        deadline = time.monotonic() + self.delay
+        heapq.heappush(self.deadlines, (deadline, next(self.sequence)) + key)
+        if self.deadlines[0][0] == deadline:
+            # The scheduler may be waiting for a later deadline.
+            self.lock.notify()
+
+    def flush(self, key, pending):
+        """Send what a window held back. Called with lock held."""
+        connection = key[0]
+        if len(pending) == 1:
+            connection.notify(describe(pending[0]))
+        else:
+            connection.notify(summarize(pending))
+            self.coalesced += len(pending)
+            self.digests += 1
+
+    def close_windows(self):
+        """Scheduler thread: close every window whose time is up."""
+        with self.lock:
+            while True:
+                if not self.deadlines:
+                    self.lock.wait()
+                    continue
+                wait = self.deadlines[0][0] - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+                deadline, sequence, connection, group = heapq.heappop(self.deadlines)
+                key = (connection, group)
+                pending = self.windows.pop(key)
+                if pending:
+                    self.flush(key, pending)
+                    self.open_window(key)
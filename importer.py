@@ -0,0 +1,147 @@
+"""
+importer.py
+-----------
+Offline bulk import of posts into the bulletin board server's storage.
+
+Reads posts from a JSONL file, one JSON object per line:
+
+    {"group": "news", "sender": "alice", "subject": "Hello", "message": "Hello everyone", "date": "2023-10-01"}
+
+("date" is optional and defaults to today) and writes them straight into the
+storage engine in the server's data directory, without going through a
+server. Groups that don't exist yet are created, and every post gets the next
+message ID of its group. Posts are written in batches, each with a single log
+append (or SQLite transaction), and the pickle engine's log is compacted into
+a snapshot at the end, so the server doesn't have to replay it on startup.
+
+Run it while the server is stopped, with the same --data-dir, --storage and
+--workers the server is started with:
+
+    python importer.py posts.jsonl --data-dir data --storage pickle
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import time
+
+import cluster
+import storage
+
+# Posts written to storage at a time.
+IMPORT_BATCH = 10000
+
+
+class Importer:
+    """Writes imported posts to the storage of each worker (just one unless
+    the server runs with --workers), keeping track of each group's next
+    message ID.
+    """
+
+    def __init__(self, data_dir, storage_engine=storage.STORAGE_ENGINE, workers=1, batch_size=IMPORT_BATCH) -> None:
+        self.data_dir = data_dir
+        self.storage_engine = storage_engine
+        self.workers = workers
+        self.batch_size = batch_size
+        # Worker index -> (storage engine, saved groups, records not written yet)
+        self.engines = {}
+        self.posts = 0
+        self.created = 0
+
+    def engine(self, group):
+        """Return (engine, saved groups, pending records) of the worker that owns group."""
+        index = cluster.group_owner(group, self.workers) if self.workers > 1 else 0
+        if index not in self.engines:
+            data_dir = self.data_dir
+            if self.workers > 1:
+                data_dir = cluster.worker_data_dir(data_dir, index)
+            engine = storage.STORAGE_ENGINES[self.storage_engine](data_dir)
+            groups = engine.recover()
+            groups.setdefault("default", {"members": {}, "past_memberships": {}, "next_message_id": 0})
+            self.engines[index] = (engine, groups, [])
+        return self.engines[index]
+
+    def add(self, group, post):
+        """Queue a post, and write the queue once it's a batch long."""
+        engine, groups, pending = self.engine(group)
+        if group not in groups:
+            self.record(groups, pending, ("create", group))
+            self.created += 1
+        self.record(groups, pending, ("post", group, groups[group]["next_message_id"], post))
+        self.posts += 1
+        if len(pending) >= self.batch_size:
+            engine.write_many(pending)
+            pending.clear()
+
+    @staticmethod
+    def record(groups, pending, record):
+        storage.apply_record(groups, record)
+        pending.append(record)
+
+    def close(self):
+        """Write what's left, snapshot (pickle engine) and close the storage."""
+        for engine, groups, pending in self.engines.values():
+            engine.write_many(pending)
+            pending.clear()
+            engine.finish_snapshot(engine.begin_snapshot(groups))
+            engine.close()
+
+
+def parse_post(line):
+    """Return (group, post) for a line of the JSONL file. Raises ValueError
+    (or KeyError for a missing field) if the line isn't a valid post.
+    """
+    item = json.loads(line)
+    date = datetime.date.fromisoformat(item["date"]) if "date" in item else datetime.date.today()
+    post = {"sender": str(item["sender"]), "date": date, "subject": str(item["subject"]), "message": str(item["message"])}
+    if not item["group"] or " " in item["group"]:
+        raise ValueError("invalid group name %r" % (item["group"]))
+    return str(item["group"]), post
+
+
+def import_posts(lines, importer):
+    """Import the posts in lines (of a JSONL file). Invalid lines are
+    reported on stderr and skipped. Returns the number of lines skipped.
+    """
+    skipped = 0
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            group, post = parse_post(line)
+        except (ValueError, KeyError, TypeError) as error:
+            print("Line %d skipped: %s" % (number, error), file=sys.stderr)
+            skipped += 1
+            continue
+        importer.add(group, post)
+    importer.close()
+    return skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import posts from a JSONL file into the bulletin board server's storage.")
+    parser.add_argument("file", help="JSONL file of posts ('-' for stdin)")
+    parser.add_argument("--data-dir", default=".", help="the server's data directory")
+    parser.add_argument("--storage", choices=storage.STORAGE_ENGINES, default=storage.STORAGE_ENGINE, help="the server's storage engine")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes the server runs (see cluster.py)")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH, help="posts written to storage at a time")
+    args = parser.parse_args()
+    try:
+        cluster.check_data_layout(args.data_dir, args.workers)
+    except ValueError as error:
+        parser.error(str(error))
+    importer = Importer(args.data_dir, args.storage, args.workers, args.batch_size)
+    began = time.perf_counter()
+    lines = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+    skipped = import_posts(lines, importer)
+    elapsed = time.perf_counter() - began
+    print(
+        "Imported %d posts (%d new groups) in %.2fs (%.0f posts/s), %d lines skipped."
+        % (importer.posts, importer.created, elapsed, importer.posts / elapsed if elapsed else 0, skipped)
+    )
+    return 1 if skipped else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,501 @@
+"""
+loadgen.py
+----------
+Headless load generator for the bulletin board server.
+Opens many concurrent sessions with the real handshake, sends a configurable
+mix of commands at a target rate over the framed protocol (see protocol.py)
+and reports throughput, per-command latency percentiles and how long post
+notifications take to reach the other members of a group. Results are
+printed and saved as JSON so runs can be compared over time.
+
+    python loadgen.py --spawn-server --sessions 200 --rate 2000 --duration 30
+
+With --churn it runs a soak test instead: every session connects, sends
+commands for a moment and goes away (with %exit, by hanging up, by going
+silent or with a broken handshake), then does it all again, for the whole
+duration, while the server's memory use, open file descriptors and threads
+are sampled to show they stay flat.
+
+    python loadgen.py --spawn-server --churn --duration 3600 --server-args "--heartbeat-interval 5 --read-timeout 5"
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import protocol
+
+# Commands loadgen can send, and the default mix (relative weights).
+COMMANDS = ("post", "groupjoin", "groupmessage", "groupusers", "groups")
+DEFAULT_MIX = "post=20,groupjoin=5,groupmessage=50,groupusers=10,groups=15"
+
+NOTIFICATION = re.compile(r"New message posted in (\S+) by \S+ with ID#(\d+)\.")
+# A digest of several post notifications (see coalescing.py).
+DIGEST = re.compile(r"\d+ new messages posted in (\S+) \(IDs ([\d, -]+)\)\.")
+
+# How --churn sessions end (relative weights): with %exit, by dropping the
+# connection, by no longer answering anything (heartbeats included) until
+# the server gives up on them, or by sending a handshake the server refuses.
+CHURN_ENDINGS = {"exit": 6, "hangup": 3, "silent": 1, "garbage": 1}
+
+
+def posts_announced(text):
+    """Return the (group, message ID) of every post a notification announces."""
+    posts = []
+    for line in text.split("\n"):
+        match = NOTIFICATION.match(line)
+        if match:
+            posts.append((match.group(1), int(match.group(2))))
+            continue
+        match = DIGEST.match(line)
+        if match:
+            for part in match.group(2).split(", "):
+                first, _, last = part.partition("-")
+                posts.extend((match.group(1), message_id) for message_id in range(int(first), int(last or first) + 1))
+    return posts
+
+
+def parse_mix(text):
+    """Parse a command mix such as "post=20,groupmessage=80" into {command: weight}."""
+    mix = {}
+    for item in text.split(","):
+        command, _, weight = item.partition("=")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError("unknown command '%s' (choose from %s)" % (command, ", ".join(COMMANDS)))
+        try:
+            mix[command] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError("invalid weight for '%s'" % (command))
+    return mix
+
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the (sorted) values fall."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stats:
+    """Measurements shared by every session."""
+
+    def __init__(self) -> None:
+        # command -> list of round trip times in seconds
+        self.latencies = {command: [] for command in COMMANDS}
+        self.errors = {command: 0 for command in COMMANDS}
+        # (group, message ID) -> when the post was sent, for matching notifications
+        self.posts_sent = {}
+        # (group, message ID, when the notification arrived)
+        self.notifications = []
+        # Highest message ID seen on each group, to pick IDs to read.
+        self.newest = {}
+
+    def saw_post(self, group, message_id):
+        if message_id > self.newest.get(group, -1):
+            self.newest[group] = message_id
+
+
+class Session:
+    """One client session: a sender that issues commands on a schedule and a
+    reader that matches responses to them by request ID.
+    """
+
+    def __init__(self, name, group, args, stats) -> None:
+        self.name = name
+        self.group = group
+        self.args = args
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.decoder = protocol.FrameDecoder()
+        self.next_request_id = protocol.HANDSHAKE_REQUEST_ID + 1
+        # request ID -> (command, when it was sent, group for post commands)
+        self.pending = {}
+        self.random = random.Random(name)
+        self.connected = False
+
+    async def connect(self):
+        """Connect and perform the handshake ("<name> <group>", answered with "id N ...")."""
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.writer.write(protocol.encode_frame(protocol.REQUEST, protocol.HANDSHAKE_REQUEST_ID, "%s %s" % (self.name, self.group)))
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("server closed the connection during the handshake")
+            for frame_type, request_id, payload in self.decoder.feed(data):
+                if frame_type == protocol.RESPONSE and request_id == protocol.HANDSHAKE_REQUEST_ID:
+                    if not payload.startswith(b"id "):
+                        raise ConnectionError(payload.decode())
+                    self.connected = True
+                    return
+
+    def next_command(self, mix, groups):
+        command = self.random.choices(list(mix), list(mix.values()))[0]
+        match command:
+            case "post":
+                return command, "grouppost %s subject %s" % (self.group, "x" * self.args.body_size)
+            case "groupjoin":
+                return command, "groupjoin %s" % (self.random.choice(groups))
+            case "groupmessage":
+                newest = self.stats.newest.get(self.group, 0)
+                return command, "groupmessage %s %d" % (self.group, self.random.randint(0, newest))
+            case "groupusers":
+                return command, "groupusers %s" % (self.group)
+            case "groups":
+                return command, "groups"
+
+    async def send_commands(self, mix, groups, rate, deadline):
+        """Send commands until the deadline. With a rate, commands are sent
+        open loop at exponentially distributed intervals (so a slow server
+        can't slow the offered load down and hide its own latency); without
+        one, the next command is sent as soon as the last is answered.
+        """
+        next_send = time.perf_counter()
+        while True:
+            if rate:
+                next_send += self.random.expovariate(rate)
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif self.pending:
+                await self.answered.wait()
+            if time.perf_counter() >= deadline:
+                return
+            command, text = self.next_command(mix, groups)
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.pending[request_id] = (command, time.perf_counter())
+            self.answered.clear()
+            self.writer.write(protocol.encode_frame(protocol.REQUEST, request_id, text))
+            await self.writer.drain()
+
+    async def read_responses(self):
+        """Match responses to commands and timestamp post notifications."""
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            now = time.perf_counter()
+            for frame_type, request_id, payload in self.decoder.feed(data):
+                text = payload.decode()
+                if frame_type == protocol.HEARTBEAT:
+                    self.writer.write(protocol.encode_frame(protocol.HEARTBEAT, protocol.HANDSHAKE_REQUEST_ID, ""))
+                    continue
+                if frame_type == protocol.NOTIFICATION:
+                    for group, message_id in posts_announced(text):
+                        self.stats.notifications.append((group, message_id, now))
+                        self.stats.saw_post(group, message_id)
+                    continue
+                match = NOTIFICATION.match(text)
+                if frame_type != protocol.RESPONSE or request_id not in self.pending:
+                    continue
+                command, sent = self.pending.pop(request_id)
+                self.stats.latencies[command].append(now - sent)
+                if text.startswith("Error") or text.startswith("Invalid"):
+                    self.stats.errors[command] += 1
+                if command == "post" and match:
+                    # The poster gets the post's announcement as its reply.
+                    group, message_id = match.group(1), int(match.group(2))
+                    self.stats.posts_sent[(group, message_id)] = sent
+                    self.stats.saw_post(group, message_id)
+                self.answered.set()
+
+    async def run(self, mix, groups, rate, deadline, ending="exit"):
+        """Send commands until the deadline, then end the session the given
+        way (see CHURN_ENDINGS).
+        """
+        self.answered = asyncio.Event()
+        reader = asyncio.create_task(self.read_responses())
+        await self.send_commands(mix, groups, rate, deadline)
+        # Give the last commands a moment to be answered.
+        grace = time.perf_counter() + self.args.drain_timeout
+        while self.pending and time.perf_counter() < grace:
+            await asyncio.sleep(0.05)
+        match ending:
+            case "exit":
+                self.writer.write(protocol.encode_frame(protocol.REQUEST, self.next_request_id, "exit"))
+                try:
+                    await asyncio.wait_for(reader, self.args.drain_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.writer.close()
+            case "hangup":
+                reader.cancel()
+                self.writer.transport.abort()
+            case "silent":
+                reader.cancel()
+                try:
+                    await asyncio.wait_for(self.wait_closed(), self.args.silent_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.writer.transport.abort()
+
+    async def wait_closed(self):
+        """Read (and ignore) everything until the server closes the connection."""
+        while await self.reader.read(65536):
+            pass
+
+    async def send_garbage(self):
+        """Send a handshake the server refuses, and wait for it to close the connection."""
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.writer.write(protocol.encode_frame(protocol.REQUEST, protocol.HANDSHAKE_REQUEST_ID, self.name))
+        await asyncio.wait_for(self.wait_closed(), self.args.connect_timeout)
+        self.writer.close()
+
+
+async def generate_load(args, mix):
+    stats = Stats()
+    groups = ["group%d" % (index) for index in range(args.groups)]
+    sessions = [Session("user%d" % (index), groups[index % len(groups)], args, stats) for index in range(args.sessions)]
+
+    # Connect everyone before the clock starts, a batch at a time.
+    began = time.perf_counter()
+    failed = 0
+    for first in range(0, len(sessions), args.connect_batch):
+        batch = sessions[first : first + args.connect_batch]
+        connecting = (asyncio.wait_for(session.connect(), args.connect_timeout) for session in batch)
+        for result in await asyncio.gather(*connecting, return_exceptions=True):
+            if isinstance(result, Exception):
+                failed += 1
+    connected = [session for session in sessions if session.connected]
+    connect_time = time.perf_counter() - began
+    print("%d session(s) connected in %.2fs, %d failed" % (len(connected), connect_time, failed))
+
+    rate = args.rate / len(connected) if args.rate and connected else 0
+    began = time.perf_counter()
+    await asyncio.gather(*(session.run(mix, groups, rate, began + args.duration) for session in connected))
+    elapsed = time.perf_counter() - began
+    return summarize(args, stats, len(connected), failed, connect_time, elapsed)
+
+
+def sample_process(pid):
+    """Return the (resident memory in KiB, open file descriptors, threads) of
+    a process, read from /proc (so Linux only).
+    """
+    fields = {}
+    with open("/proc/%d/status" % (pid)) as status:
+        for line in status:
+            name, _, value = line.partition(":")
+            fields[name] = value.split()
+    return int(fields["VmRSS"][0]), len(os.listdir("/proc/%d/fd" % (pid))), int(fields["Threads"][0])
+
+
+async def generate_churn(args, mix, pid):
+    """Soak test: keep args.sessions sessions connecting, working for a moment
+    and going away until the duration is over, sampling the server process
+    (pid, if known) every args.sample_interval seconds.
+    """
+    stats = Stats()
+    groups = ["group%d" % (index) for index in range(args.groups)]
+    endings = {ending: 0 for ending in CHURN_ENDINGS}
+    failed = 0
+    samples = []
+    began = time.perf_counter()
+    deadline = began + args.duration
+
+    async def churn(index):
+        nonlocal failed
+        chooser = random.Random(index)
+        while time.perf_counter() < deadline:
+            ending = chooser.choices(list(CHURN_ENDINGS), list(CHURN_ENDINGS.values()))[0]
+            # Names are reused, as returning users would.
+            session = Session("churn%d" % (index), groups[index % len(groups)], args, stats)
+            try:
+                if ending == "garbage":
+                    await session.send_garbage()
+                else:
+                    await asyncio.wait_for(session.connect(), args.connect_timeout)
+                    await session.run(mix, groups, 0, min(deadline, time.perf_counter() + args.churn_session_time), ending)
+                endings[ending] += 1
+            except (OSError, ConnectionError, asyncio.TimeoutError, protocol.ProtocolError):
+                failed += 1
+                if session.writer is not None:
+                    session.writer.transport.abort()
+
+    async def sample():
+        print("  %8s %12s %9s %8s %8s" % ("seconds", "connections", "RSS KiB", "fds", "threads"))
+        while True:
+            memory, descriptors, threads = sample_process(pid)
+            elapsed = time.perf_counter() - began
+            samples.append({"seconds": elapsed, "connections": sum(endings.values()), "rss_kib": memory, "fds": descriptors, "threads": threads})
+            print("  %8.0f %12d %9d %8d %8d" % (elapsed, sum(endings.values()), memory, descriptors, threads))
+            await asyncio.sleep(args.sample_interval)
+
+    sampler = asyncio.create_task(sample()) if pid is not None else None
+    await asyncio.gather(*(churn(index) for index in range(args.sessions)))
+    if sampler is not None:
+        sampler.cancel()
+    elapsed = time.perf_counter() - began
+    results = summarize(args, stats, args.sessions, failed, 0, elapsed)
+    results["churn"] = {"connections": endings, "failed": failed, "samples": samples}
+    return results
+
+
+def summarize(args, stats, sessions, failed, connect_time, elapsed):
+    """Work out the results to report."""
+    commands = {}
+    for command, latencies in stats.latencies.items():
+        if not latencies:
+            continue
+        latencies.sort()
+        commands[command] = {
+            "count": len(latencies),
+            "errors": stats.errors[command],
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "p999_ms": percentile(latencies, 0.999) * 1000,
+            "max_ms": latencies[-1] * 1000,
+        }
+    lags = sorted(
+        received - stats.posts_sent[(group, message_id)]
+        for group, message_id, received in stats.notifications
+        if (group, message_id) in stats.posts_sent
+    )
+    return {
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "sessions": sessions,
+        "failed_sessions": failed,
+        "connect_seconds": connect_time,
+        "duration_seconds": elapsed,
+        "throughput": sum(len(latencies) for latencies in stats.latencies.values()) / elapsed,
+        "commands": commands,
+        "notifications": {
+            "count": len(lags),
+            "lag_p50_ms": percentile(lags, 0.5) * 1000 if lags else None,
+            "lag_p99_ms": percentile(lags, 0.99) * 1000 if lags else None,
+            "lag_p999_ms": percentile(lags, 0.999) * 1000 if lags else None,
+            "lag_max_ms": lags[-1] * 1000 if lags else None,
+        },
+    }
+
+
+def print_results(results):
+    churn = results.get("churn")
+    if churn is not None:
+        print(
+            "%d connections over %.1fs (%s), %d failed"
+            % (
+                sum(churn["connections"].values()),
+                results["duration_seconds"],
+                ", ".join("%d %s" % (count, ending) for ending, count in churn["connections"].items()),
+                churn["failed"],
+            )
+        )
+        samples = churn["samples"]
+        if len(samples) > 1:
+            for key, label in (("rss_kib", "RSS KiB"), ("fds", "file descriptors"), ("threads", "threads")):
+                values = [sample[key] for sample in samples]
+                print("  server %s: %d at the start, %d at the end, %d at most" % (label, values[0], values[-1], max(values)))
+    print("%.0f commands/s over %.1fs" % (results["throughput"], results["duration_seconds"]))
+    print("  %-13s %8s %7s %9s %9s %9s %9s" % ("command", "count", "errors", "p50 ms", "p99 ms", "p999 ms", "max ms"))
+    for command, result in results["commands"].items():
+        print(
+            "  %-13s %8d %7d %9.2f %9.2f %9.2f %9.2f"
+            % (command, result["count"], result["errors"], result["p50_ms"], result["p99_ms"], result["p999_ms"], result["max_ms"])
+        )
+    notifications = results["notifications"]
+    if notifications["count"]:
+        print(
+            "  notification lag over %d deliveries: p50 %.2fms, p99 %.2fms, p999 %.2fms, max %.2fms"
+            % (notifications["count"], notifications["lag_p50_ms"], notifications["lag_p99_ms"], notifications["lag_p999_ms"], notifications["lag_max_ms"])
+        )
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def spawn_server(args):
+    """Start server.py on localhost with a fresh data directory. Returns (process, data directory)."""
+    data_dir = tempfile.mkdtemp(prefix="bulletin-loadgen-")
+    args.host = "127.0.0.1"
+    args.port = free_port()
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"),
+        "--host", args.host,
+        "--port", str(args.port),
+        "--data-dir", data_dir,
+        # Room for a whole batch of connections (--server-args can override it).
+        "--backlog", str(args.connect_batch),
+    ] + args.server_args.split()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process, data_dir
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                shutil.rmtree(data_dir)
+                raise RuntimeError("server.py did not start")
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulletin board server load generator.")
+    parser.add_argument("--host", default="127.0.0.1", help="server host")
+    parser.add_argument("--port", type=int, default=1024, help="server port")
+    parser.add_argument("--spawn-server", action="store_true", help="start server.py on a free localhost port (with a temporary data directory) for the run")
+    parser.add_argument("--server-args", default="", help="extra arguments for the spawned server, e.g. \"--asyncio --fsync interval\"")
+    parser.add_argument("--sessions", type=int, default=100, help="concurrent sessions")
+    parser.add_argument("--groups", type=int, default=10, help="groups the sessions are spread over")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="command mix as command=weight pairs (default: %s)" % (DEFAULT_MIX))
+    parser.add_argument("--rate", type=float, default=1000, help="target commands per second over all sessions (0 to send as fast as replies come back)")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to generate load for")
+    parser.add_argument("--body-size", type=int, default=100, help="length of posted message bodies")
+    parser.add_argument("--connect-batch", type=int, default=100, help="sessions connecting at once")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="seconds a session may take to connect and complete the handshake")
+    parser.add_argument("--drain-timeout", type=float, default=5, help="seconds to wait for outstanding replies at the end")
+    parser.add_argument("--churn", action="store_true", help="soak test: sessions keep connecting and going away for the whole duration, while the server's memory, file descriptors and threads are sampled")
+    parser.add_argument("--churn-session-time", type=float, default=1, help="seconds each --churn session sends commands for before it goes away")
+    parser.add_argument("--silent-timeout", type=float, default=60, help="seconds a --churn session that went silent waits for the server to close it")
+    parser.add_argument("--sample-interval", type=float, default=10, help="seconds between samples of the server process with --churn")
+    parser.add_argument("--server-pid", type=int, help="process ID of the server to sample with --churn (known with --spawn-server)")
+    parser.add_argument("--output", help="file to save the results as JSON (default: loadgen-<time>.json)")
+    args = parser.parse_args()
+
+    process = data_dir = None
+    if args.spawn_server:
+        process, data_dir = spawn_server(args)
+        args.server_pid = process.pid
+    try:
+        if args.churn:
+            results = asyncio.run(generate_churn(args, args.mix, args.server_pid))
+        else:
+            results = asyncio.run(generate_load(args, args.mix))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            shutil.rmtree(data_dir)
+
+    print_results(results)
+    output = args.output or "loadgen-%s.json" % (datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("Results saved to %s" % (output))
+    return 0
+
+
+if __name__ == "__main__":
+    main()
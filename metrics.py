@@ -0,0 +1,257 @@
+"""
+metrics.py
+----------
+Instrumentation for the bulletin board server: counters, histograms and
+gauges, served in the Prometheus text format by a small HTTP endpoint and
+summarized by the %stats admin command.
+
+Metrics can stay on in production: every thread records into its own shard
+of a counter or histogram, so recording a value takes no locks, and the
+shards are only added up when the metrics are read. Hot paths look their
+series up once (see series()) rather than on every record. Histograms have
+fixed buckets, so percentiles are estimates (the upper bound of the bucket
+they fall in).
+"""
+
+import bisect
+import http.server
+import threading
+import time
+
+# Bucket upper bounds, in seconds, for latencies and lock wait and hold times.
+TIME_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Locks are acquired far more often than anything else is recorded, so only
+# one acquisition in LOCK_SAMPLE is timed.
+LOCK_SAMPLE = 8
+# Bucket upper bounds for sizes, such as how many sessions a notification goes to.
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Counter:
+    """Monotonic count, sharded by thread."""
+
+    def __init__(self) -> None:
+        # thread ID -> [count]. Only its own thread writes a shard; thread IDs
+        # are reused, so there are never more shards than threads at once.
+        self.shards = {}
+
+    def increment(self, amount=1):
+        shard = self.shards.get(threading.get_ident())
+        if shard is None:
+            shard = self.shards.setdefault(threading.get_ident(), [0])
+        shard[0] += amount
+
+    @property
+    def value(self):
+        return sum(shard[0] for shard in list(self.shards.values()))
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, plus their count and sum,
+    sharded by thread like Counter.
+    """
+
+    def __init__(self, buckets) -> None:
+        self.buckets = buckets
+        # thread ID -> one count per bucket, one for values above every
+        # bucket, and the sum of the values.
+        self.shards = {}
+
+    def observe(self, value):
+        shard = self.shards.get(threading.get_ident())
+        if shard is None:
+            shard = self.shards.setdefault(threading.get_ident(), [0] * (len(self.buckets) + 2))
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def totals(self):
+        """Return (count per bucket, count, sum) over every shard."""
+        shards = list(self.shards.values())
+        counts = [sum(column) for column in zip(*shards)] or [0] * (len(self.buckets) + 2)
+        return counts[:-1], sum(counts[:-1]), counts[-1]
+
+    @property
+    def count(self):
+        return self.totals()[1]
+
+    def quantile(self, fraction):
+        """Estimate a quantile as the upper bound of the bucket it falls in."""
+        counts, count, total = self.totals()
+        if count == 0:
+            return None
+        seen = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            seen += bucket_count
+            if seen >= fraction * count:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Registry of the server's metrics.
+    Metrics are identified by name and a tuple of (label, value) pairs. A
+    disabled registry ignores everything recorded, so instrumented code
+    doesn't need to check whether metrics are on.
+    """
+
+    def __init__(self, enabled=True) -> None:
+        self.enabled = enabled
+        # name -> (Prometheus type, help text)
+        self.descriptions = {}
+        # (name, labels) -> Counter
+        self.counters = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        # name -> function returning the current value, read when rendered
+        self.callbacks = {}
+        # Serializes creating series.
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, text):
+        self.descriptions[name] = (kind, text)
+
+    def counter_series(self, name, labels=()):
+        """Return the Counter for a series, creating it if needed."""
+        counter = self.counters.get((name, labels))
+        if counter is None:
+            with self.lock:
+                counter = self.counters.setdefault((name, labels), Counter())
+        return counter
+
+    def histogram_series(self, name, labels=(), buckets=TIME_BUCKETS):
+        """Return the Histogram for a series, creating it if needed."""
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault((name, labels), Histogram(buckets))
+        return histogram
+
+    def increment(self, name, amount=1, labels=()):
+        if self.enabled:
+            self.counter_series(name, labels).increment(amount)
+
+    def observe(self, name, value, labels=(), buckets=TIME_BUCKETS):
+        if self.enabled:
+            self.histogram_series(name, labels, buckets).observe(value)
+
+    def register(self, name, kind, text, function):
+        """Add a metric whose value is read from function() when rendered."""
+        self.describe(name, kind, text)
+        self.callbacks[name] = function
+
+    def counter(self, name, labels=()):
+        counter = self.counters.get((name, labels))
+        return 0 if counter is None else counter.value
+
+    def histogram(self, name, labels=()):
+        return self.histograms.get((name, labels))
+
+    def labelled(self, name):
+        """Return {labels: Counter or Histogram} for every series of a metric."""
+        with self.lock:
+            series = {labels: counter for (key, labels), counter in self.counters.items() if key == name}
+            series.update({labels: histogram for (key, labels), histogram in self.histograms.items() if key == name})
+        return series
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: item[0])
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        names = sorted(
+            set(self.callbacks) | {name for (name, labels), value in counters} | {name for (name, labels), value in histograms}
+        )
+        for name in names:
+            kind, text = self.descriptions.get(name, ("untyped", name))
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if name in self.callbacks:
+                lines.append("%s %s" % (name, self.callbacks[name]()))
+            for (series, labels), counter in counters:
+                if series == name:
+                    lines.append("%s%s %s" % (name, format_labels(labels), counter.value))
+            for (series, labels), histogram in histograms:
+                if series != name:
+                    continue
+                counts, count, total = histogram.totals()
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", bound),)), cumulative))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), total))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics at http://host:port/metrics from a background thread."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        endpoint = http.server.ThreadingHTTPServer((host, port), Handler)
+        endpoint.daemon_threads = True
+        threading.Thread(target=endpoint.serve_forever, daemon=True).start()
+        return endpoint
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % (",".join('%s="%s"' % (label, value) for label, value in labels))
+
+
+class TimedLock:
+    """Mutex (used like threading.Lock) that records how long it is waited
+    for and held, as lock_wait_seconds and lock_hold_seconds, for one
+    acquisition in LOCK_SAMPLE.
+    """
+
+    def __init__(self, metrics, name) -> None:
+        self.lock = threading.Lock()
+        self.wait = metrics.histogram_series("lock_wait_seconds", (("lock", name),))
+        self.hold = metrics.histogram_series("lock_hold_seconds", (("lock", name),))
+        # Acquisitions left until the next timed one (never, when disabled).
+        self.countdown = 0 if metrics.enabled else float("inf")
+        # When the current holder acquired the lock, if it's being timed.
+        self.acquired = None
+
+    def __enter__(self):
+        # Racy without the lock, but that only moves which acquisition is timed.
+        self.countdown -= 1
+        if self.countdown >= 0:
+            self.lock.acquire()
+            return self
+        self.countdown = LOCK_SAMPLE - 1
+        began = time.perf_counter()
+        self.lock.acquire()
+        # Only the holder touches acquired, so it needs no further locking.
+        self.acquired = time.perf_counter()
+        self.wait.observe(self.acquired - began)
+        return self
+
+    def __exit__(self, *exc_info):
+        acquired = self.acquired
+        if acquired is None:
+            self.lock.release()
+            return
+        self.acquired = None
+        held = time.perf_counter() - acquired
+        self.lock.release()
+        self.hold.observe(held)
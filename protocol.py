@@ -0,0 +1,91 @@
+"""
+protocol.py
+-----------
+Framed wire protocol shared by the bulletin board server and client.
+
+Every frame starts with a fixed 10 byte header followed by a UTF-8 payload:
+
+    version (1 byte) | type (1 byte) | request ID (4 bytes) | length (4 bytes)
+
+All integers are unsigned and big-endian. Clients send REQUEST frames, the
+server answers each one with a RESPONSE frame carrying the same request ID,
+and unsolicited broadcasts are sent as NOTIFICATION frames (request ID 0).
+A long answer may be streamed as any number of RESPONSE_PART frames followed
+by the final RESPONSE frame, all carrying the request ID.
+Because replies carry the request ID, a client may pipeline many requests
+without waiting for each reply.
+
+The very first frame of a session is the handshake ("<name> <group>"), sent
+with request ID 0. It is answered with "id <client ID> ...", which also
+carries the session's token ("token <token>") when the server lets sessions
+be resumed: a client that lost its connection can reconnect with the
+handshake "<name> <group> <token>" to get its session back. The server tells the framed protocol apart from the plain
+text protocol by the first byte it receives: a plain text handshake always
+starts with a printable character, never with PROTOCOL_VERSION.
+
+When nothing has been received from a framed session for a while, the server
+sends it a HEARTBEAT frame (request ID 0, empty payload), which the client
+answers with a HEARTBEAT frame of its own. A session that doesn't answer in
+time is taken to be dead and its connection is dropped.
+"""
+
+import struct
+
+# Version of the framed protocol, also used as the first byte of every frame.
+PROTOCOL_VERSION = 1
+
+# Frame types
+REQUEST = 1
+RESPONSE = 2
+NOTIFICATION = 3
+RESPONSE_PART = 4
+HEARTBEAT = 5
+
+# Request ID used for the handshake and for notifications.
+HANDSHAKE_REQUEST_ID = 0
+
+HEADER = struct.Struct("!BBII")
+# Refuse frames larger than this, so a bad peer can't make us buffer forever.
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a frame that can't be decoded."""
+
+
+def is_framed(first_byte):
+    """Return True if a session starting with first_byte uses the framed protocol."""
+    return first_byte == PROTOCOL_VERSION
+
+
+def encode_frame(frame_type, request_id, payload):
+    """Encode a frame. The payload may be given as str or bytes."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, request_id, len(payload)) + payload
+
+
+class FrameDecoder:
+    """Incremental frame decoder. Feed it whatever recv() returned and it
+    returns every frame that is now complete, keeping partial frames buffered.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """Add received bytes and return a list of (type, request ID, payload bytes)."""
+        self.buffer += data
+        frames = []
+        while len(self.buffer) >= HEADER.size:
+            version, frame_type, request_id, length = HEADER.unpack_from(self.buffer)
+            if version != PROTOCOL_VERSION:
+                raise ProtocolError("Unsupported protocol version %d." % (version))
+            if length > MAX_PAYLOAD:
+                raise ProtocolError("Frame of %d bytes exceeds the payload limit." % (length))
+            end = HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((frame_type, request_id, bytes(self.buffer[HEADER.size : end])))
+            del self.buffer[:end]
+        return frames
@@ -0,0 +1,374 @@
+"""
+replication.py
+--------------
+Read replicas for the bulletin board server.
+
+A server started with --replication-port accepts followers on that port. A
+server started with --follow HOST:PORT is a follower: it keeps its own copy of
+the primary's groups, memberships and boards, kept current from the primary's
+stream of changes, and serves every read-only command (%message, %users,
+%groups, the listings, %search and so on) to its own clients from that copy.
+Commands that change anything (joins, posts and leaves, including the join
+of the handshake) are forwarded to the primary, which runs them for the
+follower's client and sends the replies back.
+
+When a follower connects, it tells the primary the next message ID of every
+board it already has in its own storage. The primary answers with a snapshot
+of every group's membership and the posts the follower is missing, then
+streams every change (create, join, leave and post records, in the order they
+were made) and every group notification, which the follower applies to its
+copy and delivers to its own clients. Replies to forwarded commands travel on
+the same link, after the changes the command made, so a client of a follower
+always reads its own writes.
+
+The primary sends a heartbeat every HEARTBEAT_INTERVAL seconds, so a follower
+knows how far behind it is (its replication lag) even when nothing changes.
+A follower that loses the primary keeps serving reads, answers writes with
+an error, and reconnects and catches up again in the background.
+
+Links use multiprocessing.connection over TCP, with messages pickled, so
+both sides must have the shared key from the BULLETIN_REPLICATION_KEY
+environment variable.
+"""
+
+import concurrent.futures
+import copy
+import itertools
+import logging
+import multiprocessing.connection
+import queue
+import threading
+import time
+
+import cluster
+
+log = logging.getLogger("server")
+
+# Seconds between heartbeats from the primary, and between a follower's
+# attempts to reach a primary it lost.
+HEARTBEAT_INTERVAL = 1
+RECONNECT_INTERVAL = 1
+# Posts sent in each message when a follower catches up.
+CATCH_UP_PAGE = 1000
+
+
+def parse_address(text):
+    """Parse "HOST:PORT" into (host, port). Raises ValueError if it isn't one."""
+    host, _, port = text.rpartition(":")
+    if not host:
+        raise ValueError("expected HOST:PORT, got %r" % (text))
+    return host, int(port)
+
+
+class FollowerLink:
+    """The primary's link to one follower. Messages are queued and sent in
+    order by a writer thread, once the follower has caught up, so a sender
+    (possibly holding a group lock) never blocks on the socket.
+    """
+
+    def __init__(self, connection, address) -> None:
+        self.connection = connection
+        self.address = address
+        self.outbound = queue.SimpleQueue()
+
+    def send(self, message):
+        self.outbound.put(message)
+
+    def start_writer(self):
+        threading.Thread(target=self.write_outbound, daemon=True).start()
+
+    def write_outbound(self):
+        while True:
+            message = self.outbound.get()
+            try:
+                self.connection.send(message)
+            except (OSError, ValueError):
+                # Closed: the reader takes care of the rest.
+                return
+
+    def local_id(self, client_id):
+        """Return the follower's own ID for one of its clients' remote
+        sessions here (see ReplicationSource.run_forwarded), or None for any
+        other client ID.
+        """
+        if isinstance(client_id, tuple) and client_id[0] is self:
+            return client_id[1]
+        return None
+
+
+class ReplicationSource:
+    """The primary's side: accepts followers, sends them the snapshot and
+    the changes, and runs the commands they forward.
+    """
+
+    def __init__(self, server, host, port, authkey) -> None:
+        self.server = server
+        self.host = host
+        self.port = port
+        self.authkey = authkey
+        # Followers that get the changes, and the sequence number of the last
+        # change sent. Guarded by lock, which also keeps every follower's
+        # stream in one order.
+        self.links = []
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.forwarded = concurrent.futures.ThreadPoolExecutor(cluster.FORWARDED_COMMAND_THREADS)
+
+    def start(self):
+        listener = multiprocessing.connection.Listener((self.host, self.port), authkey=self.authkey)
+        threading.Thread(target=self.accept_followers, args=(listener,), daemon=True).start()
+        threading.Thread(target=self.send_heartbeats, daemon=True).start()
+        log.info("Accepting followers on %s:%d.", self.host, self.port)
+
+    def accept_followers(self, listener):
+        while True:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as error:
+                log.warning("Refused a follower: %s", error)
+                continue
+            threading.Thread(target=self.serve_follower, args=(connection, listener.last_accepted), daemon=True).start()
+
+    def publish_records(self, records):
+        """Send changes to every follower. Called with the lock guarding the
+        changes held, so followers get them in the order they were made.
+        """
+        with self.lock:
+            for record in records:
+                self.sequence += 1
+                message = ("record", self.sequence, time.time(), record)
+                for link in self.links:
+                    link.send(message)
+
+    def publish_notification(self, group, notification, exclude, reply_to):
+        """Send a group notification to every follower, to deliver to its own
+        clients. Called with the group's lock held.
+        """
+        with self.lock:
+            for link in self.links:
+                local_exclude = tuple(link.local_id(client_id) for client_id in exclude)
+                link.send(("notify", group, notification, local_exclude, link.local_id(reply_to)))
+
+    def send_heartbeats(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self.lock:
+                for link in self.links:
+                    link.send(("heartbeat", self.sequence, time.time()))
+
+    def serve_follower(self, connection, address):
+        """Catch a follower up, then run the commands it forwards until it goes away."""
+        server = self.server
+        link = None
+        try:
+            kind, positions = connection.recv()
+            link = FollowerLink(connection, address)
+            # The membership is captured, and the follower starts getting the
+            # changes made from then on, with every group locked: nothing is
+            # missed or sent twice.
+            with server.groups_lock, server.locked_groups(server.groups, write=False):
+                groups = copy.deepcopy(server.save_groups())
+                with self.lock:
+                    self.links.append(link)
+            connection.send(("snapshot", groups))
+            # Then the posts it's missing, a page at a time, so posting
+            # carries on meanwhile.
+            posts = 0
+            for group, saved in groups.items():
+                for first in range(positions.get(group, 0), saved["next_message_id"], CATCH_UP_PAGE):
+                    with server.group_locks[group].read():
+                        page = server.storage.read_posts(group, first, min(first + CATCH_UP_PAGE, saved["next_message_id"]))
+                    if page:
+                        connection.send(("posts", group, page))
+                        posts += len(page)
+            connection.send(("caught_up",))
+            link.start_writer()
+            log.info("Follower %s:%d caught up (%d posts sent).", address[0], address[1], posts)
+            while True:
+                message = connection.recv()
+                self.forwarded.submit(self.run_forwarded, link, message)
+        except (EOFError, OSError):
+            pass
+        finally:
+            if link is not None:
+                with self.lock:
+                    if link in self.links:
+                        self.links.remove(link)
+                log.warning("Lost follower %s:%d.", address[0], address[1])
+            connection.close()
+
+    def run_forwarded(self, link, message):
+        """Run a request forwarded by a follower and send back the answer.
+        The follower's client gets a remote session keyed by (link, its
+        client ID on the follower), so it can't be mistaken for a client here.
+        """
+        kind, token = message[0], message[1]
+        result = True
+        try:
+            if kind == "join":
+                client_name, group = message[2:]
+                self.server.ensure_member(group, client_name)
+            else:
+                client_id, client_name, data = message[2:]
+                session_id = (link, client_id)
+                self.server.remote_sessions[session_id] = {
+                    "name": client_name,
+                    "connection": cluster.RemoteConnection(link, client_id),
+                }
+                try:
+                    result = self.server.handle_command(session_id, data)
+                finally:
+                    self.server.remote_sessions.pop(session_id, None)
+        except Exception:
+            log.exception("Forwarded %s failed.", kind)
+        finally:
+            link.send(("done", token, result))
+
+
+class Replica:
+    """A follower's link to its primary."""
+
+    def __init__(self, server, address, authkey) -> None:
+        self.server = server
+        self.address = address
+        self.authkey = authkey
+        self.connection = None
+        self.send_lock = threading.Lock()
+        # Forwarded requests waiting for their answer, as token -> Future.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.tokens = itertools.count()
+        # Set once the copy here has caught up with the primary.
+        self.caught_up = threading.Event()
+        # Sequence number of the last change applied, how long after the
+        # primary sent it the last change or heartbeat was handled here, and
+        # when that was (monotonic).
+        self.applied = 0
+        self.delay = 0.0
+        self.heard = time.monotonic()
+
+    @property
+    def lag(self):
+        """Seconds the copy here is behind the primary: how late the last
+        message from the primary was handled, plus, when the link is down,
+        the time since.
+        """
+        if self.connection is None:
+            return self.delay + time.monotonic() - self.heard
+        return self.delay
+
+    def start(self):
+        """Connect to the primary and catch up. Called after the follower has
+        recovered its own storage and before it accepts clients; returns once
+        the copy here is current.
+        """
+        threading.Thread(target=self.follow, daemon=True).start()
+        if not self.caught_up.wait(RECONNECT_INTERVAL * 5):
+            log.info("Waiting for the primary at %s:%d...", *self.address)
+            self.caught_up.wait()
+
+    def follow(self):
+        """Follow the primary for good, reconnecting whenever the link is lost."""
+        while True:
+            try:
+                connection = multiprocessing.connection.Client(self.address, authkey=self.authkey)
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            try:
+                self.read_primary(connection)
+            except (EOFError, OSError):
+                log.warning("Lost the primary at %s:%d, reconnecting.", *self.address)
+            except Exception:
+                # The copy here can't be trusted any more: start over from a
+                # fresh snapshot rather than serve stale reads for good.
+                log.exception("Failed to apply a change from the primary at %s:%d, resyncing.", *self.address)
+            finally:
+                with self.send_lock:
+                    self.connection = None
+                connection.close()
+                # Nothing more will be answered.
+                with self.pending_lock:
+                    futures = list(self.pending.values())
+                    self.pending.clear()
+                for future in futures:
+                    future.set_exception(ConnectionError("The primary is unavailable."))
+            time.sleep(RECONNECT_INTERVAL)
+
+    def read_primary(self, connection):
+        """Catch up with the primary, then apply its changes and deliver its
+        notifications and replies, in the order they were sent.
+        """
+        with self.server.groups_lock:
+            positions = dict(self.server.board_seqs)
+        connection.send(("hello", positions))
+        with self.send_lock:
+            self.connection = connection
+        while True:
+            message = connection.recv()
+            self.heard = time.monotonic()
+            kind = message[0]
+            if kind == "record":
+                sequence, sent, record = message[1:]
+                self.server.apply_change(record)
+                self.applied = sequence
+                self.delay = max(0.0, time.time() - sent)
+            elif kind == "notify":
+                self.server.deliver_group(*message[1:])
+            elif kind in ("reply", "reply_part"):
+                session = self.server.connected_clients.get(message[1])
+                if session is not None:
+                    getattr(session["connection"], kind)(message[2])
+            elif kind == "done":
+                with self.pending_lock:
+                    future = self.pending.pop(message[1], None)
+                if future is not None:
+                    future.set_result(message[2])
+            elif kind == "heartbeat":
+                self.applied = message[1]
+                self.delay = max(0.0, time.time() - message[2])
+            elif kind == "snapshot":
+                self.server.apply_snapshot(message[1])
+            elif kind == "posts":
+                self.server.apply_posts(*message[1:])
+            elif kind == "caught_up":
+                log.info("Caught up with the primary at %s:%d.", *self.address)
+                self.caught_up.set()
+
+    def request(self, message):
+        """Send a request to the primary and wait for its answer. Raises
+        ConnectionError if the primary is unavailable.
+        """
+        token = next(self.tokens)
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending[token] = future
+        try:
+            with self.send_lock:
+                if self.connection is None:
+                    raise ConnectionError("The primary is unavailable.")
+                self.connection.send((message[0], token) + message[1:])
+        except (ConnectionError, OSError):
+            with self.pending_lock:
+                self.pending.pop(token, None)
+            raise ConnectionError("The primary is unavailable.")
+        return future.result()
+
+    def forward_command(self, client_id, client_name, data):
+        """Have the primary run a client's command. Returns what
+        handle_command returned there.
+        """
+        try:
+            return self.request(("command", client_id, client_name, data))
+        except ConnectionError:
+            self.server.connected_clients[client_id]["connection"].reply(
+                "Error: This server is a read-only replica and can't reach its primary. Try again later."
+            )
+            return True
+
+    def forward_join(self, group, client_name):
+        """Have the primary add a connecting client to a group."""
+        try:
+            self.request(("join", client_name, group))
+        except ConnectionError:
+            log.warning("Couldn't add %s to group %s: the primary is unavailable.", client_name, group)
@@ -0,0 +1,97 @@
+"""
+search.py
+---------
+Full-text search over the posts on a board.
+
+Each group gets an inverted index mapping every term in its posts' subjects,
+bodies and senders to the IDs of the posts containing it. Posts only ever get
+added with increasing IDs, so postings are appended in ID order and can be
+intersected with binary searches. Matches are ranked by TF-IDF: a term counts
+for more the more often it occurs in a post, and the rarer it is on the board.
+"""
+
+import array
+import bisect
+import collections
+import heapq
+import math
+import re
+
+TERM = re.compile(r"\w+")
+# Occurrences in the subject or sender count this many times over one in the body.
+FIELD_WEIGHT = 2
+# Largest term count stored for a single post (counts are kept as bytes).
+MAX_COUNT = 0xFF
+
+
+def tokenize(text):
+    """Split text into lowercase search terms."""
+    return TERM.findall(text.lower())
+
+
+class GroupIndex:
+    """Inverted index over one group's posts."""
+
+    def __init__(self) -> None:
+        # term -> (message IDs containing it in ID order, term count in each)
+        self.postings = {}
+        self.documents = 0
+
+    def add(self, message_id, post):
+        """Index a post. Posts must be added in message ID order."""
+        counts = collections.Counter(tokenize(post["message"]))
+        for term in tokenize(post["subject"]) + tokenize(post["sender"]):
+            counts[term] += FIELD_WEIGHT
+        for term, count in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array.array("q"), array.array("B"))
+            posting[0].append(message_id)
+            posting[1].append(min(count, MAX_COUNT))
+        self.documents += 1
+
+    def search(self, query, accept, limit):
+        """Return the IDs of up to limit posts that contain every term in
+        query and for which accept(message_id) is true, best match first
+        (newest first among equally good matches).
+        """
+        terms = set(tokenize(query))
+        if not terms or any(term not in self.postings for term in terms):
+            return []
+        postings = sorted((self.postings[term] for term in terms), key=lambda posting: len(posting[0]))
+        if len(postings) == 1:
+            return self.search_term(postings[0], accept, limit)
+        # Walk the rarest term's postings and look each post up in the others.
+        weights = [math.log(1 + self.documents / len(message_ids)) for message_ids, counts in postings]
+        (first_ids, first_counts), others = postings[0], postings[1:]
+        matches = []
+        for position, message_id in enumerate(first_ids):
+            score = first_counts[position] * weights[0]
+            for (message_ids, counts), weight in zip(others, weights[1:]):
+                index = bisect.bisect_left(message_ids, message_id)
+                if index == len(message_ids) or message_ids[index] != message_id:
+                    break
+                score += counts[index] * weight
+            else:
+                matches.append((score, message_id))
+        return [message_id for score, message_id in heapq.nlargest(limit, (match for match in matches if accept(match[1])))]
+
+    def search_term(self, posting, accept, limit):
+        """search() for a single term, where the score only depends on the
+        count. Rather than score every post, take counts from the highest
+        down and find the posts with each count newest first with
+        bytes.rfind, so a common term costs a few scans of its counts.
+        """
+        message_ids, counts = posting
+        counts = counts.tobytes()
+        found = []
+        for count in sorted(set(counts), reverse=True):
+            end = len(counts)
+            while len(found) < limit:
+                position = counts.rfind(bytes((count,)), 0, end)
+                if position < 0:
+                    break
+                if accept(message_ids[position]):
+                    found.append(message_ids[position])
+                end = position
+        return found
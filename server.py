@@ -10,208 +10,1405 @@ import socket
 import threading
 import signal
 import sys
-import pickle
-from os.path import exists
 import datetime
-import copy
+import argparse
+import asyncio
+import time
+import os
+import subprocess
+import collections
+import contextlib
+import concurrent.futures
+import logging
+import secrets
+import protocol
+import storage
+import search
+import cache
+import metrics
+import cluster
+import coalescing
+import replication
+import timers
 
-# Define the max number of connections
+log = logging.getLogger("server")
+
+# Commands tracked separately in the command metrics (anything else counts as "invalid")
+COMMANDS = frozenset((
+    "help", "join", "post", "users", "leave", "message", "exit", "groups", "groupjoin", "grouppost",
+    "groupusers", "groupleave", "groupmessage", "messages", "latest", "since", "search", "stats", "bulkpost",
+))
+
+# Commands run by the worker that owns the group they're about: the default
+# group's, or the group named by their first parameter (see cluster.py).
+DEFAULT_GROUP_COMMANDS = frozenset(("join", "post", "leave", "message"))
+GROUP_COMMANDS = frozenset((
+    "groupjoin", "grouppost", "groupleave", "groupmessage", "messages", "latest", "since", "search", "bulkpost",
+))
+
+# Commands a follower forwards to its primary (see replication.py).
+WRITE_COMMANDS = frozenset(("join", "post", "leave", "groupjoin", "grouppost", "groupleave", "bulkpost"))
+
+# Define the default listen backlog (pending, not yet accepted connections)
 MAX_CONNECTIONS = 5
+# Define the default cap on concurrent sessions (None for no cap)
+MAX_SESSIONS = None
+# Define how many bytes are read from a client socket at a time
+RECV_BUFFER_SIZE = 4096
+# Define how many notifications may wait in a client's outbound queue
+OUTBOUND_QUEUE_SIZE = 256
+# Define what happens to notifications for a client whose queue is full
+OVERFLOW_POLICIES = ("drop", "coalesce", "disconnect")
+OVERFLOW_POLICY = "drop"
+# Define how many posts from before they joined a group a member may read
+HISTORY_LIMIT = 2
+# Define how many posts a %messages or %latest command lists at most, and how
+# many go in each page of the reply
+MESSAGES_LIMIT = 1000
+MESSAGES_PAGE_SIZE = 50
+# Define how many message IDs a %search command returns at most
+SEARCH_LIMIT = 20
+# Define how many posts a %bulkpost command may make at once
+BULKPOST_LIMIT = 10000
+# Define how many encoded %message responses are cached, and how many bytes
+# they may take up in total
+MESSAGE_CACHE_ENTRIES = 4096
+MESSAGE_CACHE_BYTES = 8 * 1024 * 1024
+# Define when the write-ahead log is compacted into a snapshot: after this
+# many records, or this many seconds after the last snapshot
+SNAPSHOT_RECORDS = 10000
+SNAPSHOT_INTERVAL = 300
+# Define how long notifications for a client are coalesced into a digest
+# during a burst (0 sends each one on its own), and how many a digest holds
+COALESCE_DELAY = 0
+COALESCE_BATCH = 100
+# Define how many seconds a session outlives a lost connection, waiting to be
+# resumed with its token (0 ends it right away), and how many notifications
+# are kept for it meanwhile
+RESUME_TIMEOUT = 60
+RESUME_BUFFER = 256
+# Define how many seconds a framed session may go without sending anything
+# before it's sent a heartbeat (0 for no heartbeats), how long a connection
+# has to answer a heartbeat or to complete its handshake, and how long a
+# session may go without sending a command before it's closed (0 to never
+# close idle sessions)
+HEARTBEAT_INTERVAL = 30
+READ_TIMEOUT = 10
+IDLE_TIMEOUT = 0
+# Define how many threads run commands in asyncio mode, off the event loop:
+# storage writes wait for the disk, and a write stuck on the loop would hold
+# up every connection (and leave group commit nothing to batch)
+COMMAND_THREADS = 16
+# Reply to the handshake of a client turned away by --max-sessions
+SERVER_FULL = "Error: Server is full, try again later."
+
+
+class AsyncClientSocket:
+    """Socket-like wrapper around an asyncio stream writer.
+    Lets a Connection write to, shut down and close a client the same way in
+    the threaded and the asyncio server modes.
+    """
+
+    def __init__(self, writer) -> None:
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    def sendall(self, data):
+        self.writer.write(data)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def shutdown(self, how):
+        # May be called from other threads (such as the timer wheel's).
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def close(self):
+        self.writer.close()
+
+
+class Connection:
+    """A client session's connection.
+    Works out which protocol the client speaks from the first bytes it sends
+    (plain text or framed, see protocol.py), splits incoming data into
+    commands and encodes outgoing replies and notifications to match.
+
+    Outgoing messages are only appended to a bounded outbound queue, which is
+    drained by a dedicated writer thread, so a handler never blocks on a slow
+    client while holding a server lock. Replies are always queued; once
+    max_queue notifications are waiting, the overflow policy decides what
+    happens to the next one:
+        drop        discard the new notification
+        coalesce    fold it into the last queued notification, which then
+                    reports how many were folded in and the latest one
+        disconnect  drop the client
+    on_overflow(outcome) is called every time the policy is applied, and
+    on_sent(byte count) after every write to the socket.
+    """
+
+    # Queue entry telling the writer to close the socket once everything
+    # before it has been sent.
+    CLOSE = None
+
+    def __init__(
+        self, client_socket, max_queue=OUTBOUND_QUEUE_SIZE, overflow_policy=OVERFLOW_POLICY, on_overflow=None, on_sent=None
+    ) -> None:
+        self.client_socket = client_socket
+        # None until the first bytes have been received.
+        self.framed = None
+        self.decoder = protocol.FrameDecoder()
+        # Set once the handshake has been handled.
+        self.client_id = None
+        # Request ID of the command currently being handled.
+        self.request_id = protocol.HANDSHAKE_REQUEST_ID
+        # Outbound queue of (frame type, request ID, message) entries.
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.on_overflow = on_overflow
+        self.outbound = collections.deque()
+        self.outbound_ready = threading.Condition()
+        self.queued_notifications = 0
+        # Notifications folded into the last queued one, and its original text.
+        self.coalesced = 0
+        self.coalesced_base = None
+        self.closed = False
+        self.aborted = False
+        # Everything received before the handshake, kept in case the
+        # connection is handed to another worker (see cluster.py).
+        self.received = b""
+        # Traffic on this connection, for %stats.
+        self.on_sent = on_sent
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # When (monotonic) the connection was opened, last received anything
+        # and last received a command, and when it was last sent a heartbeat,
+        # for the timer watching it (see Server.check_connection).
+        self.opened = self.last_received = self.last_active = time.monotonic()
+        self.heartbeat_sent = None
+        self.timer = None
+
+    def feed(self, data):
+        """Return the list of (request ID, command) pairs completed by data."""
+        self.bytes_in += len(data)
+        self.last_received = time.monotonic()
+        if self.framed is None:
+            self.framed = protocol.is_framed(data[0])
+        if not self.framed:
+            # Plain text: every read is taken to be exactly one command.
+            self.last_active = self.last_received
+            return [(protocol.HANDSHAKE_REQUEST_ID, data.decode())]
+        # Heartbeats only show the client is still there.
+        commands = [
+            (request_id, payload.decode())
+            for frame_type, request_id, payload in self.decoder.feed(data)
+            if frame_type == protocol.REQUEST
+        ]
+        if commands:
+            self.last_active = self.last_received
+        return commands
+
+    def reply(self, message):
+        """Queue the response to the command currently being handled."""
+        self.send(protocol.RESPONSE, self.request_id, message)
+
+    def reply_part(self, message):
+        """Queue part of a response to the command currently being handled;
+        the last part is sent with reply().
+        """
+        self.send(protocol.RESPONSE_PART, self.request_id, message)
+
+    def notify(self, message):
+        """Queue an unsolicited notification."""
+        self.send(protocol.NOTIFICATION, protocol.HANDSHAKE_REQUEST_ID, message)
+
+    def heartbeat(self):
+        """Queue a heartbeat, for the client to answer (framed protocol only)."""
+        self.heartbeat_sent = time.monotonic()
+        self.send(protocol.HEARTBEAT, protocol.HANDSHAKE_REQUEST_ID, "")
+
+    def send(self, frame_type, request_id, message):
+        """Queue a message for the writer. Never blocks on the socket."""
+        with self.outbound_ready:
+            if self.closed:
+                return
+            if frame_type == protocol.NOTIFICATION:
+                if self.queued_notifications >= self.max_queue:
+                    self.overflow(message)
+                    return
+                self.queued_notifications += 1
+            self.outbound.append((frame_type, request_id, message))
+        self.wake_writer()
+
+    def overflow(self, message):
+        """Apply the overflow policy to a notification. Called with outbound_ready held."""
+        if self.overflow_policy == "coalesce":
+            for index in range(len(self.outbound) - 1, -1, -1):
+                entry = self.outbound[index]
+                if entry is not self.CLOSE and entry[0] == protocol.NOTIFICATION:
+                    if self.coalesced == 0:
+                        self.coalesced_base = entry[2]
+                    self.coalesced += 1
+                    summary = "%s\n(%d more notification(s) coalesced, latest: %s)" % (
+                        self.coalesced_base,
+                        self.coalesced,
+                        message,
+                    )
+                    self.outbound[index] = (entry[0], entry[1], summary)
+                    break
+            outcome = "coalesced"
+        elif self.overflow_policy == "disconnect":
+            self.abort()
+            outcome = "disconnected"
+        else:
+            outcome = "dropped"
+        if self.on_overflow is not None:
+            self.on_overflow(outcome)
+
+    def encode(self, frame_type, request_id, message):
+        """Encode a queued message, given as str or as already encoded bytes."""
+        if self.framed:
+            return protocol.encode_frame(frame_type, request_id, message)
+        return message if isinstance(message, bytes) else message.encode()
+
+    def take_outbound(self):
+        """Remove and return everything queued. Called with outbound_ready held."""
+        entries = list(self.outbound)
+        self.outbound.clear()
+        self.queued_notifications = 0
+        self.coalesced = 0
+        return entries
+
+    def encode_batch(self, entries):
+        """Encode queued entries into the chunks of bytes to write.
+        Framed messages are written together in one chunk. Plain text messages
+        have no delimiters, so they keep one write each.
+        """
+        chunks = [self.encode(*entry) for entry in entries if entry is not self.CLOSE]
+        if self.framed and chunks:
+            chunks = [b"".join(chunks)]
+        return chunks
+
+    def start_writer(self):
+        threading.Thread(target=self.write_outbound, daemon=True).start()
+
+    def wake_writer(self):
+        with self.outbound_ready:
+            self.outbound_ready.notify()
+
+    def write_outbound(self):
+        """Writer thread: drain the outbound queue until the connection closes."""
+        while True:
+            with self.outbound_ready:
+                while not self.outbound and not self.closed:
+                    self.outbound_ready.wait()
+                if self.closed and not self.outbound:
+                    if self.aborted:
+                        # Dropped: the socket is shut down but still open.
+                        self.client_socket.close()
+                    return
+                entries = self.take_outbound()
+            try:
+                for chunk in self.encode_batch(entries):
+                    self.client_socket.sendall(chunk)
+                    self.count_sent(len(chunk))
+            except OSError:
+                self.abort()
+                self.client_socket.close()
+                return
+            if entries[-1] is self.CLOSE:
+                try:
+                    # Wakes up the reader, if it's still waiting for data.
+                    self.client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.client_socket.close()
+                return
+
+    def count_sent(self, length):
+        self.bytes_out += length
+        if self.on_sent is not None:
+            self.on_sent(length)
+
+    def close(self):
+        """Close the connection once everything already queued has been sent."""
+        with self.outbound_ready:
+            if self.closed:
+                return
+            self.outbound.append(self.CLOSE)
+            self.closed = True
+        self.wake_writer()
+
+    def detach(self):
+        """Stop the writer and leave the socket alone, for a connection handed
+        to another worker before anything was sent on it.
+        """
+        with self.outbound_ready:
+            self.closed = True
+        self.wake_writer()
+
+    def abort(self):
+        """Drop the connection right away, discarding anything still queued."""
+        with self.outbound_ready:
+            self.outbound.clear()
+            self.queued_notifications = 0
+            self.coalesced = 0
+            self.closed = True
+            self.aborted = True
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.wake_writer()
+
+
+class AsyncConnection(Connection):
+    """Connection for the asyncio server mode. The outbound queue is drained
+    by a writer task on the event loop instead of a thread.
+    """
+
+    def start_writer(self):
+        self.loop = asyncio.get_running_loop()
+        self.outbound_event = asyncio.Event()
+        self.writer_task = self.loop.create_task(self.write_outbound_async())
+
+    def wake_writer(self):
+        # Messages may be queued from other threads, so hop onto the loop.
+        self.loop.call_soon_threadsafe(self.outbound_event.set)
+
+    async def write_outbound_async(self):
+        """Writer task: drain the outbound queue until the connection closes."""
+        while True:
+            await self.outbound_event.wait()
+            self.outbound_event.clear()
+            with self.outbound_ready:
+                if self.closed and not self.outbound:
+                    return
+                entries = self.take_outbound()
+            if not entries:
+                continue
+            try:
+                for chunk in self.encode_batch(entries):
+                    self.client_socket.sendall(chunk)
+                    self.count_sent(len(chunk))
+                await self.client_socket.drain()
+            except (OSError, RuntimeError):
+                self.abort()
+                return
+            if entries[-1] is self.CLOSE:
+                self.client_socket.close()
+                return
+
+
+class DetachedConnection:
+    """Stands in for the Connection of a session whose client went away,
+    until the session is resumed or ends (see Server.detach_session).
+    Notifications are kept, up to limit (the oldest are dropped first), to be
+    replayed on the client's new connection. Replies have nobody to go to.
+    """
+
+    def __init__(self, connection, limit) -> None:
+        self.notifications = collections.deque(maxlen=limit)
+        # Notifications dropped because the buffer was full.
+        self.missed = 0
+        # The connection the session was resumed on, which gets anything sent
+        # here from then on (such as digests the coalescer was holding back).
+        self.resumed = None
+        self.lock = threading.Lock()
+        # Traffic on the lost connection, for %stats.
+        self.bytes_in = connection.bytes_in
+        self.bytes_out = connection.bytes_out
+
+    def reply(self, message):
+        pass
+
+    def reply_part(self, message):
+        pass
+
+    def notify(self, message):
+        with self.lock:
+            if self.resumed is None:
+                if len(self.notifications) == self.notifications.maxlen:
+                    self.missed += 1
+                self.notifications.append(message)
+                return
+        self.resumed.notify(message)
+
+    def resume(self, connection):
+        """Replay the kept notifications on the session's new connection."""
+        with self.lock:
+            if self.missed:
+                connection.notify(
+                    "%d older notification(s) were dropped while you were disconnected; use %%since to catch up."
+                    % (self.missed)
+                )
+            for message in self.notifications:
+                connection.notify(message)
+            self.notifications.clear()
+            self.resumed = connection
+
+
+class ReadWriteLock:
+    """Lock that lets in any number of readers at once, or a single writer.
+    Waiting writers hold back new readers, so a steady stream of reads can't
+    starve writes. Wait and hold times of a sample of acquisitions are
+    recorded in lock_wait_seconds and lock_hold_seconds (for every group lock
+    together, by mode), like metrics.TimedLock.
+    """
+
+    def __init__(self, metrics=None) -> None:
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+        # (wait, hold) histograms by mode, or None when not recording.
+        self.timers = None
+        self.countdown = 0
+        if metrics is not None and metrics.enabled:
+            self.timers = {
+                mode: tuple(
+                    metrics.histogram_series(name, (("lock", "group"), ("mode", mode)))
+                    for name in ("lock_wait_seconds", "lock_hold_seconds")
+                )
+                for mode in ("read", "write")
+            }
+
+    def sampled(self, mode):
+        """Return the (wait, hold) histograms if this acquisition is to be timed, or None."""
+        if self.timers is None:
+            return None
+        # Racy, but that only moves which acquisition is timed.
+        self.countdown -= 1
+        if self.countdown >= 0:
+            return None
+        self.countdown = metrics.LOCK_SAMPLE - 1
+        return self.timers[mode]
+
+    @contextlib.contextmanager
+    def read(self):
+        timers = self.sampled("read")
+        if timers is not None:
+            began = time.perf_counter()
+        with self.condition:
+            while self.writing or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        if timers is not None:
+            acquired = time.perf_counter()
+            timers[0].observe(acquired - began)
+        try:
+            yield
+        finally:
+            if timers is not None:
+                timers[1].observe(time.perf_counter() - acquired)
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        timers = self.sampled("write")
+        if timers is not None:
+            began = time.perf_counter()
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        if timers is not None:
+            acquired = time.perf_counter()
+            timers[0].observe(acquired - began)
+        try:
+            yield
+        finally:
+            if timers is not None:
+                timers[1].observe(time.perf_counter() - acquired)
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
 
 
 class Server:
-    def __init__(self, host, port) -> None:
+    def __init__(
+        self,
+        host,
+        port,
+        backlog=MAX_CONNECTIONS,
+        max_sessions=MAX_SESSIONS,
+        command_threads=COMMAND_THREADS,
+        queue_size=OUTBOUND_QUEUE_SIZE,
+        overflow_policy=OVERFLOW_POLICY,
+        data_dir=".",
+        storage_engine=storage.STORAGE_ENGINE,
+        fsync_policy=storage.FSYNC_POLICY,
+        fsync_interval=storage.FSYNC_INTERVAL,
+        snapshot_records=SNAPSHOT_RECORDS,
+        snapshot_interval=SNAPSHOT_INTERVAL,
+        message_cache_entries=MESSAGE_CACHE_ENTRIES,
+        message_cache_bytes=MESSAGE_CACHE_BYTES,
+        metrics_enabled=True,
+        admins=(),
+        admin_key=None,
+        coalesce_delay=COALESCE_DELAY,
+        coalesce_batch=COALESCE_BATCH,
+        retention=None,
+        group_retention=None,
+        resume_timeout=RESUME_TIMEOUT,
+        resume_buffer=RESUME_BUFFER,
+        heartbeat_interval=HEARTBEAT_INTERVAL,
+        read_timeout=READ_TIMEOUT,
+        idle_timeout=IDLE_TIMEOUT,
+        workers=1,
+        worker_index=0,
+        cluster_key=None,
+        follow=None,
+        replication_port=None,
+        replication_key=None,
+    ) -> None:
         """Initialize the server."""
         self.host = host
         self.port = port
-        self.client_ids = 0
+        self.backlog = backlog
+        self.max_sessions = max_sessions
+        # In asyncio mode the event loop only reads and writes; commands run
+        # on a pool of command_threads threads, created with the loop.
+        self.command_threads = command_threads
+        self.command_executor = None
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        # Every change is handed to the storage engine (see storage.py), which
+        # keeps the boards in data_dir. The pickle engine's write-ahead log is
+        # compacted into a snapshot in the background.
+        self.data_dir = data_dir
+        # With several workers (see cluster.py) each one stores the groups it
+        # owns in a directory of its own and client IDs are interleaved, so
+        # they're unique over the whole server.
+        self.cluster = None
+        if workers > 1:
+            self.cluster = cluster.Cluster(self, worker_index, workers, data_dir, cluster_key)
+            data_dir = cluster.worker_data_dir(data_dir, worker_index)
+            os.makedirs(data_dir, exist_ok=True)
+        self.storage = storage.STORAGE_ENGINES[storage_engine](data_dir, fsync_policy, fsync_interval)
+        self.snapshot_records = snapshot_records
+        # The pickle engine keeps each board's newest posts in memory as set
+        # by its storage.RetentionPolicy (group_retention, falling back on
+        # retention) and archives the rest in the background.
+        self.retention = retention or storage.RetentionPolicy()
+        self.group_retention = group_retention or {}
+        self.snapshot_interval = snapshot_interval
+        # Snapshots and archiving take turns: a snapshot that compacts the
+        # body segment moves the bodies an archive is written from.
+        self.compaction_lock = threading.Lock()
+        # Encoded responses to %message and %groupmessage by (group, message
+        # ID), shared by every reader: only the visibility check is per user.
+        # Posts never change once made; anything that changes or removes one
+        # must invalidate its entry.
+        self.message_cache = cache.LRUCache(message_cache_entries, message_cache_bytes)
+        # How often each overflow policy outcome happened.
+        self.overflow_counts = collections.Counter()
+        # Group notifications and server-wide announcements sent during a
+        # burst are folded into digests (see coalescing.py), if enabled.
+        self.coalescer = None
+        if coalesce_delay > 0:
+            self.coalescer = coalescing.NotificationCoalescer(coalesce_delay, coalesce_batch)
+        # A follower (follow is the primary's (host, port)) keeps a copy of
+        # the primary's groups and boards and forwards the commands that
+        # change them; a primary with a replication_port streams its changes
+        # to its followers (see replication.py).
+        self.replica = None
+        if follow is not None:
+            self.replica = replication.Replica(self, follow, replication_key)
+        self.replication = None
+        if replication_port is not None:
+            self.replication = replication.ReplicationSource(self, host, replication_port, replication_key)
+        # Instrumentation (see metrics.py), served by --metrics-port and
+        # summarized by %stats, which only the users in admins may run, and
+        # only by giving admin_key: user names are claimed, not authenticated.
+        self.metrics = metrics.Metrics(metrics_enabled)
+        self.describe_metrics()
+        # Series recorded on every command, looked up once here.
+        self.command_timers = {
+            name: self.metrics.histogram_series("command_seconds", (("command", name),))
+            for name in COMMANDS | {"handshake", "invalid"}
+        }
+        self.fanout_sizes = self.metrics.histogram_series("notification_fanout", buckets=metrics.SIZE_BUCKETS)
+        self.admins = set(admins)
+        self.admin_key = admin_key
+        self.stats_lock = threading.Lock()
+        self.active_sessions = 0
+        self.client_ids = worker_index
+        self.client_id_step = workers
         self.connected_clients = {}
-        # Groups loaded from groups.pkl on startup.
-        self.groups = {"default": []}
-        # Boards (and posts) are loaded from boards.pkl on startup.
-        self.boards = {"default": {}}
-        self.lock = threading.Lock()
+        # Every framed session gets a token at the handshake (the legacy
+        # plain text client would print it as part of the reply). A client whose
+        # connection is lost can present it when it reconnects, within
+        # resume_timeout seconds, to get its session back (client ID,
+        # memberships and the notifications it missed) without a new
+        # handshake (see resume_session).
+        #   session_tokens      token -> client ID of the session
+        #   detached_sessions   client ID -> when the session ends unless resumed
+        self.resume_timeout = resume_timeout
+        self.resume_buffer = resume_buffer
+        self.session_tokens = {}
+        self.detached_sessions = {}
+        # Every connection is watched by a timer on a single timer wheel
+        # (see timers.py and check_connection), which sends heartbeats and
+        # drops connections that time out.
+        self.heartbeat_interval = heartbeat_interval
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.timers = timers.TimerWheel()
+        # Clients of other workers whose forwarded commands are running here,
+        # as client ID -> {"name", "connection"} (see session()).
+        self.remote_sessions = {}
+        # Groups restored on startup. Each group maps its
+        # members (in join order) to their join sequence number: the ID the
+        # group's next post had when they joined.
+        self.groups = {"default": {}}
+        # Earlier memberships of users who left a group, as
+        # group -> user name -> list of (join, leave) sequence numbers.
+        self.past_memberships = {"default": {}}
+        # Sequence number (ID) of the next post on each board.
+        self.board_seqs = {"default": 0}
+        # Indexes kept in step with groups and connected_clients so a
+        # notification only touches the sessions that need it:
+        #   user_groups     user name -> groups the user is a member of
+        #   user_sessions   user name -> IDs of the user's connected clients
+        #   group_sessions  group -> IDs of connected clients that are members
+        self.user_groups = collections.defaultdict(set)
+        self.user_sessions = collections.defaultdict(set)
+        self.group_sessions = collections.defaultdict(set)
+        # Locking: groups_lock guards the set of groups (creating a group and
+        # its board), each group's ReadWriteLock in group_locks guards that
+        # group's board and member list, and clients_lock guards
+        # connected_clients, client_ids, active_sessions, the session
+        # tokens and the session indexes above. When more than one is needed they are taken in that
+        # order, and several group locks are taken in sorted group name order
+        # (see locked_groups).
+        self.groups_lock = metrics.TimedLock(self.metrics, "groups")
+        self.group_locks = {"default": ReadWriteLock(self.metrics)}
+        # Search index of each group (see search.py). Every group's index is
+        # built in the background once the server has started (see
+        # index_groups), or by the first search of the group if that comes
+        # sooner, and kept up to date by store_post from then on. A group's
+        # lock in search_locks serializes the builds of its index.
+        self.search_indexes = {}
+        self.search_locks = collections.defaultdict(threading.Lock)
+        self.clients_lock = metrics.TimedLock(self.metrics, "clients")
+
+    def describe_metrics(self):
+        """Describe the recorded metrics, and register the ones read from the server's state."""
+        describe = self.metrics.describe
+        describe("command_seconds", "histogram", "Time taken to run a command (and how many were run), by command.")
+        describe("lock_wait_seconds", "histogram", "Time spent waiting for a lock, by lock.")
+        describe("lock_hold_seconds", "histogram", "Time a lock was held for, by lock.")
+        describe("bytes_received_total", "counter", "Bytes received from clients.")
+        describe("bytes_sent_total", "counter", "Bytes sent to clients.")
+        describe("notification_fanout", "histogram", "Sessions each group notification was sent to.")
+        describe("overflows_total", "counter", "Outbound queue overflows, by outcome.")
+        describe("sessions_resumed_total", "counter", "Sessions resumed with their token.")
+        describe("connections_timed_out_total", "counter", "Connections dropped or closed by a timeout, by reason.")
+        register = self.metrics.register
+        register("connected_clients", "gauge", "Clients that completed the handshake.", lambda: len(self.connected_clients))
+        register("active_sessions", "gauge", "Open client connections.", lambda: self.active_sessions)
+        register("groups", "gauge", "Groups on the server.", lambda: len(self.groups))
+        register("detached_sessions", "gauge", "Sessions waiting to be resumed.", lambda: len(self.detached_sessions))
+        register("timers", "gauge", "Timers on the timer wheel (one per open connection).", lambda: len(self.timers))
+        register("message_cache_hits_total", "counter", "Message cache hits.", lambda: self.message_cache.hits)
+        register("message_cache_misses_total", "counter", "Message cache misses.", lambda: self.message_cache.misses)
+        register("message_cache_evictions_total", "counter", "Message cache evictions.", lambda: self.message_cache.evictions)
+        if self.coalescer is not None:
+            register("notifications_coalesced_total", "counter", "Notifications folded into digests.", lambda: self.coalescer.coalesced)
+            register("notification_digests_total", "counter", "Digests of coalesced notifications sent.", lambda: self.coalescer.digests)
+        if self.replica is not None:
+            register("replication_lag_seconds", "gauge", "How far the copy here is behind the primary.", lambda: self.replica.lag)
+            register("replication_changes_applied", "counter", "Sequence number of the last change applied from the primary.", lambda: self.replica.applied)
+        if self.replication is not None:
+            register("replication_followers", "gauge", "Followers getting the changes made here.", lambda: len(self.replication.links))
 
     def server_shutdown(self, signum, frame):
         """Shutdown server and save data for next startup."""
-        print("\nCtrl+C pressed. Starting shutdown...")
-        # Pickle anything that needs to be saved and reloaded next time the
-        # server starts up.
-        # Save the list of groups to groups.pkl using pickle.
-        output = open("groups.pkl", "wb")
-        pickle.dump(self.groups, output)
-        output.close()
-        print("List of groups saved...")
-        # Save the list of boards and posts to boards.pkl using pickle.
-        output = open("boards.pkl", "wb")
-        pickle.dump(self.boards, output)
-        output.close()
-        print("List of boards and posts saved...")
+        log.info("Ctrl+C pressed. Starting shutdown...")
+        # Everything is already in the write-ahead log; compact it into a
+        # snapshot so the next startup doesn't have to replay it.
+        self.server_snapshot()
+        self.storage.close()
+        log.info("Groups, boards and posts saved...")
+        log.info(
+            "Outbound queue overflows: %d dropped, %d coalesced, %d disconnected.",
+            *(self.overflow_counts[outcome] for outcome in ("dropped", "coalesced", "disconnected"))
+        )
+        log.info(
+            "Message cache: %d hits, %d misses, %d evictions.",
+            self.message_cache.hits, self.message_cache.misses, self.message_cache.evictions
+        )
+        if self.coalescer is not None:
+            log.info(
+                "Notification coalescing: %d notifications sent as %d digests.",
+                self.coalescer.coalesced, self.coalescer.digests
+            )
         # Shut down the process.
-        print("Done! See you later.")
+        log.info("Done! See you later.")
         sys.exit(0)
 
+    def server_load_data(self):
+        """Restore data that needs to be set on server startup from the
+        storage engine. Boards stay with the engine; only groups are loaded.
+        """
+        groups = self.storage.recover()
+        self.restore_groups(groups)
+        log.info("%d group(s) loaded", len(groups))
+        if self.cluster is not None:
+            # Get the other workers' groups before serving anyone.
+            self.cluster.start()
+        if self.replica is not None:
+            # Catch up with the primary before serving anyone.
+            self.replica.start()
+        if self.replication is not None:
+            self.replication.start()
+
+        # Index the boards for %search, compact the log, end expired
+        # sessions and watch connections in the background from now on.
+        threading.Thread(target=self.index_groups, daemon=True).start()
+        threading.Thread(target=self.compact_periodically, daemon=True).start()
+        threading.Thread(target=self.expire_sessions, daemon=True).start()
+        self.timers.start()
+
+    def server_snapshot(self):
+        """Have the storage engine write a snapshot (and drop the log it replaces).
+        The state is captured while every group is locked, so the snapshot
+        matches the log exactly; the (slow) write happens after the locks are
+        released. A snapshot that compacts the storage write-locks the groups.
+        """
+        with self.compaction_lock:
+            compact = self.storage.compaction_due()
+            with self.groups_lock, self.locked_groups(self.groups, write=compact):
+                snapshot = self.storage.begin_snapshot(self.save_groups(), compact)
+            self.storage.finish_snapshot(snapshot)
+
+    def compact_periodically(self):
+        """Background compaction: take a snapshot whenever the log has grown
+        enough (or the storage wants compacting), and archive the posts the
+        retention policies don't keep.
+        """
+        while True:
+            time.sleep(1)
+            if self.storage.snapshot_due(self.snapshot_records, self.snapshot_interval) or self.storage.compaction_due():
+                self.server_snapshot()
+            self.archive_posts()
+
+    def archive_posts(self):
+        """Move the posts past each group's retention policy to the archive.
+        The archive segment is written without any locks held; only dropping
+        the posts from memory holds up the group.
+        """
+        with self.groups_lock:
+            groups = [group for group in self.groups if self.owns(group)]
+        for group in groups:
+            policy = self.group_retention.get(group, self.retention)
+            with self.compaction_lock:
+                archive = self.storage.prepare_archive(group, policy)
+            if archive is not None:
+                with self.group_locks[group].write():
+                    self.storage.commit_archive(archive)
+                log.debug("Archived posts %d to %d of group %s.", archive[2], archive[3] - 1, group)
+
+    def expire_sessions(self):
+        """End the detached sessions that weren't resumed in time."""
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            with self.clients_lock:
+                expired = [client_id for client_id, deadline in self.detached_sessions.items() if deadline <= now]
+                for client_id in expired:
+                    self.end_session(client_id)
+            for client_id in expired:
+                log.debug("The session of client ID #%d expired.", client_id)
+
+    def log_record(self, record):
+        """Hand a change to the storage engine. Called with the lock guarding
+        the change held, so the engine sees changes in the order they're made.
+        Changes to groups are also sent to the other workers' replicas, and
+        every change to the followers.
+        """
+        self.storage.write(record)
+        if self.cluster is not None and record[0] != "post":
+            self.cluster.publish(("record", record))
+        if self.replication is not None:
+            self.replication.publish_records([record])
+
+    def owns(self, group):
+        """Return True if this process keeps the group's board (always, unless
+        there are several workers).
+        """
+        return self.cluster is None or self.cluster.owns(group)
+
+    def save_groups(self):
+        """Return the groups in the format saved to groups.pkl:
+        group -> {"members", "past_memberships", "next_message_id"}.
+        """
+        return {
+            group: {
+                "members": members,
+                "past_memberships": self.past_memberships[group],
+                "next_message_id": self.board_seqs[group],
+            }
+            for group, members in self.groups.items()
+            if self.owns(group)
+        }
+
+    def restore_groups(self, groups):
+        """Restore groups loaded from storage (in the save_groups format), then rebuild the indexes."""
+        groups.setdefault("default", {"members": {}, "past_memberships": {}, "next_message_id": 0})
+        self.groups = {}
+        for group, saved in groups.items():
+            self.groups[group] = saved["members"]
+            self.past_memberships[group] = saved["past_memberships"]
+            self.board_seqs[group] = saved["next_message_id"]
+            self.group_locks[group] = ReadWriteLock(self.metrics)
+            for member in self.groups[group]:
+                self.user_groups[member].add(group)
+
     def server_startup(self):
         """Startup server and restore data from previous shutdown."""
         # Get instance of a socket for the server
         self.server_socket = socket.socket()
+        if self.cluster is not None:
+            # Every worker listens on the port; the kernel spreads connections over them.
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         # Bind host address and port
         self.server_socket.bind((self.host, self.port))
-        # Set max amount of users to MAX_CONNECTIONS
-        self.server_socket.listen(MAX_CONNECTIONS)
-
-        # Restore data that needs to be set on server startup
-        # Reload the group pickle file.
-        if exists("groups.pkl"):
-            groups_pkl = open("groups.pkl", "rb")
-            self.groups = pickle.load(groups_pkl)
-            print(len(self.groups), " group(s) loaded")
-            groups_pkl.close()
-        else:
-            print("No groups loaded (missing groups.pkl)!")
-        # Reload the board pickle file.
-        if exists("boards.pkl"):
-            boards_pkl = open("boards.pkl", "rb")
-            self.boards = pickle.load(boards_pkl)
-            print(len(self.boards), " board(s) loaded")
-            boards_pkl.close()
-            print(self.boards)  
-        else:
-            print("No boards loaded (missing boards.pkl)!")
+        # Set the listen backlog
+        self.server_socket.listen(self.backlog)
+
+        self.server_load_data()
 
         # Listen for incoming connections
-        print("Listening for connections on %s:%s..." % (self.host, self.port))
-        self.server_socket.listen()
+        log.info("Listening for connections on %s:%s...", self.host, self.port)
         while True:
             # Send each client to open_connections
             client_socket, client_address = self.server_socket.accept()
+            with self.clients_lock:
+                server_full = self.max_sessions is not None and self.active_sessions >= self.max_sessions
+                if not server_full:
+                    self.active_sessions += 1
+            if server_full:
+                threading.Thread(target=self.reject_connection, args=(client_socket,), daemon=True).start()
+                continue
             threading.Thread(
                 target=self.open_connection,
                 args=(client_socket, client_address),
                 daemon=True,
             ).start()
 
-    def open_connection(self, client_socket, client_address):
-        """Open a socket connection to a given client. Active on separate thread from main server execution."""
-        # Receive the client username and group
-        client_info = client_socket.recv(1024).decode()
+    def server_startup_async(self):
+        """Startup server in asyncio mode: every client is served from one event loop."""
+        self.server_load_data()
+        asyncio.run(self.server_serve_async())
+        # The event loop stopped because Ctrl+C was pressed.
+        self.command_executor.shutdown()
+        self.server_shutdown(signal.SIGINT, None)
+
+    async def server_serve_async(self):
+        """Accept connections on the event loop until Ctrl+C is pressed."""
+        server = await asyncio.start_server(
+            self.open_connection_async, self.host, self.port, backlog=self.backlog
+        )
+        # Stop the loop cleanly on Ctrl+C instead of exiting from inside it.
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, stop.set)
+        self.command_executor = concurrent.futures.ThreadPoolExecutor(self.command_threads, "command")
+        log.info("Listening for connections on %s:%s (asyncio)...", self.host, self.port)
+        async with server:
+            await stop.wait()
+
+    def open_connection(self, client_socket, client_address, received=b""):
+        """Open a socket connection to a given client. Active on separate thread from main server execution.
+        received is data already read from the socket (by the worker that handed it over).
+        """
+        self.keep_alive(client_socket)
+        connection = Connection(client_socket, self.queue_size, self.overflow_policy, self.count_overflow, self.count_sent)
+        connection.start_writer()
+        self.watch_connection(connection)
+        try:
+            # Receive the client username and group, then handle client requests
+            while True:
+                data = received or client_socket.recv(RECV_BUFFER_SIZE)
+                received = b""
+                if not data:
+                    break
+                if not self.process_input(connection, data):
+                    break
+        except (OSError, protocol.ProtocolError):
+            pass
+        except Exception:
+            log.exception("Error serving client ID #%s.", connection.client_id)
+        finally:
+            self.close_connection(connection)
+            with self.clients_lock:
+                self.active_sessions -= 1
+
+    def reject_connection(self, client_socket):
+        """Turn a client away because the server is full. Runs on a thread of its own."""
+        try:
+            client_socket.settimeout(self.read_timeout or READ_TIMEOUT)
+            data = client_socket.recv(RECV_BUFFER_SIZE)
+            if data:
+                client_socket.sendall(self.server_full_reply(data))
+        except OSError:
+            pass
+        finally:
+            client_socket.close()
+
+    @staticmethod
+    def server_full_reply(handshake):
+        """Return the reply turning a client away, in the protocol its
+        handshake (the data it sent first) uses, so a framed client can read it.
+        """
+        if protocol.is_framed(handshake[0]):
+            return protocol.encode_frame(protocol.RESPONSE, protocol.HANDSHAKE_REQUEST_ID, SERVER_FULL)
+        return SERVER_FULL.encode()
+
+    async def open_connection_async(self, reader, writer):
+        """Open a stream connection to a given client. Runs as a task on the server's event loop."""
+        if self.max_sessions is not None and self.active_sessions >= self.max_sessions:
+            # Turn the client away once its handshake shows which protocol it speaks.
+            try:
+                data = await asyncio.wait_for(reader.read(RECV_BUFFER_SIZE), self.read_timeout or READ_TIMEOUT)
+                if data:
+                    writer.write(self.server_full_reply(data))
+            except (OSError, asyncio.TimeoutError):
+                pass
+            writer.close()
+            return
+        self.active_sessions += 1
+        self.keep_alive(writer.get_extra_info("socket"))
+        connection = AsyncConnection(
+            AsyncClientSocket(writer), self.queue_size, self.overflow_policy, self.count_overflow, self.count_sent
+        )
+        connection.start_writer()
+        self.watch_connection(connection)
+        loop = asyncio.get_running_loop()
+        try:
+            # Receive the client username and group, then handle client
+            # requests. The commands run on the command threads, one read's
+            # worth at a time, so a connection's commands still run in order.
+            while True:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    break
+                if not await loop.run_in_executor(self.command_executor, self.process_input, connection, data):
+                    break
+        except (OSError, protocol.ProtocolError, asyncio.CancelledError):
+            # CancelledError: the event loop is shutting down.
+            pass
+        except Exception:
+            log.exception("Error serving client ID #%s.", connection.client_id)
+        finally:
+            self.close_connection(connection)
+            self.active_sessions -= 1
+
+    def keep_alive(self, client_socket):
+        """Have the kernel probe a quiet connection with TCP keepalives, on
+        the heartbeat schedule: heartbeats only work with the framed
+        protocol, so this is what notices a plain text client that went
+        away without closing its connection (a machine that crashed or
+        dropped off the network). Its read then fails and the connection is
+        torn down like any other. Linux only.
+        """
+        if self.heartbeat_interval <= 0 or not hasattr(socket, "TCP_KEEPIDLE"):
+            return
+        probes = 3
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(self.heartbeat_interval)))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(self.read_timeout / probes)))
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+
+    def close_connection(self, connection):
+        """Tear down a connection whose read loop has ended, however it ended
+        (%exit, the client hanging up or breaking the protocol, a timeout or
+        an error): stop watching it, close it once anything queued has been
+        sent, and detach its session to be resumed or ended (see
+        detach_session), unless the session already ended or moved to
+        another connection. Shared by the threaded and the asyncio server modes.
+        """
+        self.timers.cancel(connection.timer)
+        connection.close()
+        if connection.client_id is not None:
+            self.detach_session(connection.client_id, connection)
+
+    def watch_connection(self, connection):
+        """Start watching a new connection for timeouts (see check_connection)."""
+        connection.timer = self.timers.schedule(self.read_timeout, self.check_connection, connection)
+
+    def check_connection(self, connection):
+        """Timer wheel callback watching a connection. Drops it if it didn't
+        complete its handshake or answer a heartbeat within read_timeout,
+        closes its session if it hasn't sent a command in idle_timeout, and
+        sends it a heartbeat if it hasn't sent anything in heartbeat_interval.
+        Then checks again when the next of these is due.
+        """
+        if connection.closed:
+            return
+        now = time.monotonic()
+        deadlines = []
+        if connection.client_id is None:
+            if now >= connection.opened + self.read_timeout:
+                self.drop_connection(connection, "handshake")
+                return
+            deadlines.append(connection.opened + self.read_timeout)
+        elif self.idle_timeout > 0:
+            if now >= connection.last_active + self.idle_timeout:
+                self.reap_session(connection)
+                return
+            deadlines.append(connection.last_active + self.idle_timeout)
+        if self.heartbeat_interval > 0 and connection.framed:
+            if connection.heartbeat_sent is not None and connection.heartbeat_sent >= connection.last_received:
+                # Waiting for the answer to a heartbeat.
+                if now >= connection.heartbeat_sent + self.read_timeout:
+                    self.drop_connection(connection, "heartbeat")
+                    return
+                deadlines.append(connection.heartbeat_sent + self.read_timeout)
+            elif now >= connection.last_received + self.heartbeat_interval:
+                connection.heartbeat()
+                deadlines.append(now + self.read_timeout)
+            else:
+                deadlines.append(connection.last_received + self.heartbeat_interval)
+        if deadlines:
+            connection.timer = self.timers.schedule(min(deadlines) - now, self.check_connection, connection)
+
+    def drop_connection(self, connection, reason):
+        """Drop a connection that timed out. Its reader then closes it as a
+        lost connection, so its session can still be resumed.
+        """
+        log.debug("Dropped a connection (client ID #%s): %s timeout.", connection.client_id, reason)
+        self.metrics.increment("connections_timed_out_total", labels=(("reason", reason),))
+        connection.abort()
+
+    def reap_session(self, connection):
+        """Close the session of a connection that hasn't sent a command in
+        idle_timeout seconds. Unlike a lost connection's, it can't be resumed.
+        """
+        client_id = connection.client_id
+        with self.clients_lock:
+            session = self.connected_clients.get(client_id)
+            if session is None or session["connection"] is not connection:
+                return
+            self.end_session(client_id)
+        log.debug("Closed the idle session of client ID #%d.", client_id)
+        self.metrics.increment("connections_timed_out_total", labels=(("reason", "idle"),))
+        connection.notify("You have been disconnected from the server after %g seconds without a command." % (self.idle_timeout))
+        connection.close()
+
+    def adopt_connection(self, handle, received):
+        """Serve a client connection handed over by another worker."""
+        with self.clients_lock:
+            self.active_sessions += 1
+        client_socket = socket.socket(fileno=handle)
+        threading.Thread(target=self.open_connection, args=(client_socket, None, received), daemon=True).start()
+
+    def count_overflow(self, outcome):
+        """Count an outbound queue overflow outcome (dropped, coalesced or disconnected)."""
+        with self.stats_lock:
+            self.overflow_counts[outcome] += 1
+        self.metrics.increment("overflows_total", labels=(("outcome", outcome),))
+
+    def count_sent(self, length):
+        self.metrics.increment("bytes_sent_total", length)
+
+    def process_input(self, connection, data):
+        """Run every command completed by data received on a connection.
+        The first command of a session is its handshake. Pipelined commands are
+        run in the order they were sent. Returns False when the connection
+        should stop reading further commands.
+        """
+        self.metrics.increment("bytes_received_total", len(data))
+        if self.cluster is not None and connection.client_id is None:
+            connection.received += data
+        for request_id, command in connection.feed(data):
+            connection.request_id = request_id
+            if connection.client_id is None and self.cluster is not None:
+                # Hand the connection to the owner of the group it's connecting with.
+                handshake = command.split(" ")
+                if len(handshake) > 1 and not self.owns(handshake[1]):
+                    connection.detach()
+                    self.cluster.hand_off(handshake[1], connection.client_socket, connection.received)
+                    return False
+            if not self.run_command(connection, command):
+                return False
+        return True
+
+    def run_command(self, connection, command):
+        """Run one command received on a connection (the handshake, if it's the
+        session's first) and record it in the command metrics. Returns False
+        when the connection should stop reading further commands.
+        """
+        if connection.client_id is None and len(command.split(" ")) < 2:
+            connection.reply('Error: Invalid handshake, expected "<name> <group>".')
+            return False
+        if not self.metrics.enabled:
+            if connection.client_id is None:
+                connection.client_id = self.register_client(command, connection)
+                return True
+            return self.handle_command(connection.client_id, command)
+        began = time.perf_counter()
+        if connection.client_id is None:
+            name = "handshake"
+            connection.client_id = self.register_client(command, connection)
+            keep_reading = True
+        else:
+            name = command.split(" ")[0]
+            if name not in COMMANDS:
+                name = "invalid"
+            keep_reading = self.handle_command(connection.client_id, command)
+        self.command_timers[name].observe(time.perf_counter() - began)
+        return keep_reading
+
+    def register_client(self, client_info, connection):
+        """Perform the connection handshake for a new client and return its client ID.
+        A handshake that ends with a session token resumes that session instead,
+        if it still can be.
+        """
         client_name = client_info.split(" ")[0]
         client_group = client_info.split(" ")[1]
-        client_id = self.client_ids
-        
-        
-        # Announce that a client has been connected.
-        print("A client with ID #%d has connected, waiting for queries." % (client_id))
+        if len(client_info.split(" ")) > 2:
+            client_id = self.resume_session(client_name, client_info.split(" ")[2], connection)
+            if client_id is not None:
+                return client_id
 
         # Manage client, group, and board data
-        self.add_clients_groups(client_id, client_name, client_group, client_socket)
+        client_id = self.add_clients_groups(client_name, client_group, connection)
+
+        # Announce that a client has been connected.
+        log.debug("A client with ID #%d has connected, waiting for queries.", client_id)
 
         # Broadcast to all clients that a new client has joined
         self.broadcast_client_join(client_id, client_name)
 
         # List up to 5 groups when a user connects
-        example_groups = list(self.groups)[0:5]
+        with self.groups_lock:
+            example_groups = list(self.groups)[0:5]
         if len(example_groups) > 0:
             example_groups_message = " Current server groups: " + ", ".join(example_groups)
             if len(example_groups) > 5:
                 example_groups_message += "..."
 
-        # Send client ID to client to confirm connection + exmaple groups
-        client_socket.send(("id " + str(client_id) + example_groups_message).encode())
+        # Send client ID to client to confirm connection + exmaple groups,
+        # along with the session's token if it can be resumed
+        token = self.connected_clients[client_id].get("token")
+        if token is not None:
+            example_groups_message = " token " + token + example_groups_message
+        connection.reply("id " + str(client_id) + example_groups_message)
+        return client_id
 
-        # Handle client requests
-        while True:
-            data = client_socket.recv(1024).decode()
-            if not data:
-                break
-            command = data.split(" ")[0]
-            params = data.split(" ")[1:]
-            match command:
-                case "help":
-                    help_msg = (
-                        "A %connect command followed by the address and port number of a running bulletin board server to connect to.\n"
-                        "A %join command to join the single message board.\n"
-                        "A %post command followed by the message subject and the message content or main body to post a message to the board.\n"
-                        "A %users command to retrieve a list of users in the same group.\n"
-                        "A %leave command to leave the group.\n"
-                        "A %message command followed by message ID to retrieve the content of the message.\n"
-                        "An %exit command to disconnect from the server and exit the client program.\n"
-                        "A %groups command to retrieve a list of all groups that can be joined.\n"
-                        "A %groupjoin command followed by the group id/name to join a specific group.\n"
-                        "A %grouppost command followed by the group id/name, the message subject, and the message content or main body to post a message to a message board owned by a specific group.\n"
-                        "A %groupusers command followed by the group id/name to retrieve a list of users in the given group.\n"
-                        "A %groupleave command followed by the group id/name to leave a specific group.\n"
-                        "A %groupmessage command followed by the group id/name and message ID to retrieve the content of the message posted earlier on a message board owned by a specific group."
-                    )
-                    client_socket.send(help_msg.encode())
-                case "join":
-                    self.handle_join(client_id, "default")
-                case "post":
-                    if len(params) < 2:
-                        client_socket.send("Error: Missing subject or message.".encode())
-                        break
-                    self.handle_post(client_id, "default", *params)
-                case "users":
+    def resume_session(self, client_name, token, connection):
+        """Move the session a token belongs to onto a new connection and
+        replay the notifications it missed. The session keeps its client ID
+        and memberships, and nobody is told it connected. Returns the client
+        ID, or None if the token isn't that of a session of client_name that
+        is still open, or the connection isn't framed.
+        """
+        if not connection.framed:
+            return None
+        with self.clients_lock:
+            client_id = self.session_tokens.get(token)
+            if client_id is None or self.connected_clients[client_id]["name"] != client_name:
+                return None
+            session = self.connected_clients[client_id]
+            previous = session["connection"]
+            session["connection"] = connection
+            self.detached_sessions.pop(client_id, None)
+            connection.reply("id %d token %s Session resumed." % (client_id, token))
+            if isinstance(previous, DetachedConnection):
+                previous.resume(connection)
+            else:
+                # The old connection is still open as far as we know (the
+                # client noticed it was broken first), so drop it.
+                previous.abort()
+        self.metrics.increment("sessions_resumed_total")
+        log.debug("A client with ID #%d has resumed its session.", client_id)
+        return client_id
+
+    def detach_session(self, client_id, connection):
+        """Keep the session of a client whose connection was lost, so it can
+        be resumed, or end it if sessions can't be resumed.
+        """
+        with self.clients_lock:
+            session = self.connected_clients.get(client_id)
+            if session is None or session["connection"] is not connection:
+                # Ended with %exit, or already resumed on another connection.
+                return
+            if self.resume_timeout <= 0 or "token" not in session:
+                # Nothing could resume it.
+                self.end_session(client_id)
+                return
+            session["connection"] = DetachedConnection(connection, self.resume_buffer)
+            self.detached_sessions[client_id] = time.monotonic() + self.resume_timeout
+        log.debug("A client with ID #%d has lost its connection.", client_id)
+
+    def end_session(self, client_id):
+        """Remove a session from the connected clients and the indexes.
+        Called with clients_lock held.
+        """
+        session = self.connected_clients.pop(client_id)
+        client_name = session["name"]
+        self.session_tokens.pop(session.get("token"), None)
+        self.detached_sessions.pop(client_id, None)
+        self.user_sessions[client_name].discard(client_id)
+        for group in self.user_groups[client_name]:
+            self.group_sessions[group].discard(client_id)
+        if not self.user_sessions[client_name]:
+            # The user's last session.
+            del self.user_sessions[client_name]
+            if self.cluster is not None:
+                self.cluster.announce_presence(client_name, False)
+
+    def handle_command(self, client_id, data):
+        """Run a single command sent by a client.
+        Returns False when the connection should stop reading further commands.
+        Shared by the threaded and the asyncio server modes.
+        """
+        connection = self.session(client_id)["connection"]
+        client_name = self.session(client_id)["name"]
+        command = data.split(" ")[0]
+        params = data.split(" ")[1:]
+        if command == "bulkpost":
+            # The posts follow on the lines after the command's own.
+            params = data.split("\n")[0].split(" ")[1:]
+            if not connection.framed:
+                # A plain text command is whatever a single read returned, so
+                # a long batch of posts would arrive in pieces.
+                connection.reply("Error: %bulkpost needs the framed protocol.")
+                return True
+        if self.cluster is not None:
+            # Commands about another worker's group run there.
+            if command in DEFAULT_GROUP_COMMANDS:
+                group = "default"
+            elif command in GROUP_COMMANDS and params:
+                group = params[0]
+            else:
+                group = None
+            if group is not None and not self.owns(group):
+                return self.cluster.forward_command(group, client_id, client_name, data)
+        if self.replica is not None and command in WRITE_COMMANDS:
+            return self.replica.forward_command(client_id, client_name, data)
+        match command:
+            case "help":
+                help_msg = (
+                    "A %connect command followed by the address and port number of a running bulletin board server to connect to.\n"
+                    "A %join command to join the single message board.\n"
+                    "A %post command followed by the message subject and the message content or main body to post a message to the board.\n"
+                    "A %users command to retrieve a list of users in the same group.\n"
+                    "A %leave command to leave the group.\n"
+                    "A %message command followed by message ID to retrieve the content of the message.\n"
+                    "An %exit command to disconnect from the server and exit the client program.\n"
+                    "A %groups command to retrieve a list of all groups that can be joined.\n"
+                    "A %groupjoin command followed by the group id/name to join a specific group.\n"
+                    "A %grouppost command followed by the group id/name, the message subject, and the message content or main body to post a message to a message board owned by a specific group.\n"
+                    "A %groupusers command followed by the group id/name to retrieve a list of users in the given group.\n"
+                    "A %groupleave command followed by the group id/name to leave a specific group.\n"
+                    "A %groupmessage command followed by the group id/name and message ID to retrieve the content of the message posted earlier on a message board owned by a specific group.\n"
+                    "A %messages command followed by the group id/name and the first and last message IDs to list the messages in that range (add --bodies to include their content).\n"
+                    "A %latest command followed by the group id/name and a number N to list the newest N messages (add --bodies to include their content).\n"
+                    "A %since command followed by the group id/name and the last message ID you have seen to list the messages posted after it (add --bodies to include their content).\n"
+                    "A %search command followed by the group id/name and one or more words to find the messages containing all of them, best match first.\n"
+                    "A %bulkpost command followed by the group id/name, then one message per line (its subject and its content), to post many messages at once."
+                )
+                if client_name in self.admins:
+                    help_msg += "\nA %stats command followed by the admin key to show server statistics (admins only)."
+                connection.reply(help_msg)
+            case "join":
+                self.handle_join(client_id, "default")
+            case "post":
+                if len(params) < 2:
+                    connection.reply("Error: Missing subject or message.")
+                    return False
+                self.handle_post(client_id, "default", *params)
+            case "users":
+                with self.group_locks["default"].read():
                     group_users = ", ".join(self.groups["default"])
-                    client_socket.send(("Users in 'default': " + group_users).encode())
-                case "leave":
-                    self.handle_leave(client_id, "default")
-                case "message":
-                    if len(params) < 1:
-                        client_socket.send("Error: Missing message ID.".encode())
-                        break
-                    self.handle_message(client_id, "default", *params)
-                case "exit":
-                    # Remove the current user from the server.
-                    client_socket.send("You have been disconnected from the server.".encode())
-                    print("A client with ID #%d has disconnected from the server." % (client_id))
-                    # Close the client socket
-                    self.connected_clients[client_id]["client_socket"].close()
-                    # Remove the entry the current client in the connected clients list
-                    self.connected_clients.pop(client_id)
-                    # Return 0. This kills the thread for the current client request.
-                    return 0
-                case "groups":
-                    response = "Available groups: "
-                    for group in self.groups.keys():
-                        response += group + ", "
-                    client_socket.send(response[:-2].encode())
-                case "groupjoin":
-                    if len(params) != 1:
-                        client_socket.send("Invalid %groupsjoin command. Please supply a group name to join.".encode())
-                        break
-                    else:
-                        self.handle_join(client_id, params[0])
-                case "grouppost":
-                    if len(params) < 3:
-                        client_socket.send("Error: Missing group, subject, or message.".encode())
-                        break
-                    self.handle_post(client_id, *params)
-                case "groupusers":
-                    if len(params) < 1 or params[0] not in self.groups:
-                        client_socket.send("Error: Invalid group name".encode())
-                        break
+                connection.reply("Users in 'default': " + group_users)
+            case "leave":
+                self.handle_leave(client_id, "default")
+            case "message":
+                if len(params) < 1:
+                    connection.reply("Error: Missing message ID.")
+                    return False
+                self.handle_message(client_id, "default", *params)
+            case "exit":
+                # Remove the current user from the server.
+                connection.reply("You have been disconnected from the server.")
+                log.debug("A client with ID #%d has disconnected from the server.", client_id)
+                # Close the client socket
+                connection.close()
+                # Remove the entry the current client in the connected clients list
+                with self.clients_lock:
+                    self.end_session(client_id)
+                # Return False. This ends the read loop for the current client.
+                return False
+            case "groups":
+                response = "Available groups: "
+                with self.groups_lock:
+                    groups = list(self.groups.keys())
+                for group in groups:
+                    response += group + ", "
+                connection.reply(response[:-2])
+            case "groupjoin":
+                if len(params) != 1:
+                    connection.reply("Invalid %groupsjoin command. Please supply a group name to join.")
+                    return False
+                else:
+                    self.handle_join(client_id, params[0])
+            case "grouppost":
+                if len(params) < 3:
+                    connection.reply("Error: Missing group, subject, or message.")
+                    return False
+                self.handle_post(client_id, *params)
+            case "groupusers":
+                if len(params) < 1 or params[0] not in self.groups:
+                    connection.reply("Error: Invalid group name")
+                    return False
+                with self.group_locks[params[0]].read():
                     # Ensure client is part of group
-                    if client_name not in self.groups[params[0]]:
-                        client_socket.send(f"Error: Client not member of group '{params[0]}'.".encode())
-                        break
+                    is_member = client_name in self.groups[params[0]]
                     group_users = ", ".join(self.groups[params[0]])
-                    client_socket.send((f"Users in '{params[0]}': " + group_users).encode())
-                case "groupleave":
-                    if len(params) < 1 or params[0] not in self.groups:
-                        client_socket.send("Error: Invalid group name.".encode())
-                        break
-                    self.handle_leave(client_id, params[0])
-                case "groupmessage":
-                    if len(params) < 2:
-                        client_socket.send("Error: Missing group ID or message ID.".encode())
-                        break
-                    self.handle_message(client_id, *params)
-                case _:
-                    client_socket.send("Invalid command.".encode())
-
-    def add_clients_groups(self, client_id, client_name, client_group, client_socket):
-        """Add the client to the list of users in a group.
+                if not is_member:
+                    connection.reply(f"Error: Client not member of group '{params[0]}'.")
+                    return False
+                connection.reply(f"Users in '{params[0]}': " + group_users)
+            case "groupleave":
+                if len(params) < 1 or params[0] not in self.groups:
+                    connection.reply("Error: Invalid group name.")
+                    return False
+                self.handle_leave(client_id, params[0])
+            case "groupmessage":
+                if len(params) < 2:
+                    connection.reply("Error: Missing group ID or message ID.")
+                    return False
+                self.handle_message(client_id, *params)
+            case "messages" | "latest" | "since":
+                self.handle_listing(client_id, command, params)
+            case "search":
+                self.handle_search(client_id, *params)
+            case "bulkpost":
+                if len(params) != 1:
+                    connection.reply("Error: Missing group.")
+                else:
+                    self.handle_bulkpost(client_id, params[0], data.split("\n")[1:])
+            case "stats":
+                key = params[0].encode() if len(params) == 1 else b""
+                if client_name not in self.admins or not self.admin_key or not secrets.compare_digest(key, self.admin_key):
+                    connection.reply("Error: %stats is only available to admins.")
+                else:
+                    connection.reply(self.stats_summary())
+            case _:
+                connection.reply("Invalid command.")
+
+        return True
+
+    def add_clients_groups(self, client_name, client_group, connection):
+        """Add the client to the list of users in a group and return its new client ID.
         All users are added to the group "default" unless a group name is specified.
         The list of users in a group is saved on shutdown and recalled on boot as
         a user should stay in a group unless they
@@ -219,155 +1416,805 @@ class Server:
             2. use the %groupleave command.
         Users can be in multiple groups.
         """
-        with self.lock:
+        with self.clients_lock:
             # Increment client_ids for the next client
-            self.client_ids += 1
+            client_id = self.client_ids
+            self.client_ids += self.client_id_step
 
             # Add client to the connected clients list
             self.connected_clients[client_id] = {
                 "name": client_name,
                 "group": client_group,
-                "client_socket": client_socket,
+                "connection": connection,
             }
+            if self.resume_timeout > 0 and connection.framed:
+                token = secrets.token_urlsafe(16)
+                self.connected_clients[client_id]["token"] = token
+                self.session_tokens[token] = client_id
+            arrivals = []
+            if self.cluster is not None and not self.user_sessions[client_name]:
+                arrivals = self.cluster.announce_presence(client_name, True)
+            self.user_sessions[client_name].add(client_id)
+            for group in self.user_groups[client_name]:
+                self.group_sessions[group].add(client_id)
+        # Every worker has to know the user is here before they're told
+        # they're connected, or they could miss notifications.
+        concurrent.futures.wait(arrivals)
+
+        # GROUPS
+        if self.replica is not None:
+            # Followers only change groups through the primary.
+            if client_name not in self.groups.get(client_group, ()):
+                self.replica.forward_join(client_group, client_name)
+        elif self.owns(client_group):
+            self.ensure_member(client_group, client_name)
+        else:
+            self.cluster.forward_join(client_group, client_name)
+        return client_id
 
-            # GROUPS
-            # If the user supplied a group on connect that doesn't exist, create the group.
-            if client_group not in self.groups.keys():
-                self.groups[client_group] = [client_name]
+    def ensure_member(self, group, client_name):
+        """Make a user a member of a group, creating the group if it doesn't exist."""
+        # If the user supplied a group on connect that doesn't exist, create the group.
+        if not self.create_group(group, client_name):
             # If user supplied group on connect that does exist, add them to the group.
-            elif client_name not in self.groups[client_group]:
-                self.groups[client_group].append(client_name)
-
-            # BOARDS
-            # Create a board for default if it doesn't exist yet
-            if "default" not in self.boards.keys():
-                self.boards["default"] = {}
-            # Add blank boards for all groups that don't have a board yet
-            for group in self.groups.keys():
-                if group not in self.boards.keys():
-                    self.boards[group] = {}
+            with self.group_locks[group].write():
+                if client_name not in self.groups[group]:
+                    self.add_member(group, client_name)
+
+    def session(self, client_id):
+        """Return the {"name", "connection"} of a client connected here, or of
+        a client of another worker whose forwarded command is running here.
+        """
+        session = self.connected_clients.get(client_id)
+        return session if session is not None else self.remote_sessions[client_id]
+
+    def create_group(self, group, client_name):
+        """Create a group whose first member is client_name, along with its board and lock.
+        Returns False (and changes nothing) if the group already exists.
+        """
+        with self.groups_lock:
+            if group in self.groups:
+                return False
+            self.new_group(group)
+            self.log_record(("create", group))
+            with self.group_locks[group].write():
+                self.add_member(group, client_name)
+            return True
+
+    def new_group(self, group):
+        """Set up an empty group and its lock. Called with groups_lock held."""
+        self.group_locks[group] = ReadWriteLock(self.metrics)
+        self.board_seqs[group] = 0
+        self.past_memberships[group] = {}
+        self.groups[group] = {}
+
+    def add_member(self, group, client_name):
+        """Add a user to a group and its sessions to the group's index.
+        Called with the group's write lock held.
+        """
+        self.groups[group][client_name] = self.board_seqs[group]
+        self.log_record(("join", group, client_name))
+        self.index_member(group, client_name)
+
+    def index_member(self, group, client_name):
+        """Add a new member's sessions to the group's index."""
+        with self.clients_lock:
+            self.user_groups[client_name].add(group)
+            self.group_sessions[group].update(self.user_sessions[client_name])
+            if self.cluster is not None:
+                self.cluster.member_changed(group, client_name, True)
+
+    def remove_member(self, group, client_name):
+        """Remove a user from a group and its sessions from the group's index.
+        Called with the group's write lock held.
+        """
+        join = self.groups[group].pop(client_name)
+        leave = self.board_seqs[group]
+        if join < leave:
+            # Only memberships that spanned at least one post matter.
+            self.past_memberships[group].setdefault(client_name, []).append((join, leave))
+        self.log_record(("leave", group, client_name))
+        self.unindex_member(group, client_name)
+
+    def unindex_member(self, group, client_name):
+        """Remove a former member's sessions from the group's index."""
+        with self.clients_lock:
+            self.user_groups[client_name].discard(group)
+            self.group_sessions[group].difference_update(self.user_sessions[client_name])
+            if self.cluster is not None:
+                self.cluster.member_changed(group, client_name, False)
+
+    def apply_replica(self, record):
+        """Apply a change another worker made to one of its groups (a
+        create, join or leave record, see storage.py) to the replica of its
+        membership here. Replicas aren't stored, and changes already applied
+        are ignored.
+        """
+        group = record[1]
+        if record[0] == "create":
+            with self.groups_lock:
+                if group not in self.groups:
+                    self.new_group(group)
+            return
+        with self.group_locks[group].write():
+            client_name = record[2]
+            if record[0] == "join" and client_name not in self.groups[group]:
+                self.groups[group][client_name] = 0
+                self.index_member(group, client_name)
+            elif record[0] == "leave" and client_name in self.groups[group]:
+                del self.groups[group][client_name]
+                self.unindex_member(group, client_name)
+
+    def apply_snapshot(self, groups):
+        """Follower: take every group's membership from a snapshot of the
+        primary's groups (in the save_groups format, see replication.py),
+        store it, then rebuild the indexes. The boards are caught up separately.
+        """
+        with self.groups_lock:
+            for group in groups:
+                if group not in self.groups:
+                    self.new_group(group)
+                    self.log_record(("create", group))
+            with self.locked_groups(groups):
+                for group, saved in groups.items():
+                    self.groups[group] = saved["members"]
+                    self.past_memberships[group] = saved["past_memberships"]
+                    # Stored too, or a later leave (or a restart) would find
+                    # members here that storage has never heard of.
+                    self.log_record(("members", group, saved["members"], saved["past_memberships"]))
+                with self.clients_lock:
+                    self.user_groups.clear()
+                    self.group_sessions.clear()
+                    for group, members in self.groups.items():
+                        for member in members:
+                            self.user_groups[member].add(group)
+                            self.group_sessions[group].update(self.user_sessions[member])
+
+    def apply_posts(self, group, posts):
+        """Follower: add posts from the primary's board, as (message ID, post),
+        that the copy here is missing.
+        """
+        with self.group_locks[group].write():
+            posts = [(message_id, post) for message_id, post in posts if message_id >= self.board_seqs[group]]
+            if posts:
+                self.store_posts(group, posts)
+
+    def apply_change(self, record):
+        """Follower: apply a change the primary made (a create, join, leave or
+        post record, see storage.py) to the copy here, which stores it too.
+        Changes already applied are ignored.
+        """
+        match record:
+            case ("create", group):
+                with self.groups_lock:
+                    if group not in self.groups:
+                        self.new_group(group)
+                        self.log_record(record)
+            case ("join", group, client_name):
+                with self.group_locks[group].write():
+                    if client_name not in self.groups[group]:
+                        self.add_member(group, client_name)
+            case ("leave", group, client_name):
+                with self.group_locks[group].write():
+                    if client_name in self.groups[group]:
+                        self.remove_member(group, client_name)
+            case ("post", group, message_id, post):
+                self.apply_posts(group, [(message_id, post)])
+
+    def notify_group(self, group, notification, exclude=(), reply_to=None):
+        """Notify every connected member of a group, except the client IDs in exclude.
+        The notification is a tuple (see coalescing.py). The client reply_to
+        (if any) gets it as its command reply.
+        Called with the group's lock held.
+        """
+        self.deliver_group(group, notification, exclude, reply_to)
+        if self.cluster is not None:
+            with self.clients_lock:
+                self.cluster.notify_group(group, ("notify_group", group, notification, tuple(exclude), reply_to))
+        if self.replication is not None:
+            self.replication.publish_notification(group, notification, exclude, reply_to)
+
+    def deliver_group(self, group, notification, exclude=(), reply_to=None):
+        """notify_group() for the members connected to this process."""
+        message = coalescing.describe(notification)
+        coalesced = []
+        with self.clients_lock:
+            sessions = self.group_sessions[group]
+            for cid in sessions:
+                if cid == reply_to:
+                    self.connected_clients[cid]["connection"].reply(message)
+                elif cid in exclude:
+                    continue
+                elif self.coalescer is None:
+                    self.connected_clients[cid]["connection"].notify(message)
+                else:
+                    coalesced.append(self.connected_clients[cid]["connection"])
+            if coalesced:
+                self.coalescer.notify(coalesced, notification)
+            fanout = len(sessions)
+        if self.metrics.enabled:
+            self.fanout_sizes.observe(fanout)
+
+    @contextlib.contextmanager
+    def locked_groups(self, groups, write=True):
+        """Lock several groups at once. The locks are always taken in sorted
+        group name order, so two multi-group operations can't deadlock.
+        """
+        with contextlib.ExitStack() as stack:
+            for group in sorted(groups):
+                lock = self.group_locks[group]
+                stack.enter_context(lock.write() if write else lock.read())
+            yield
 
     def broadcast_client_join(self, client_id, client_name):
         """Broadcast to all clients that a new client has joined."""
-        with self.lock:
-            encodedMessage = str(
-                "%s has joined the server (client ID #%d). "
-                % (client_name, client_id)
-            ).encode()
+        notification = ("connect", None, client_name, client_id)
+        self.deliver_all(notification, client_id)
+        if self.cluster is not None:
+            self.cluster.publish(("broadcast", notification, client_id))
+
+    def deliver_all(self, notification, client_id):
+        """Notify every client connected to this process except client_id."""
+        message = coalescing.describe(notification)
+        with self.clients_lock:
+            if self.coalescer is not None:
+                connections = [client["connection"] for cid, client in self.connected_clients.items() if cid != client_id]
+                self.coalescer.notify(connections, notification)
+                return
             for cid, client in self.connected_clients.items():
                 # Exclude the current connected client
                 if cid != client_id:
                     # Print to all other clients on their socket that *this* client has joined with its information
-                    client["client_socket"].send(encodedMessage)
+                    client["connection"].notify(message)
     
     def handle_join(self, client_id, group):
-        with self.lock:
-            client_name = self.connected_clients[client_id]["name"]
-            client_socket = self.connected_clients[client_id]["client_socket"]
-            if group not in self.groups.keys():
-                # Add new group and board.
-                self.groups[group] = [client_name]
-                self.boards[group] = {}
-                client_socket.send(f"Added to new group '{group}'.".encode())
-                return
+        client_name = self.session(client_id)["name"]
+        connection = self.session(client_id)["connection"]
+        if self.create_group(group, client_name):
+            # Added new group and board.
+            connection.reply(f"Added to new group '{group}'.")
+            return
+        with self.group_locks[group].write():
+            if client_name in self.groups[group]:
+                connection.reply(f"Already part of group '{group}'.")
             else:
-                if client_name in self.groups[group]:
-                    client_socket.send(f"Already part of group '{group}'.".encode())
-                else:
-                    self.groups[group].append(client_name)
-                    # Broadcast new message to all clients in the group
-                    for cid, info in self.connected_clients.items():
-                        if info["name"] is not client_name and info["name"] in self.groups[group]:
-                            info["client_socket"].send(f"New member {client_name} has joined group '{group}'.".encode())
-                    return_message = f"Added to group '{group}'.\nCurrent Members: " + ", ".join(self.groups[group])
-                    client_socket.send(return_message.encode())
+                # Broadcast new message to all clients in the group
+                self.notify_group(group, ("join", group, client_name))
+                self.add_member(group, client_name)
+                return_message = f"Added to group '{group}'.\nCurrent Members: " + ", ".join(self.groups[group])
+                connection.reply(return_message)
 
     def handle_post(self, client_id, group, subject, *message):
         """Post a message to a group's board with a given subject and message. Notifies all group members of post."""
-        with self.lock:
+        connection = self.session(client_id)["connection"]
+        if group not in self.groups:
+            connection.reply("Error: Invalid group name.")
+            return
+        with self.group_locks[group].write():
             # Ensure client is part of group
-            sender_name = self.connected_clients[client_id]["name"]
+            sender_name = self.session(client_id)["name"]
             if not sender_name in self.groups[group]:
-                self.connected_clients[client_id]["client_socket"].send("Error: Client not member of group.".encode())
+                connection.reply("Error: Client not member of group.")
                 return
-            
-            print( self.groups[group])
-            message_id = len(self.boards[group])
-            self.boards[group][message_id] = {
+            log.debug("Members of %s: %s", group, self.groups[group])
+            message_id = self.board_seqs[group]
+            post = {
                 "sender": sender_name,
                 "date": datetime.datetime.now().date(),
                 "subject": subject,
                 "message": " ".join(message),
-                "users_at_time_of_posting": copy.deepcopy(self.groups[group]),
             }
-            # Broadcast new message to all clients in the group
-            for cid, info in self.connected_clients.items():
-                if info["name"] in self.groups[group]:
-                    info["client_socket"].send(f"New message posted in {group} by {sender_name} with ID#{message_id}.".encode())
+            self.store_post(group, message_id, post)
+            # Broadcast new message to all clients in the group. The poster
+            # gets the announcement as the reply to their post command.
+            self.notify_group(group, ("post", group, message_id, sender_name), reply_to=client_id)
+
+    def handle_bulkpost(self, client_id, group, lines):
+        """Post a batch of messages to a group's board, one per line ("<subject>
+        <message>"). Membership is checked once, the posts are stored with a
+        single write and the members get one notification for the batch.
+        """
+        connection = self.session(client_id)["connection"]
+        if group not in self.groups:
+            connection.reply("Error: Invalid group name.")
+            return
+        lines = [line for line in lines if line]
+        if not lines:
+            connection.reply("Error: No messages to post.")
+            return
+        if len(lines) > BULKPOST_LIMIT:
+            connection.reply("Error: At most %d messages can be posted at once." % (BULKPOST_LIMIT))
+            return
+        sender_name = self.session(client_id)["name"]
+        date = datetime.datetime.now().date()
+        posts = []
+        for number, line in enumerate(lines):
+            subject, _, message = line.partition(" ")
+            if not message:
+                connection.reply("Error: Missing subject or message on line %d." % (number + 1))
+                return
+            posts.append({"sender": sender_name, "date": date, "subject": subject, "message": message})
+        with self.group_locks[group].write():
+            # Ensure client is part of group
+            if not sender_name in self.groups[group]:
+                connection.reply("Error: Client not member of group.")
+                return
+            first = self.board_seqs[group]
+            self.store_posts(group, list(enumerate(posts, first)))
+            if len(posts) == 1:
+                notification = ("post", group, first, sender_name)
+            else:
+                notification = ("posts", group, first, first + len(posts), sender_name)
+            self.notify_group(group, notification, reply_to=client_id)
+
+    def store_post(self, group, message_id, post):
+        """Add a post to a group's board. Called with the group's write lock held."""
+        self.log_record(("post", group, message_id, post))
+        self.board_seqs[group] = message_id + 1
+        index = self.search_indexes.get(group)
+        if index is not None:
+            index.add(message_id, post)
+
+    def store_posts(self, group, posts):
+        """Add posts, given as (message ID, post) in ID order, to a group's
+        board with a single write to storage. Called with the group's write
+        lock held.
+        """
+        records = [("post", group, message_id, post) for message_id, post in posts]
+        self.storage.write_many(records)
+        self.board_seqs[group] = posts[-1][0] + 1
+        if self.replication is not None:
+            self.replication.publish_records(records)
+        index = self.search_indexes.get(group)
+        if index is not None:
+            for message_id, post in posts:
+                index.add(message_id, post)
+
+    def search_index(self, group):
+        """Return a group's search index, building it if it doesn't exist yet.
+        The posts are indexed a page at a time under the group's read lock,
+        so posting carries on during a build; the posts made meanwhile are
+        added under the write lock before the index is handed to store_post.
+        """
+        index = self.search_indexes.get(group)
+        if index is not None:
+            return index
+        with self.search_locks[group]:
+            index = self.search_indexes.get(group)
+            if index is not None:
+                return index
+            index = search.GroupIndex()
+            indexed = 0
+            while self.board_seqs[group] - indexed > MESSAGES_PAGE_SIZE:
+                with self.group_locks[group].read():
+                    indexed = self.index_posts(index, group, indexed, indexed + MESSAGES_PAGE_SIZE)
+            with self.group_locks[group].write():
+                self.index_posts(index, group, indexed, self.board_seqs[group])
+                self.search_indexes[group] = index
+        return index
+
+    def index_groups(self):
+        """Build the search index of every group on startup, so no search has
+        to wait for a whole board to be indexed.
+        """
+        began = time.perf_counter()
+        with self.groups_lock:
+            groups = [group for group in self.groups if self.owns(group)]
+        for group in groups:
+            self.search_index(group)
+        log.info("Indexed %d group(s) for search in %.1fs.", len(groups), time.perf_counter() - began)
+
+    def index_posts(self, index, group, first, last):
+        """Add the posts with IDs first to last - 1 to a search index, a page at a time. Returns last."""
+        for page_first in range(first, last, MESSAGES_PAGE_SIZE):
+            for message_id, post in self.storage.read_posts(group, page_first, min(page_first + MESSAGES_PAGE_SIZE, last)):
+                index.add(message_id, post)
+        return last
+
+    def handle_search(self, client_id, group=None, *terms):
+        """Find the posts on a group's board containing every search term,
+        best match first, leaving out those the client may not view.
+        """
+        connection = self.session(client_id)["connection"]
+        if not terms:
+            connection.reply("Error: Missing group or search terms.")
+            return
+        if group not in self.groups:
+            connection.reply("Error: Invalid group name.")
+            return
+        sender_name = self.session(client_id)["name"]
+        with self.group_locks[group].read():
+            is_member = sender_name in self.groups[group]
+        if not is_member:
+            connection.reply("Error: Client not member of group.")
+            return
+        index = self.search_index(group)
+        with self.group_locks[group].read():
+            # Ensure client is still part of group
+            if not sender_name in self.groups[group]:
+                connection.reply("Error: Client not member of group.")
+                return
+            message_ids = index.search(
+                " ".join(terms), lambda message_id: self.can_view(group, sender_name, message_id), SEARCH_LIMIT
+            )
+        if message_ids:
+            connection.reply(f"Messages in '{group}' matching '{' '.join(terms)}', best first: " + ", ".join(map(str, message_ids)))
+        else:
+            connection.reply(f"No messages in '{group}' match '{' '.join(terms)}'.")
 
     def handle_message(self, client_id, group, message_id):
         """View a message from a group's board with a given message ID."""
-        client_socket = self.connected_clients[client_id]["client_socket"]
+        connection = self.session(client_id)["connection"]
+        if group not in self.groups:
+            connection.reply("Error: Invalid group name.")
+            return
+
+        with self.group_locks[group].read():
+            # Ensure client is part of group
+            sender_name = self.session(client_id)["name"]
+            if not sender_name in self.groups[group]:
+                connection.reply("Error: Client not member of group.")
+                return
+            
+            # Ensure message exists. IDs are checked against the board before
+            # they get anywhere near storage, which may not take any int
+            # (SQLite integers are 64 bits).
+            try:
+                message_id = int(message_id)
+            except ValueError:
+                connection.reply("Error: Message ID does not exist.")
+                return
+            if not 0 <= message_id < self.board_seqs[group]:
+                connection.reply("Error: Message ID does not exist.")
+                return
+            response = self.message_cache.get((group, message_id))
+            if response is None:
+                message = self.storage.read_post(group, message_id)
+                if message is None:
+                    connection.reply("Error: Message ID does not exist.")
+                    return
+                response = f"{message['sender']} on {message['date']} ({message['subject']}): {message['message']}".encode()
+                self.message_cache.put((group, message_id), response)
+            if self.can_view(group, sender_name, message_id):
+                connection.reply(response)
+            else:
+                connection.reply(f"Error: You are trying to access a message from too far in the past from when you joined the current group. (Limit: {HISTORY_LIMIT})")
 
-        # Ensure client is part of group
-        sender_name = self.connected_clients[client_id]["name"]
-        if not sender_name in self.groups[group]:
-            client_socket.send("Error: Client not member of group.".encode())
+    def handle_listing(self, client_id, command, params):
+        """Parse a %messages <group> <first ID> <last ID> [--bodies], a
+        %latest <group> <count> [--bodies] or a %since <group> <last seen ID>
+        [--bodies] command and list the posts asked for.
+        """
+        connection = self.session(client_id)["connection"]
+        bodies = "--bodies" in params
+        params = [param for param in params if param != "--bodies"]
+        if len(params) != (3 if command == "messages" else 2):
+            if command == "messages":
+                connection.reply("Error: Usage is %messages <group> <first ID> <last ID> [--bodies].")
+            elif command == "latest":
+                connection.reply("Error: Usage is %latest <group> <count> [--bodies].")
+            else:
+                connection.reply("Error: Usage is %since <group> <last seen ID> [--bodies].")
+            return
+        group = params[0]
+        if group not in self.groups:
+            connection.reply("Error: Invalid group name.")
             return
-        
-        # Ensure message exists
         try:
-            message = self.boards[group][int(message_id)]
-            if message is not None:
-                if sender_name not in self.boards[group][int(message_id)]['users_at_time_of_posting']:
-                    # Check if they're in the list of members two posts from now.
-                    if (sender_name in self.boards[group][int(message_id)+1]['users_at_time_of_posting'] or
-                        sender_name in self.boards[group][int(message_id)+2]['users_at_time_of_posting']):
-                        encodedMessage = f"{message['sender']} on {message['date']} ({message['subject']}): {message['message']}".encode()
-                        client_socket.send(encodedMessage)
-                    else:
-                        client_socket.send("Error: You are trying to access a message from too far in the past from when you joined the current group. (Limit: 2)".encode())
-                else:
-                    encodedMessage = f"{message['sender']} on {message['date']} ({message['subject']}): {message['message']}".encode()
-                    client_socket.send(encodedMessage)
-            else:
-                raise Exception
-        except:
-            client_socket.send("Error: Message ID does not exist.".encode())
+            numbers = [int(param) for param in params[1:]]
+        except ValueError:
+            connection.reply("Error: Message IDs and counts must be numbers.")
+            return
+        if command == "messages":
+            if numbers[1] < numbers[0]:
+                connection.reply("Error: The first message ID is after the last one.")
+                return
+            self.handle_messages(client_id, group, numbers[0], numbers[1] + 1, bodies)
+        elif command == "since":
+            self.handle_messages(client_id, group, numbers[0] + 1, None, bodies)
+        else:
+            count = min(max(numbers[0], 0), MESSAGES_LIMIT)
+            self.handle_messages(client_id, group, self.board_seqs[group] - count, None, bodies)
+
+    def handle_messages(self, client_id, group, first, last, bodies):
+        """List the posts with IDs first to last - 1 (or to the newest post, if
+        last is None) that the client may view, at most MESSAGES_LIMIT of them.
+        The listing is streamed a page of MESSAGES_PAGE_SIZE posts at a time,
+        and the group is only locked while a page is read, so a long listing
+        neither builds one huge reply nor holds up posters.
+        """
+        connection = self.session(client_id)["connection"]
+        sender_name = self.session(client_id)["name"]
+        first = max(first, 0)
+        cap = first + MESSAGES_LIMIT
+        last = cap if last is None else min(last, cap)
+        listed = 0
+        page_first = first
+        while True:
+            with self.group_locks[group].read():
+                # Ensure client is part of group
+                if not sender_name in self.groups[group]:
+                    connection.reply("Error: Client not member of group.")
+                    return
+                end = min(last, self.board_seqs[group])
+                page_last = min(page_first + MESSAGES_PAGE_SIZE, end)
+                lines = []
+                # Only IDs of posts that exist go to storage, which may not
+                # take any int.
+                posts = self.storage.read_posts(group, page_first, page_last, bodies) if page_first < end else []
+                for message_id, post in posts:
+                    if self.can_view(group, sender_name, message_id):
+                        line = f"#{message_id} {post['sender']} on {post['date']} ({post['subject']})"
+                        lines.append(line + f": {post['message']}" if bodies else line)
+            listed += len(lines)
+            page_first = page_last
+            if page_first >= end:
+                break
+            if lines:
+                connection.reply_part("\n".join(lines))
+        summary = f"{listed} message(s) listed from '{group}'."
+        if end == cap and cap < self.board_seqs[group]:
+            summary += f" More messages from ID#{end}."
+        connection.reply("\n".join(lines + [summary]))
+
+    def can_view(self, group, client_name, message_id):
+        """Check whether a current member of a group may read one of its posts.
+        Members can read every post made while they were in the group, plus
+        the HISTORY_LIMIT posts before each time they joined: that is, any post
+        m for which one of their memberships overlaps posts m..m+HISTORY_LIMIT.
+        Called with the group's lock held.
+        """
+        if self.groups[group][client_name] <= message_id + HISTORY_LIMIT:
+            return True
+        for join, leave in self.past_memberships[group].get(client_name, ()):
+            if join <= message_id + HISTORY_LIMIT and leave > message_id:
+                return True
+        return False
 
     def handle_leave(self, client_id, group):
         """Removes a user from a given group. Notifies all group members that user has left."""
-        with self.lock:
-            client_socket = self.connected_clients[client_id]["client_socket"]
-            
+        connection = self.session(client_id)["connection"]
+        with self.group_locks[group].write():
             # Ensure client is part of group
-            sender_name = self.connected_clients[client_id]["name"]
+            sender_name = self.session(client_id)["name"]
             if not sender_name in self.groups[group]:
-                client_socket.send(f"Error: Client not member of group '{group}'.".encode())
+                connection.reply(f"Error: Client not member of group '{group}'.")
                 return
             
             # Remove client from group
-            self.groups[group].remove(sender_name)
-            client_socket.send(f"You have left group '{group}'.".encode())
+            self.remove_member(group, sender_name)
+            connection.reply(f"You have left group '{group}'.")
 
             # Broadcast leave message to all clients in the group
-            for cid, info in self.connected_clients.items():
-                if info["name"] in self.groups[group]:
-                    info["client_socket"].send(f"User {sender_name} has left group '{group}'.".encode())
+            self.notify_group(group, ("leave", group, sender_name))
+
+    def stats_summary(self):
+        """Return the %stats report: a summary of the metrics recorded so far."""
+        if not self.metrics.enabled:
+            return "Metrics are disabled on this server (--no-metrics)."
+
+        def milliseconds(histogram, fraction):
+            value = histogram.quantile(fraction)
+            return "n/a" if value is None else "%gms" % (value * 1000)
+
+        with self.clients_lock:
+            connections = [(cid, info["name"], info["connection"]) for cid, info in self.connected_clients.items()]
+        lines = [
+            "Server statistics:",
+            "Clients: %d connected, %d sessions open. Groups: %d."
+            % (len(connections), self.active_sessions, len(self.groups)),
+            "Commands (count, p50, p99):",
+        ]
+        commands = [(labels, histogram) for labels, histogram in self.metrics.labelled("command_seconds").items() if histogram.count]
+        for labels, histogram in sorted(commands, key=lambda item: -item[1].count):
+            lines.append(
+                "  %s: %d, %s, %s"
+                % (dict(labels)["command"], histogram.count, milliseconds(histogram, 0.5), milliseconds(histogram, 0.99))
+            )
+        lines.append("Locks (wait p99, hold p99):")
+        waits = self.metrics.labelled("lock_wait_seconds")
+        holds = self.metrics.labelled("lock_hold_seconds")
+        for labels in sorted(waits):
+            lines.append(
+                "  %s: %s, %s"
+                % (" ".join(value for label, value in labels), milliseconds(waits[labels], 0.99), milliseconds(holds[labels], 0.99))
+            )
+        lines.append(
+            "Bytes: %d received, %d sent."
+            % (self.metrics.counter("bytes_received_total"), self.metrics.counter("bytes_sent_total"))
+        )
+        busiest = sorted(connections, key=lambda item: item[2].bytes_in + item[2].bytes_out, reverse=True)[:5]
+        for cid, name, connection in busiest:
+            lines.append("  #%d %s: %d in, %d out" % (cid, name, connection.bytes_in, connection.bytes_out))
+        fanout = self.fanout_sizes
+        if fanout.count:
+            lines.append(
+                "Notification fan-out: %d notifications, p50 %s, p99 %s sessions."
+                % (fanout.count, fanout.quantile(0.5), fanout.quantile(0.99))
+            )
+        lines.append(
+            "Overflows: %d dropped, %d coalesced, %d disconnected."
+            % tuple(self.overflow_counts[outcome] for outcome in ("dropped", "coalesced", "disconnected"))
+        )
+        lines.append(
+            "Message cache: %d hits, %d misses, %d evictions."
+            % (self.message_cache.hits, self.message_cache.misses, self.message_cache.evictions)
+        )
+        if self.replica is not None:
+            lines.append(
+                "Replication: following %s:%d, %d changes applied, %.3fs behind."
+                % (self.replica.address + (self.replica.applied, self.replica.lag))
+            )
+        if self.replication is not None:
+            lines.append("Replication: %d followers." % (len(self.replication.links)))
+        return "\n".join(lines)
+
+
+def retention_policy(text):
+    """argparse type for retention limits (see storage.RetentionPolicy.parse)."""
+    try:
+        return storage.RetentionPolicy.parse(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+
+
+def group_retention_policy(text):
+    """argparse type for a group's retention limits: (group, RetentionPolicy)."""
+    group, _, limits = text.rpartition(":")
+    return group, retention_policy(limits)
+
+
+def follow_address(text):
+    """argparse type for a primary's replication address: (host, port)."""
+    try:
+        return replication.parse_address(text)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
 
 
 def main():
-    host = input("Specify host IP (RETURN for localhost): ")
-    port = input("Enter port (>=1024, default 1024): ")
+    parser = argparse.ArgumentParser(description="Bulletin board server.")
+    parser.add_argument("--host", help="host IP to listen on (prompted if omitted)")
+    parser.add_argument("--port", type=int, help="port to listen on (prompted if omitted)")
+    parser.add_argument("--asyncio", action="store_true", help="serve all clients from a single asyncio event loop")
+    parser.add_argument("--command-threads", type=int, default=COMMAND_THREADS, help="threads running commands in asyncio mode")
+    parser.add_argument("--backlog", type=int, default=MAX_CONNECTIONS, help="listen backlog for pending connections")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS, help="maximum number of concurrent sessions")
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE, help="notifications that may wait in a client's outbound queue")
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY, help="what to do with notifications for a client whose queue is full")
+    parser.add_argument("--data-dir", default=".", help="directory holding the stored groups and boards")
+    parser.add_argument("--storage", choices=storage.STORAGE_ENGINES, default=storage.STORAGE_ENGINE, help="storage engine: boards in memory with a write-ahead log (pickle) or in an SQLite database (sqlite)")
+    parser.add_argument("--fsync", choices=storage.FSYNC_POLICIES, default=storage.FSYNC_POLICY, help="when log appends are fsynced: every append, group commit (batch) or on an interval")
+    parser.add_argument("--fsync-interval", type=float, default=storage.FSYNC_INTERVAL, help="seconds between fsyncs with --fsync interval")
+    parser.add_argument("--snapshot-records", type=int, default=SNAPSHOT_RECORDS, help="compact the log into a snapshot after this many records")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL, help="compact the log into a snapshot after this many seconds")
+    parser.add_argument("--retain", type=retention_policy, default=storage.RetentionPolicy(), metavar="LIMITS", help="posts each board keeps in memory before the oldest are archived, e.g. posts=10000,days=30,bytes=67108864")
+    parser.add_argument("--group-retain", type=group_retention_policy, action="append", default=[], metavar="GROUP:LIMITS", help="retention limits for one group, overriding --retain (may be repeated)")
+    parser.add_argument("--message-cache-entries", type=int, default=MESSAGE_CACHE_ENTRIES, help="encoded message responses to cache (0 to disable the cache)")
+    parser.add_argument("--message-cache-bytes", type=int, default=MESSAGE_CACHE_BYTES, help="total size of the cached message responses")
+    parser.add_argument("--coalesce-delay", type=float, default=COALESCE_DELAY, help="seconds notifications for a client are coalesced into a digest during a burst (0 to send each one)")
+    parser.add_argument("--coalesce-batch", type=int, default=COALESCE_BATCH, help="notifications after which a digest is sent without waiting")
+    parser.add_argument("--metrics-port", type=int, help="serve metrics in the Prometheus text format on this local port")
+    parser.add_argument("--no-metrics", action="store_true", help="don't record metrics")
+    parser.add_argument("--resume-timeout", type=float, default=RESUME_TIMEOUT, help="seconds a client that lost its connection has to resume its session (0 to end it right away)")
+    parser.add_argument("--resume-buffer", type=int, default=RESUME_BUFFER, help="notifications kept for a session waiting to be resumed")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL, help="seconds a framed session may be quiet before it's sent a heartbeat (0 for no heartbeats)")
+    parser.add_argument("--read-timeout", type=float, default=READ_TIMEOUT, help="seconds a connection has to complete its handshake or answer a heartbeat")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="seconds a session may go without a command before it's closed (0 to keep idle sessions)")
+    parser.add_argument("--admin", action="append", default=[], help="user name allowed to run %%stats (may be repeated); names aren't authenticated, so %%stats also needs the key in BULLETIN_ADMIN_KEY")
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO", help="lowest level of log messages to print")
+    parser.add_argument("--workers", type=int, default=1, help="server processes to run, with the groups split between them (see cluster.py)")
+    parser.add_argument("--worker-index", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--follow", type=follow_address, metavar="HOST:PORT", help="run as a read-only replica of the primary whose --replication-port this is (see replication.py)")
+    parser.add_argument("--replication-port", type=int, help="accept followers (see --follow) on this port")
+    args = parser.parse_args()
+    if args.workers > 1 and args.asyncio:
+        parser.error("--workers can't be combined with --asyncio")
+    if args.workers > 1 and args.metrics_port is not None:
+        parser.error("--metrics-port needs a single worker")
+    if args.follow is not None or args.replication_port is not None:
+        if args.workers > 1:
+            parser.error("--follow and --replication-port need a single worker")
+        if args.asyncio:
+            parser.error("--follow and --replication-port can't be combined with --asyncio")
+        if args.follow is not None and args.replication_port is not None:
+            parser.error("a follower can't have followers of its own")
+        if not os.environ.get("BULLETIN_REPLICATION_KEY"):
+            parser.error("--follow and --replication-port need the shared key in BULLETIN_REPLICATION_KEY")
+    if args.admin and not os.environ.get("BULLETIN_ADMIN_KEY"):
+        parser.error("--admin needs the admin key in BULLETIN_ADMIN_KEY")
+    if args.worker_index is None:
+        # Only checked once, by the parent of the workers.
+        try:
+            cluster.check_data_layout(args.data_dir, args.workers)
+        except ValueError as error:
+            parser.error(str(error))
+    log_format = "%(asctime)s %(levelname)s %(message)s"
+    if args.worker_index is not None:
+        log_format = "%(asctime)s worker-" + str(args.worker_index) + " %(levelname)s %(message)s"
+    logging.basicConfig(level=args.log_level, format=log_format)
+
+    host = args.host if args.host is not None else input("Specify host IP (RETURN for localhost): ")
+    port = str(args.port) if args.port is not None else input("Enter port (>=1024, default 1024): ")
+    host = host if host != "" else socket.gethostbyname(socket.gethostname())
+    port = int(port) if port != "" else 1024
+    if args.workers > 1 and args.worker_index is None:
+        return run_workers(host, port, args.workers)
     server = Server(
-        host if host != "" else socket.gethostbyname(socket.gethostname()),
-        int(port) if port != "" else 1024,
+        host,
+        port,
+        backlog=args.backlog,
+        max_sessions=args.max_sessions,
+        command_threads=args.command_threads,
+        queue_size=args.queue_size,
+        overflow_policy=args.overflow_policy,
+        data_dir=args.data_dir,
+        storage_engine=args.storage,
+        fsync_policy=args.fsync,
+        fsync_interval=args.fsync_interval,
+        snapshot_records=args.snapshot_records,
+        snapshot_interval=args.snapshot_interval,
+        retention=args.retain,
+        group_retention=dict(args.group_retain),
+        message_cache_entries=args.message_cache_entries,
+        message_cache_bytes=args.message_cache_bytes,
+        metrics_enabled=not args.no_metrics,
+        admins=args.admin,
+        admin_key=os.environ.get("BULLETIN_ADMIN_KEY", "").encode(),
+        coalesce_delay=args.coalesce_delay,
+        coalesce_batch=args.coalesce_batch,
+        resume_timeout=args.resume_timeout,
+        resume_buffer=args.resume_buffer,
+        heartbeat_interval=args.heartbeat_interval,
+        read_timeout=args.read_timeout,
+        idle_timeout=args.idle_timeout,
+        workers=args.workers,
+        worker_index=args.worker_index or 0,
+        cluster_key=os.environ.get("BULLETIN_CLUSTER_KEY", "").encode(),
+        follow=args.follow,
+        replication_port=args.replication_port,
+        replication_key=os.environ.get("BULLETIN_REPLICATION_KEY", "").encode(),
     )
+    if args.metrics_port is not None:
+        server.metrics.serve(args.metrics_port)
+        log.info("Serving metrics on http://127.0.0.1:%d/metrics", args.metrics_port)
     # Register the Ctrl+C signal handler
     signal.signal(signal.SIGINT, server.server_shutdown)
     # Start the server.
-    server.server_startup()
+    if args.asyncio:
+        server.server_startup_async()
+    else:
+        server.server_startup()
+
+    return 0
+
+
+def run_workers(host, port, workers):
+    """Run the server as several worker processes (see cluster.py) and wait
+    for them. Ctrl+C is passed on to every worker, which then shuts down as
+    a single server would.
+    """
+    # Only the workers may talk to each other.
+    environment = dict(os.environ, BULLETIN_CLUSTER_KEY=os.urandom(16).hex())
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)]
+            + sys.argv[1:]
+            + ["--host", host, "--port", str(port), "--worker-index", str(index)],
+            env=environment,
+            # Keep the terminal's Ctrl+C from reaching the workers directly.
+            start_new_session=True,
+        )
+        for index in range(workers)
+    ]
+
+    def stop(signum, frame):
+        for process in processes:
+            process.send_signal(signal.SIGINT)
 
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.wait()
     return 0
 
 
@@ -0,0 +1,1235 @@
+"""
+storage.py
+----------
+Durable storage for the bulletin board server.
+
+The server keeps group membership in memory and hands every change (new
+groups, joins, leaves and posts) to a storage engine, which also serves posts
+back by ID. There are two engines:
+
+    pickle  Every board is held in memory. Changes are appended to a
+            write-ahead log as they happen, and a snapshot of the whole state
+            is written every so often so the log can be thrown away. On
+            startup the latest snapshot is loaded and the log written since
+            is replayed on top of it.
+    sqlite  Boards live in an SQLite database and posts are read from it one
+            at a time, so startup time and memory don't grow with history.
+            An empty database imports whatever the pickle engine (or an older
+            version's groups.pkl and boards.pkl) left in the data directory.
+
+Logs are numbered by generation. Taking a snapshot starts a new log
+generation first, and the snapshot records the generation it was taken at:
+every log older than that is covered by the snapshot and can be deleted.
+
+The pickle engine keeps only each board's newest posts (its hot set) in
+memory, as set by the group's retention policy. Older posts are moved into
+compressed, read-only archive segments in the archive directory, and are
+still read back by ID through a small index of the segments.
+"""
+
+import abc
+import array
+import bisect
+import collections
+import datetime
+import itertools
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# When appends are made durable with fsync:
+#   always    every append is fsynced before it returns
+#   batch     group commit: concurrent appends wait for one shared fsync
+#   interval  a background thread fsyncs every fsync_interval seconds, so a
+#             crash can lose the last interval's worth of appends
+FSYNC_POLICIES = ("always", "batch", "interval")
+FSYNC_POLICY = "batch"
+FSYNC_INTERVAL = 0.05
+
+SNAPSHOT_FILE = "snapshot.pkl"
+LOG_PREFIX = "wal."
+DATABASE_FILE = "boards.db"
+SEGMENT_FILE = "bodies.seg"
+# A body segment rewritten by compaction is named after the log generation
+# of the snapshot that first refers to it.
+COMPACTED_SEGMENT_FILE = "bodies.%08d.seg"
+# The body segment is compacted once the bodies of archived posts take up
+# more of it than the bodies still on the boards, and at least this much.
+COMPACT_MIN_BYTES = 64 * 1024 * 1024
+ARCHIVE_DIRECTORY = "archive"
+# Posts are archived at least this many at a time, so segments aren't tiny:
+# a board's hot set can run over its retention policy by up to this much.
+ARCHIVE_BATCH = 256
+# Archived posts are compressed in blocks of this many, the unit read back.
+ARCHIVE_BLOCK_POSTS = 64
+# Archive segments kept open (with their block index loaded) at once.
+ARCHIVE_OPEN_SEGMENTS = 16
+
+# Every log record is stored as length | CRC-32 | pickled record.
+RECORD_HEADER = struct.Struct("!II")
+# An archive segment ends with the offset of its pickled block index.
+ARCHIVE_FOOTER = struct.Struct("!Q")
+
+
+def fsync_directory(path):
+    """Make a rename or a new file in a directory durable."""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """A single append-only log file."""
+
+    def __init__(self, path, fsync_policy=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL) -> None:
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.file = open(path, "ab")
+        self.lock = threading.Lock()
+        # Group commit bookkeeping: appends written so far, appends known to
+        # be on disk, and whether some appender is fsyncing right now.
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self.synced_changed = threading.Condition()
+        self.closed = False
+        if fsync_policy == "interval":
+            threading.Thread(target=self.sync_periodically, daemon=True).start()
+
+    def append(self, record):
+        """Append a record. Returns once it is as durable as the fsync policy promises."""
+        self.append_many([record])
+
+    def append_many(self, records):
+        """Append several records with a single write, and wait for them to
+        be durable together.
+        """
+        data = bytearray()
+        for record in records:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            data += RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            self.written += len(records)
+            position = self.written
+            if self.fsync_policy == "always":
+                os.fsync(self.file.fileno())
+                self.synced = position
+        if self.fsync_policy == "batch":
+            self.wait_for_sync(position)
+
+    def wait_for_sync(self, position):
+        """Group commit: wait until append number position is on disk. The
+        first appender to find no fsync running does one for everything
+        written so far, and the others just wait for it.
+        """
+        with self.synced_changed:
+            while self.synced < position:
+                if self.syncing:
+                    self.synced_changed.wait()
+                    continue
+                self.syncing = True
+                self.synced_changed.release()
+                try:
+                    with self.lock:
+                        target = self.written
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.synced_changed.acquire()
+                    self.syncing = False
+                self.synced = max(self.synced, target)
+                self.synced_changed.notify_all()
+
+    def sync_periodically(self):
+        """Interval policy: fsync in the background whenever something was written."""
+        while not self.closed:
+            time.sleep(self.fsync_interval)
+            with self.lock:
+                if self.closed or self.synced == self.written:
+                    continue
+                target = self.written
+                fd = self.file.fileno()
+            try:
+                os.fsync(fd)
+            except OSError:
+                # The log was closed (and so fsynced) in the meantime.
+                return
+            self.synced = target
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    @staticmethod
+    def read(path):
+        """Yield the records in a log file. A torn or corrupt record at the
+        end (from a crash in the middle of an append) ends the log.
+        """
+        with open(path, "rb") as log:
+            while True:
+                header = log.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                length, checksum = RECORD_HEADER.unpack(header)
+                payload = log.read(length)
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    return
+                yield pickle.loads(payload)
+
+
+class DurableStore:
+    """Snapshot plus write-ahead logs kept in a data directory."""
+
+    def __init__(self, data_dir, fsync_policy=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL) -> None:
+        self.data_dir = data_dir
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        os.makedirs(data_dir, exist_ok=True)
+        self.log = None
+        self.generation = 0
+        self.snapshot_generation = 0
+        # Appends since the last snapshot, used to decide when to compact.
+        self.records_since_snapshot = 0
+        self.snapshot_time = time.monotonic()
+
+    def log_path(self, generation):
+        return os.path.join(self.data_dir, "%s%08d" % (LOG_PREFIX, generation))
+
+    def log_generations(self):
+        """Return the generations of the logs in the data directory, oldest first."""
+        return sorted(
+            int(name[len(LOG_PREFIX) :])
+            for name in os.listdir(self.data_dir)
+            if name.startswith(LOG_PREFIX) and name[len(LOG_PREFIX) :].isdigit()
+        )
+
+    def recover(self):
+        """Return (snapshot state or None, list of log records written since).
+        Opens a fresh log generation for the appends that follow.
+        """
+        state, records = self.load()
+        generations = self.log_generations()
+        self.records_since_snapshot = len(records)
+        self.generation = max(generations + [self.snapshot_generation - 1]) + 1
+        self.log = WriteAheadLog(self.log_path(self.generation), self.fsync_policy, self.fsync_interval)
+        return state, records
+
+    def load(self):
+        """Read the snapshot and the logs written since without changing anything.
+        Returns (snapshot state or None, list of log records).
+        """
+        state = None
+        snapshot_generation = 0
+        snapshot_path = os.path.join(self.data_dir, SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, "rb") as snapshot:
+                saved = pickle.load(snapshot)
+            snapshot_generation = saved["log_generation"]
+            state = saved["state"]
+        records = []
+        for generation in self.log_generations():
+            if generation >= snapshot_generation:
+                records.extend(WriteAheadLog.read(self.log_path(generation)))
+        self.snapshot_generation = snapshot_generation
+        return state, records
+
+    def append(self, record):
+        self.log.append(record)
+        self.records_since_snapshot += 1
+
+    def append_many(self, records):
+        self.log.append_many(records)
+        self.records_since_snapshot += len(records)
+
+    def rotate(self):
+        """Start a new log generation and return it. The caller must make
+        sure no appends happen concurrently, and capture the state a snapshot
+        will be written for while they are held off.
+        """
+        self.log.close()
+        self.generation += 1
+        self.log = WriteAheadLog(self.log_path(self.generation), self.fsync_policy, self.fsync_interval)
+        self.records_since_snapshot = 0
+        self.snapshot_time = time.monotonic()
+        return self.generation
+
+    def write_snapshot(self, state, generation):
+        """Durably write a snapshot (pickled state bytes) taken at a log
+        generation returned by rotate(), then delete the logs it covers.
+        """
+        snapshot_path = os.path.join(self.data_dir, SNAPSHOT_FILE)
+        temporary_path = snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as snapshot:
+            pickle.dump({"log_generation": generation, "state": state}, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary_path, snapshot_path)
+        fsync_directory(self.data_dir)
+        for old_generation in self.log_generations():
+            if old_generation < generation:
+                os.remove(self.log_path(old_generation))
+
+    def snapshot_due(self, max_records, max_seconds):
+        """Return True if the log has grown enough that a snapshot should be taken."""
+        if self.records_since_snapshot == 0:
+            return False
+        return (
+            self.records_since_snapshot >= max_records
+            or time.monotonic() - self.snapshot_time >= max_seconds
+        )
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+def holds_data(data_dir):
+    """Return True if data_dir holds data of either engine, or the pickle
+    files of an older version.
+    """
+    if not os.path.isdir(data_dir):
+        return False
+    stored = (SNAPSHOT_FILE, DATABASE_FILE, SEGMENT_FILE, ARCHIVE_DIRECTORY, "groups.pkl", "boards.pkl")
+    return any(
+        name in stored or name.startswith(LOG_PREFIX) or is_segment_file(name) for name in os.listdir(data_dir)
+    )
+
+
+def is_segment_file(name):
+    """Return True if name is that of a body segment, compacted or not."""
+    return name == SEGMENT_FILE or (name.startswith("bodies.") and name.endswith(".seg"))
+
+
+def load_legacy_data(data_dir):
+    """Load groups.pkl and boards.pkl, as saved on shutdown by older versions,
+    and migrate them to the saved groups format (see Storage.recover).
+    """
+    groups = {"default": []}
+    boards = {"default": {}}
+    groups_path = os.path.join(data_dir, "groups.pkl")
+    if os.path.exists(groups_path):
+        with open(groups_path, "rb") as groups_pkl:
+            groups = pickle.load(groups_pkl)
+    boards_path = os.path.join(data_dir, "boards.pkl")
+    if os.path.exists(boards_path):
+        with open(boards_path, "rb") as boards_pkl:
+            boards = pickle.load(boards_pkl)
+    for group, saved in groups.items():
+        board = boards.setdefault(group, {})
+        if not isinstance(saved, dict):
+            groups[group] = migrate_group(saved, board)
+    return groups, boards
+
+
+def migrate_group(member_names, board):
+    """Work out membership sequence numbers from the member lists stored
+    with every post by older versions, then drop those lists.
+    A user was a member when post k was made if their name is in post k's
+    list, so each unbroken run of posts listing them is one membership.
+    """
+    message_ids = sorted(board)
+    next_message_id = message_ids[-1] + 1 if message_ids else 0
+    joins = {}
+    past = {}
+    previous = set()
+    for message_id in message_ids:
+        present = set(board[message_id].pop("users_at_time_of_posting", []))
+        for name in present - previous:
+            joins[name] = message_id
+        for name in previous - present:
+            past.setdefault(name, []).append((joins.pop(name), message_id))
+        previous = present
+    members = {}
+    for name in member_names:
+        # Members not listed with the latest post joined after it.
+        members[name] = joins.pop(name, next_message_id)
+    for name, join in joins.items():
+        # Listed with the latest post, but left since.
+        past.setdefault(name, []).append((join, next_message_id))
+    return {"members": members, "past_memberships": past, "next_message_id": next_message_id}
+
+
+def apply_record(groups, record):
+    """Apply a logged change to saved groups, the way the server applied it:
+    a member's join sequence number is the ID the group's next post had when
+    they joined.
+    """
+    match record:
+        case ("create", group):
+            groups[group] = {"members": {}, "past_memberships": {}, "next_message_id": 0}
+        case ("join", group, name):
+            saved = groups[group]
+            saved["members"][name] = saved["next_message_id"]
+        case ("leave", group, name):
+            saved = groups[group]
+            join = saved["members"].pop(name, None)
+            leave = saved["next_message_id"]
+            if join is not None and join < leave:
+                saved["past_memberships"].setdefault(name, []).append((join, leave))
+        case ("members", group, members, past_memberships):
+            saved = groups[group]
+            saved["members"] = dict(members)
+            saved["past_memberships"] = {name: list(spans) for name, spans in past_memberships.items()}
+        case ("post", group, message_id, post):
+            groups[group]["next_message_id"] = message_id + 1
+
+
+class Storage(abc.ABC):
+    """Interface between the server and a storage engine.
+
+    The server holds group membership itself and calls write() with every
+    change while holding the lock that guards it, so an engine sees changes
+    in the order they were made. Posts are only kept by the engine.
+    """
+
+    @abc.abstractmethod
+    def recover(self):
+        """Load the stored state and get ready for writes. Returns the saved
+        groups: group -> {"members", "past_memberships", "next_message_id"}.
+        """
+
+    @abc.abstractmethod
+    def write(self, record):
+        """Durably store a change: ("create", group), ("join", group, name),
+        ("leave", group, name), ("post", group, message_id, post) or
+        ("members", group, members, past_memberships), which replaces a
+        group's whole membership (a follower taking the primary's snapshot).
+        """
+
+    def write_many(self, records):
+        """Durably store several changes at once, in order."""
+        for record in records:
+            self.write(record)
+
+    def prepare_archive(self, group, policy):
+        """Write the posts of a group that its RetentionPolicy no longer keeps
+        in memory to an archive segment, without any locks held. Returns
+        whatever commit_archive() needs, or None if nothing is due.
+        """
+        return None
+
+    def commit_archive(self, archive):
+        """Drop the posts written by prepare_archive() from memory, serving
+        them from the archive from now on. Called with the group's lock held.
+        """
+
+    @abc.abstractmethod
+    def read_post(self, group, message_id):
+        """Return a post, or None if the group has no post with that ID."""
+
+    def read_posts(self, group, first, last, bodies=True):
+        """Return [(message ID, post)] for the posts with IDs first to last - 1.
+        Without bodies, the posts have no "message".
+        """
+        posts = []
+        for message_id in range(first, last):
+            post = self.read_post(group, message_id)
+            if post is not None:
+                if not bodies:
+                    del post["message"]
+                posts.append((message_id, post))
+        return posts
+
+    def snapshot_due(self, max_records, max_seconds):
+        """Return True if the engine wants a snapshot taken."""
+        return False
+
+    def compaction_due(self):
+        """Return True if the engine wants its next snapshot to compact."""
+        return False
+
+    def begin_snapshot(self, groups, compact=False):
+        """Capture the state for a snapshot. Called with every group locked,
+        with the saved groups; returns whatever finish_snapshot() needs.
+        With compact, the groups are write-locked and the engine may move
+        posts around.
+        """
+        return None
+
+    def finish_snapshot(self, snapshot):
+        """Write a snapshot captured by begin_snapshot(), without any locks held."""
+
+    def close(self):
+        pass
+
+
+class Segment:
+    """Append-only file of message bodies, read back through mmap so that
+    bodies stay in the page cache instead of on the Python heap.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = open(path, "a+b")
+        self.length = os.path.getsize(path)
+        self.mapping = None
+        self.lock = threading.Lock()
+
+    def truncate(self, length):
+        """Drop everything after length bytes (appends not covered by a snapshot)."""
+        with self.lock:
+            self.file.truncate(length)
+            self.length = length
+            self.mapping = None
+
+    def append(self, data):
+        """Append a body and return its offset. Appends to a board are
+        serialized by the group's lock, but boards share the segment.
+        """
+        with self.lock:
+            offset = self.length
+            self.file.write(data)
+            self.file.flush()
+            self.length += len(data)
+        return offset
+
+    def append_many(self, bodies):
+        """Append several bodies with a single write and return their offsets."""
+        offsets = []
+        with self.lock:
+            offset = self.length
+            for body in bodies:
+                offsets.append(offset)
+                offset += len(body)
+            self.file.write(b"".join(bodies))
+            self.file.flush()
+            self.length = offset
+        return offsets
+
+    def read(self, offset, length):
+        if length == 0:
+            # An empty segment can't be mapped.
+            return b""
+        mapping = self.mapping
+        if mapping is None or offset + length > len(mapping):
+            # The body was appended after the segment was last mapped. Older
+            # mappings are left for readers still using them to drop.
+            with self.lock:
+                if self.mapping is None or offset + length > len(self.mapping):
+                    self.mapping = mmap.mmap(self.file.fileno(), self.length, access=mmap.ACCESS_READ)
+                mapping = self.mapping
+        return mapping[offset : offset + length]
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self.mapping = None
+            self.file.close()
+
+
+class Board:
+    """A group's posts, stored column-wise and indexed by message ID.
+    Senders are interned, dates kept as ordinals and bodies left in the body
+    segment, so a post costs a few machine words plus its subject.
+    The columns start at message ID first: older posts have been archived.
+    """
+
+    def __init__(self) -> None:
+        self.first = 0
+        self.senders = []
+        self.dates = array.array("l")
+        self.subjects = []
+        self.offsets = array.array("q")
+        # Length of each body in the segment, or -1 for IDs without a post.
+        self.lengths = array.array("q")
+        # Total length of the bodies on the board.
+        self.body_bytes = 0
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.senders = [sys.intern(sender) if sender is not None else None for sender in self.senders]
+
+    def __len__(self):
+        return len(self.senders)
+
+    @property
+    def end(self):
+        """The ID after the newest post on the board."""
+        return self.first + len(self.senders)
+
+    def add(self, message_id, sender, date, subject, offset, length):
+        while self.end < message_id:
+            # Older versions could leave gaps in the message IDs.
+            self.add(self.end, None, datetime.date.min, None, 0, -1)
+        row = (sys.intern(sender) if sender is not None else None, date.toordinal(), subject, offset, length)
+        columns = (self.senders, self.dates, self.subjects, self.offsets, self.lengths)
+        appending = message_id == self.end
+        index = message_id - self.first
+        if not appending:
+            self.body_bytes -= max(self.lengths[index], 0)
+        self.body_bytes += max(length, 0)
+        for column, value in zip(columns, row):
+            if appending:
+                column.append(value)
+            else:
+                column[index] = value
+
+    def get(self, message_id):
+        """Return (sender, date, subject, body offset, body length), or None."""
+        index = message_id - self.first
+        if not 0 <= index < len(self.senders) or self.lengths[index] < 0:
+            return None
+        return (
+            self.senders[index],
+            datetime.date.fromordinal(self.dates[index]),
+            self.subjects[index],
+            self.offsets[index],
+            self.lengths[index],
+        )
+
+    def trim(self, message_id):
+        """Drop the posts before message_id (once they've been archived)."""
+        count = min(message_id, self.end) - self.first
+        if count <= 0:
+            return
+        self.body_bytes -= sum(length for length in self.lengths[:count] if length > 0)
+        for column in (self.senders, self.dates, self.subjects, self.offsets, self.lengths):
+            del column[:count]
+        self.first += count
+
+    def archive_cut(self, policy, today):
+        """Return the ID of the oldest post the policy keeps in memory."""
+        cut = self.first
+        if policy.max_posts is not None:
+            cut = max(cut, self.end - policy.max_posts)
+        if policy.max_days is not None:
+            oldest = today.toordinal() - policy.max_days
+            while cut < self.end and self.dates[cut - self.first] < oldest:
+                cut += 1
+        if policy.max_bytes is not None:
+            excess = self.body_bytes - policy.max_bytes
+            # Bodies of the posts already cut off count towards the excess.
+            excess -= sum(length for length in self.lengths[: cut - self.first] if length > 0)
+            while excess > 0 and cut < self.end:
+                excess -= max(self.lengths[cut - self.first], 0)
+                cut += 1
+        return cut
+
+
+class RetentionPolicy:
+    """How much of a board the pickle engine keeps in memory: at most
+    max_posts posts, no posts older than max_days days and at most max_bytes
+    bytes of message bodies. None means no limit.
+    """
+
+    def __init__(self, max_posts=None, max_days=None, max_bytes=None) -> None:
+        self.max_posts = max_posts
+        self.max_days = max_days
+        self.max_bytes = max_bytes
+
+    @property
+    def limited(self):
+        return (self.max_posts, self.max_days, self.max_bytes) != (None, None, None)
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a policy such as "posts=1000,days=30,bytes=1048576"."""
+        limits = {}
+        for item in text.split(","):
+            name, _, value = item.partition("=")
+            if name not in ("posts", "days", "bytes") or not value.isdigit():
+                raise ValueError("invalid retention limit '%s'" % (item))
+            limits["max_" + name] = int(value)
+        return cls(**limits)
+
+
+class ArchiveSegment:
+    """A read-only file of archived posts of one group, with IDs first to
+    last - 1. Posts are pickled and compressed in blocks of
+    ARCHIVE_BLOCK_POSTS, and the file ends with an index of the blocks.
+    """
+
+    def __init__(self, path) -> None:
+        self.file = open(path, "rb")
+        self.file.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+        (index_offset,) = ARCHIVE_FOOTER.unpack(self.file.read(ARCHIVE_FOOTER.size))
+        self.file.seek(index_offset)
+        # [(first message ID in the block, offset, length)]
+        self.blocks = pickle.loads(self.file.read())[1]
+        self.block_ids = [block[0] for block in self.blocks]
+        # The block read last, as (block number, posts), for listings.
+        self.last_block = (None, None)
+
+    @staticmethod
+    def write(path, group, rows):
+        """Durably write a segment of rows: (message ID, sender, date
+        ordinal, subject, body), in ID order.
+        """
+        blocks = []
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as segment:
+            for start in range(0, len(rows), ARCHIVE_BLOCK_POSTS):
+                block = rows[start : start + ARCHIVE_BLOCK_POSTS]
+                data = zlib.compress(pickle.dumps(block, protocol=pickle.HIGHEST_PROTOCOL))
+                blocks.append((block[0][0], segment.tell(), len(data)))
+                segment.write(data)
+            index_offset = segment.tell()
+            segment.write(pickle.dumps((group, blocks), protocol=pickle.HIGHEST_PROTOCOL))
+            segment.write(ARCHIVE_FOOTER.pack(index_offset))
+            segment.flush()
+            os.fsync(segment.fileno())
+        os.replace(temporary_path, path)
+        fsync_directory(os.path.dirname(path))
+
+    def read_block(self, number):
+        cached_number, posts = self.last_block
+        if cached_number != number:
+            first, offset, length = self.blocks[number]
+            posts = pickle.loads(zlib.decompress(os.pread(self.file.fileno(), length, offset)))
+            self.last_block = (number, posts)
+        return posts
+
+    def read_posts(self, first, last, bodies):
+        """Return [(message ID, post)] for the archived posts with IDs first to last - 1."""
+        posts = []
+        if not self.blocks:
+            return posts
+        number = max(bisect.bisect_right(self.block_ids, first) - 1, 0)
+        while number < len(self.blocks) and self.block_ids[number] < last:
+            for message_id, sender, date, subject, body in self.read_block(number):
+                if first <= message_id < last:
+                    post = {"sender": sender, "date": datetime.date.fromordinal(date), "subject": subject}
+                    if bodies:
+                        post["message"] = body
+                    posts.append((message_id, post))
+            number += 1
+        return posts
+
+    def close(self):
+        self.file.close()
+
+
+class PickleReader:
+    """Reads what the pickle engine (or an older version's groups.pkl and
+    boards.pkl) left in a data directory, without changing anything there,
+    for another engine to import.
+    """
+
+    def __init__(self, data_dir) -> None:
+        self.data_dir = data_dir
+        state, records = DurableStore(data_dir).load()
+        if state is not None:
+            state = pickle.loads(state)
+            self.groups, self.boards = state["groups"], state["boards"]
+            self.segment_file = state.get("segment_file", SEGMENT_FILE)
+            self.segment_length = state.get("segment_length", 0)
+            self.archives = state.get("archives", {})
+        else:
+            self.groups, self.boards = load_legacy_data(data_dir)
+            self.segment_file = SEGMENT_FILE
+            self.segment_length = 0
+            self.archives = {}
+        # Posts logged since, as group -> {message ID: post}. Archiving only
+        # moves posts the snapshot or the log already has.
+        self.logged = {}
+        for record in records:
+            apply_record(self.groups, record)
+            if record[0] == "post":
+                self.logged.setdefault(record[1], {})[record[2]] = record[3]
+
+    def posts(self, group):
+        """Return [(message ID, post)] for every post on a group's board, oldest first."""
+        posts = {}
+        for first, last, name in self.archives.get(group, []):
+            segment = ArchiveSegment(os.path.join(self.data_dir, ARCHIVE_DIRECTORY, name))
+            posts.update(segment.read_posts(first, last, True))
+            segment.close()
+        board = self.boards.get(group)
+        if isinstance(board, Board):
+            rows = [(message_id, board.get(message_id)) for message_id in range(board.first, board.end)]
+            rows = [(message_id, row) for message_id, row in rows if row is not None and row[3] + row[4] <= self.segment_length]
+            if rows:
+                with open(os.path.join(self.data_dir, self.segment_file), "rb") as segment:
+                    for message_id, (sender, date, subject, offset, length) in rows:
+                        body = os.pread(segment.fileno(), length, offset).decode()
+                        posts[message_id] = {"sender": sender, "date": date, "subject": subject, "message": body}
+        elif board is not None:
+            # A board of post dicts, from older versions.
+            posts.update(board)
+        posts.update(self.logged.get(group, {}))
+        return sorted(posts.items())
+
+
+class PickleStorage(Storage):
+    """Every board in memory, made durable with a write-ahead log and snapshots.
+    Message bodies are kept in the body segment rather than in the boards;
+    a snapshot records which segment it uses and how long it was, and
+    recovery cuts it back to that length before the log (which holds whole
+    posts) is replayed.
+
+    Archiving a board's oldest posts writes them to a new archive segment
+    first, then logs an ("archive", group, first, last, name) record and
+    drops them from the board. A segment the log never mentions (from a
+    crash in between) is deleted on recovery. The bodies of archived posts
+    stay in the body segment until a snapshot compacts it: the bodies still
+    on the boards are copied to a new segment, which replaces the old one
+    once the snapshot is on disk.
+    """
+
+    def __init__(self, data_dir, fsync_policy=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL) -> None:
+        self.data_dir = data_dir
+        self.store = DurableStore(data_dir, fsync_policy, fsync_interval)
+        self.segment_file = SEGMENT_FILE
+        self.segment = Segment(os.path.join(data_dir, SEGMENT_FILE))
+        # The segment compaction replaced, deleted once a snapshot is written.
+        self.retired_segment = None
+        self.boards = {"default": Board()}
+        # Archive segments of each group, oldest first, as [(first ID, last
+        # ID + 1, file name)], and the ones open now (file name -> ArchiveSegment,
+        # least recently used first).
+        self.archives = {}
+        self.open_archives = collections.OrderedDict()
+        self.archive_lock = threading.Lock()
+        self.archive_numbers = None
+
+    def restore(self, state, records):
+        """Rebuild the boards from a snapshot state (or the legacy pickle
+        files) and the log records written since. Returns the saved groups.
+        """
+        if state is not None:
+            state = pickle.loads(state)
+            groups, boards = state["groups"], state["boards"]
+            self.open_segment(state.get("segment_file", SEGMENT_FILE))
+            self.segment.truncate(state.get("segment_length", 0))
+            self.archives = state.get("archives", {})
+        else:
+            groups, boards = load_legacy_data(self.data_dir)
+            self.segment.truncate(0)
+            self.archives = {}
+        self.boards = {}
+        for group, board in boards.items():
+            if isinstance(board, Board):
+                self.boards[sys.intern(group)] = board
+            else:
+                # A board of post dicts, from older versions.
+                self.apply(("create", group))
+                for message_id, post in sorted(board.items()):
+                    self.apply(("post", group, message_id, post))
+        for record in records:
+            apply_record(groups, record)
+            self.apply(record)
+        return groups
+
+    def recover(self):
+        # Also opens a fresh log for the writes that follow.
+        groups = self.restore(*self.store.recover())
+        # Delete the segments left by archiving that never got logged.
+        directory = os.path.join(self.data_dir, ARCHIVE_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        archived = {name for segments in self.archives.values() for first, last, name in segments}
+        for name in os.listdir(directory):
+            if name not in archived:
+                os.remove(os.path.join(directory, name))
+        self.archive_numbers = itertools.count(max((int(name.split(".")[0]) for name in archived), default=0) + 1)
+        # And the body segments the snapshot no longer uses.
+        for name in os.listdir(self.data_dir):
+            if is_segment_file(name) and name != self.segment_file:
+                os.remove(os.path.join(self.data_dir, name))
+        return groups
+
+    def open_segment(self, name):
+        """Switch to the body segment with that file name."""
+        if name != self.segment_file:
+            self.segment.close()
+            self.segment = Segment(os.path.join(self.data_dir, name))
+            self.segment_file = name
+
+    def apply(self, record):
+        match record:
+            case ("create", group):
+                self.boards.setdefault(sys.intern(group), Board())
+            case ("post", group, message_id, post):
+                body = post["message"].encode()
+                offset = self.segment.append(body)
+                self.boards[group].add(message_id, post["sender"], post["date"], post["subject"], offset, len(body))
+            case ("archive", group, first, last, name):
+                self.boards[group].trim(last)
+                self.archives.setdefault(group, []).append((first, last, name))
+
+    def write(self, record):
+        self.apply(record)
+        self.store.append(record)
+
+    def write_many(self, records):
+        # The bodies of the posts go to the segment with a single write too.
+        bodies = [record[3]["message"].encode() for record in records if record[0] == "post"]
+        offsets = iter(zip(self.segment.append_many(bodies), bodies))
+        for record in records:
+            if record[0] == "post":
+                group, message_id, post = record[1:]
+                offset, body = next(offsets)
+                self.boards[group].add(message_id, post["sender"], post["date"], post["subject"], offset, len(body))
+            else:
+                self.apply(record)
+        self.store.append_many(records)
+
+    def read_post(self, group, message_id):
+        board = self.boards[group]
+        if message_id < board.first:
+            posts = self.read_archived(group, message_id, message_id + 1, True)
+            return posts[0][1] if posts else None
+        row = board.get(message_id)
+        if row is None:
+            return None
+        return self.post_from_row(row, True)
+
+    def read_posts(self, group, first, last, bodies=True):
+        board = self.boards[group]
+        first, last = max(first, 0), min(last, board.end)
+        posts = []
+        if first < board.first:
+            posts.extend(self.read_archived(group, first, min(last, board.first), bodies))
+        for message_id in range(max(first, board.first), last):
+            row = board.get(message_id)
+            if row is not None:
+                posts.append((message_id, self.post_from_row(row, bodies)))
+        return posts
+
+    def read_archived(self, group, first, last, bodies):
+        """Return [(message ID, post)] for the archived posts with IDs first to last - 1."""
+        segments = self.archives.get(group, [])
+        number = max(bisect.bisect_right(segments, (first, float("inf"))) - 1, 0)
+        posts = []
+        for segment_first, segment_last, name in segments[number:]:
+            if segment_first >= last:
+                break
+            if segment_last > first:
+                posts.extend(self.archive_segment(name).read_posts(first, last, bodies))
+        return posts
+
+    def archive_segment(self, name):
+        """Return an open archive segment, closing the least recently used
+        one if too many are open.
+        """
+        with self.archive_lock:
+            segment = self.open_archives.get(name)
+            if segment is None:
+                segment = ArchiveSegment(os.path.join(self.data_dir, ARCHIVE_DIRECTORY, name))
+                self.open_archives[name] = segment
+                if len(self.open_archives) > ARCHIVE_OPEN_SEGMENTS:
+                    # Readers still using it keep it alive; its file is
+                    # closed when the last one is done.
+                    self.open_archives.popitem(last=False)
+            else:
+                self.open_archives.move_to_end(name)
+            return segment
+
+    def post_from_row(self, row, bodies):
+        sender, date, subject, offset, length = row
+        post = {"sender": sender, "date": date, "subject": subject}
+        if bodies:
+            post["message"] = self.segment.read(offset, length).decode()
+        return post
+
+    def prepare_archive(self, group, policy):
+        board = self.boards.get(group)
+        if board is None or not policy.limited:
+            return None
+        first = board.first
+        last = board.archive_cut(policy, datetime.date.today())
+        if last - first < ARCHIVE_BATCH and not (policy.max_days is not None and last > first):
+            return None
+        # Posts never change, so they can be read without the group's lock.
+        rows = [
+            (message_id, post["sender"], post["date"].toordinal(), post["subject"], post["message"])
+            for message_id, post in self.read_posts(group, first, last)
+        ]
+        name = "%08d.arc" % (next(self.archive_numbers))
+        ArchiveSegment.write(os.path.join(self.data_dir, ARCHIVE_DIRECTORY, name), group, rows)
+        return ("archive", group, first, last, name)
+
+    def commit_archive(self, archive):
+        self.store.append(archive)
+        self.apply(archive)
+
+    def snapshot_due(self, max_records, max_seconds):
+        return self.store.snapshot_due(max_records, max_seconds)
+
+    def compaction_due(self):
+        live = sum(board.body_bytes for board in list(self.boards.values()))
+        return self.segment.length - live > max(live, COMPACT_MIN_BYTES)
+
+    def begin_snapshot(self, groups, compact=False):
+        generation = self.store.rotate()
+        if compact:
+            self.compact_segment(COMPACTED_SEGMENT_FILE % (generation))
+        state = pickle.dumps(
+            {
+                "groups": groups,
+                "boards": self.boards,
+                "segment_file": self.segment_file,
+                "segment_length": self.segment.length,
+                "archives": self.archives,
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        return state, generation
+
+    def compact_segment(self, name):
+        """Copy the bodies still on the boards to a new body segment and
+        switch to it, leaving the bodies of archived posts behind. The boards
+        must be write-locked.
+        """
+        segment = Segment(os.path.join(self.data_dir, name))
+        for board in self.boards.values():
+            bodies = [
+                self.segment.read(offset, length) if length > 0 else b""
+                for offset, length in zip(board.offsets, board.lengths)
+            ]
+            board.offsets = array.array(board.offsets.typecode, segment.append_many(bodies))
+        self.segment.close()
+        self.retired_segment = self.segment_file
+        self.segment = segment
+        self.segment_file = name
+
+    def finish_snapshot(self, snapshot):
+        state, generation = snapshot
+        # The bodies the snapshot refers to must be on disk before it is.
+        self.segment.sync()
+        self.store.write_snapshot(state, generation)
+        if self.retired_segment is not None:
+            os.remove(os.path.join(self.data_dir, self.retired_segment))
+            fsync_directory(self.data_dir)
+            self.retired_segment = None
+
+    def close(self):
+        self.store.close()
+        self.segment.close()
+        with self.archive_lock:
+            for segment in self.open_archives.values():
+                segment.close()
+            self.open_archives.clear()
+
+
+class SQLiteStorage(Storage):
+    """Boards in an SQLite database, read a post at a time.
+
+    Posts are keyed by (group, message ID), so a lookup is a single index
+    probe and startup only reads the (small) group and membership tables.
+    The "always" fsync policy makes every commit durable (synchronous=FULL);
+    the others let SQLite sync its own write-ahead log at checkpoints
+    (synchronous=NORMAL), which survives a crash of the server but not
+    necessarily of the machine.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS groups (
+            name TEXT PRIMARY KEY,
+            next_message_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            group_name TEXT NOT NULL,
+            user_name TEXT NOT NULL,
+            join_seq INTEGER NOT NULL,
+            PRIMARY KEY (group_name, user_name)
+        );
+        CREATE TABLE IF NOT EXISTS past_memberships (
+            group_name TEXT NOT NULL,
+            user_name TEXT NOT NULL,
+            join_seq INTEGER NOT NULL,
+            leave_seq INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS past_memberships_group ON past_memberships (group_name);
+        CREATE TABLE IF NOT EXISTS posts (
+            group_name TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            sender TEXT NOT NULL,
+            date TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            message TEXT NOT NULL,
+            PRIMARY KEY (group_name, message_id)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, data_dir, fsync_policy=FSYNC_POLICY, fsync_interval=FSYNC_INTERVAL) -> None:
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        # One connection shared by every handler thread, serialized by lock.
+        self.database = sqlite3.connect(os.path.join(data_dir, DATABASE_FILE), check_same_thread=False)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.database.execute("PRAGMA synchronous=%s" % ("FULL" if fsync_policy == "always" else "NORMAL"))
+        self.database.executescript(self.SCHEMA)
+        self.lock = threading.Lock()
+
+    def recover(self):
+        with self.lock:
+            if self.database.execute("SELECT COUNT(*) FROM groups").fetchone()[0] == 0:
+                self.import_pickles()
+            groups = {}
+            for group, next_message_id in self.database.execute("SELECT name, next_message_id FROM groups"):
+                groups[group] = {"members": {}, "past_memberships": {}, "next_message_id": next_message_id}
+            # Members come back in join order: a (re)join always gets a new, higher rowid.
+            for group, name, join in self.database.execute(
+                "SELECT group_name, user_name, join_seq FROM members ORDER BY rowid"
+            ):
+                groups[group]["members"][name] = join
+            for group, name, join, leave in self.database.execute(
+                "SELECT group_name, user_name, join_seq, leave_seq FROM past_memberships ORDER BY rowid"
+            ):
+                groups[group]["past_memberships"].setdefault(name, []).append((join, leave))
+        return groups
+
+    def import_pickles(self):
+        """Fill an empty database from the pickle engine's snapshot and log,
+        or from an older version's groups.pkl and boards.pkl.
+        """
+        source = PickleReader(self.data_dir)
+        groups = source.groups
+        groups.setdefault("default", {"members": {}, "past_memberships": {}, "next_message_id": 0})
+        with self.database:
+            for group, saved in groups.items():
+                self.database.execute("INSERT INTO groups VALUES (?, ?)", (group, saved["next_message_id"]))
+                self.database.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?)",
+                    ((group, name, join) for name, join in saved["members"].items()),
+                )
+                self.database.executemany(
+                    "INSERT INTO past_memberships VALUES (?, ?, ?, ?)",
+                    (
+                        (group, name, join, leave)
+                        for name, memberships in saved["past_memberships"].items()
+                        for join, leave in memberships
+                    ),
+                )
+                self.database.executemany(
+                    "INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?)",
+                    (self.post_row(group, message_id, post) for message_id, post in source.posts(group)),
+                )
+
+    @staticmethod
+    def post_row(group, message_id, post):
+        return (group, message_id, post["sender"], post["date"].isoformat(), post["subject"], post["message"])
+
+    def write(self, record):
+        with self.lock, self.database:
+            self.execute(record)
+
+    def write_many(self, records):
+        # One transaction, so one commit for the lot, with every run of posts
+        # inserted together.
+        with self.lock, self.database:
+            posts = []
+            for record in records:
+                if record[0] == "post":
+                    posts.append(record)
+                    continue
+                self.insert_posts(posts)
+                posts = []
+                self.execute(record)
+            self.insert_posts(posts)
+
+    def insert_posts(self, records):
+        """Insert several post records at once. Called with lock held, in a transaction."""
+        self.database.executemany(
+            "INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?)", (self.post_row(*record[1:]) for record in records)
+        )
+        next_message_ids = {group: message_id + 1 for kind, group, message_id, post in records}
+        self.database.executemany(
+            "UPDATE groups SET next_message_id = ? WHERE name = ?",
+            [(next_message_id, group) for group, next_message_id in next_message_ids.items()],
+        )
+
+    def execute(self, record):
+        """Apply a change to the database. Called with lock held, in a transaction."""
+        match record:
+            case ("create", group):
+                self.database.execute("INSERT INTO groups VALUES (?, 0)", (group,))
+            case ("join", group, name):
+                self.database.execute(
+                    "INSERT INTO members SELECT name, ?, next_message_id FROM groups WHERE name = ?",
+                    (name, group),
+                )
+            case ("leave", group, name):
+                row = self.database.execute(
+                    "SELECT join_seq FROM members WHERE group_name = ? AND user_name = ?", (group, name)
+                ).fetchone()
+                if row is None:
+                    return
+                (join,) = row
+                (leave,) = self.database.execute(
+                    "SELECT next_message_id FROM groups WHERE name = ?", (group,)
+                ).fetchone()
+                self.database.execute(
+                    "DELETE FROM members WHERE group_name = ? AND user_name = ?", (group, name)
+                )
+                if join < leave:
+                    self.database.execute(
+                        "INSERT INTO past_memberships VALUES (?, ?, ?, ?)", (group, name, join, leave)
+                    )
+            case ("members", group, members, past_memberships):
+                self.database.execute("DELETE FROM members WHERE group_name = ?", (group,))
+                self.database.execute("DELETE FROM past_memberships WHERE group_name = ?", (group,))
+                self.database.executemany(
+                    "INSERT INTO members VALUES (?, ?, ?)", ((group, name, join) for name, join in members.items())
+                )
+                self.database.executemany(
+                    "INSERT INTO past_memberships VALUES (?, ?, ?, ?)",
+                    (
+                        (group, name, join, leave)
+                        for name, memberships in past_memberships.items()
+                        for join, leave in memberships
+                    ),
+                )
+            case ("post", group, message_id, post):
+                self.database.execute(
+                    "INSERT INTO posts VALUES (?, ?, ?, ?, ?, ?)", self.post_row(group, message_id, post)
+                )
+                self.database.execute(
+                    "UPDATE groups SET next_message_id = ? WHERE name = ?", (message_id + 1, group)
+                )
+
+    def read_post(self, group, message_id):
+        with self.lock:
+            row = self.database.execute(
+                "SELECT sender, date, subject, message FROM posts WHERE group_name = ? AND message_id = ?",
+                (group, message_id),
+            ).fetchone()
+        if row is None:
+            return None
+        sender, date, subject, message = row
+        return {"sender": sender, "date": datetime.date.fromisoformat(date), "subject": subject, "message": message}
+
+    def read_posts(self, group, first, last, bodies=True):
+        columns = "message_id, sender, date, subject" + (", message" if bodies else "")
+        with self.lock:
+            rows = self.database.execute(
+                "SELECT %s FROM posts WHERE group_name = ? AND message_id >= ? AND message_id < ? ORDER BY message_id"
+                % (columns),
+                (group, first, last),
+            ).fetchall()
+        posts = []
+        for message_id, sender, date, subject, *message in rows:
+            post = {"sender": sender, "date": datetime.date.fromisoformat(date), "subject": subject}
+            if bodies:
+                post["message"] = message[0]
+            posts.append((message_id, post))
+        return posts
+
+    def close(self):
+        with self.lock:
+            self.database.close()
+
+
+# Storage engines by --storage name.
+STORAGE_ENGINES = {"pickle": PickleStorage, "sqlite": SQLiteStorage}
+STORAGE_ENGINE = "pickle"
@@ -0,0 +1,252 @@
+"""
+support.py
+----------
+Helpers for the tests: run server.py in a temporary data directory and talk
+to it over the plain text and framed protocols, the way client.py does, or
+drive a Server's handlers directly, the way benchmarks.py does.
+"""
+
+import contextlib
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol  # noqa: E402
+from server import Server  # noqa: E402
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server.py")
+# Seconds to wait for a server to start listening, or for a reply.
+START_TIMEOUT = 15
+REPLY_TIMEOUT = 5
+
+
+def free_port():
+    """Return a TCP port nothing is listening on right now."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_until(condition, timeout=REPLY_TIMEOUT, interval=0.05):
+    """Wait for condition() to be true. Returns its last value."""
+    deadline = time.monotonic() + timeout
+    while True:
+        value = condition()
+        if value or time.monotonic() >= deadline:
+            return value
+        time.sleep(interval)
+
+
+class ServerProcess:
+    """server.py running in a subprocess, with its own data directory (a new
+    temporary one, unless data_dir is given) and log file.
+    """
+
+    def __init__(self, *args, data_dir=None, env=None) -> None:
+        self.directory = tempfile.mkdtemp(prefix="bulletin-test-")
+        self.data_dir = data_dir if data_dir is not None else os.path.join(self.directory, "data")
+        self.port = free_port()
+        self.log_path = os.path.join(self.directory, "server.log")
+        command = [sys.executable, SERVER, "--host", "127.0.0.1", "--port", str(self.port), "--data-dir", self.data_dir]
+        with open(self.log_path, "w") as log:
+            self.process = subprocess.Popen(
+                command + list(args),
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env=dict(os.environ, **(env or {})),
+            )
+        if not wait_until(self.listening, START_TIMEOUT):
+            self.stop()
+            raise RuntimeError("The server didn't start:\n" + self.log())
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def listening(self):
+        # Told by the log rather than by connecting, which would take up a session.
+        if self.process.poll() is not None:
+            raise RuntimeError("The server exited with %d:\n%s" % (self.process.returncode, self.log()))
+        return "Listening for connections" in self.log()
+
+    def log(self):
+        with open(self.log_path) as log:
+            return log.read()
+
+    def stop(self):
+        """Shut the server down the way Ctrl+C does. Returns its exit code."""
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(START_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        return self.process.returncode
+
+    def kill(self):
+        """Kill the server without letting it shut down, as a crash would."""
+        self.process.kill()
+        self.process.wait()
+
+    def cleanup(self):
+        self.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class PlainClient:
+    """A client speaking the plain text protocol: every command is its own
+    send, and replies and notifications arrive as they come.
+    """
+
+    def __init__(self, port, name, group="default") -> None:
+        self.socket = socket.create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT)
+        self.received = ""
+        self.socket.sendall(("%s %s" % (name, group)).encode())
+        self.hello = self.read_until("Current server groups")
+
+    def read_until(self, text, timeout=REPLY_TIMEOUT):
+        """Read until text has arrived. Returns (and forgets) everything read
+        up to the end of the chunk it arrived in. Raises AssertionError if
+        it doesn't come in time.
+        """
+        deadline = time.monotonic() + timeout
+        while text not in self.received:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise AssertionError("Waited for %r, got %r" % (text, self.received))
+            self.socket.settimeout(remaining)
+            try:
+                data = self.socket.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                raise AssertionError("Connection closed waiting for %r, got %r" % (text, self.received))
+            self.received += data.decode()
+        received, self.received = self.received, ""
+        return received
+
+    def command(self, command, expect):
+        """Send a command and return what was read up to its expected reply."""
+        self.socket.sendall(command.encode())
+        return self.read_until(expect)
+
+    def close(self):
+        self.socket.close()
+
+
+class FramedClient:
+    """A client speaking the framed protocol. Replies are matched to their
+    requests; notifications are collected in notifications.
+    """
+
+    def __init__(self, port, name, group="default") -> None:
+        self.socket = socket.create_connection(("127.0.0.1", port), timeout=REPLY_TIMEOUT)
+        self.decoder = protocol.FrameDecoder()
+        self.frames = []
+        self.notifications = []
+        self.next_request_id = 1
+        self.hello = self.request("%s %s" % (name, group), protocol.HANDSHAKE_REQUEST_ID)
+
+    def read_frame(self):
+        while not self.frames:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed.")
+            self.frames.extend(self.decoder.feed(data))
+        frame_type, request_id, payload = self.frames.pop(0)
+        return frame_type, request_id, payload.decode()
+
+    def request(self, command, request_id=None):
+        """Send a command and return its reply (parts joined with newlines)."""
+        if request_id is None:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+        self.socket.sendall(protocol.encode_frame(protocol.REQUEST, request_id, command))
+        parts = []
+        while True:
+            frame_type, frame_id, payload = self.read_frame()
+            if frame_type == protocol.NOTIFICATION:
+                self.notifications.append(payload)
+            elif frame_type == protocol.HEARTBEAT:
+                self.socket.sendall(protocol.encode_frame(protocol.HEARTBEAT, frame_id, ""))
+            elif frame_type == protocol.RESPONSE_PART and frame_id == request_id:
+                parts.append(payload)
+            elif frame_type == protocol.RESPONSE and frame_id == request_id:
+                return "\n".join(parts + [payload])
+
+    def close(self):
+        self.socket.close()
+
+
+class RecordingConnection:
+    """Stands in for a Connection: keeps every reply (with the parts sent
+    before it, joined with newlines) and notification instead of sending them.
+    """
+
+    def __init__(self, framed=True) -> None:
+        self.client_id = None
+        self.framed = framed
+        self.bytes_in = self.bytes_out = 0
+        self.parts = []
+        self.replies = []
+        self.notifications = []
+
+    @staticmethod
+    def text(message):
+        return message.decode() if isinstance(message, bytes) else message
+
+    def reply_part(self, message):
+        self.parts.append(self.text(message))
+
+    def reply(self, message):
+        self.replies.append("\n".join(self.parts + [self.text(message)]))
+        self.parts = []
+
+    def notify(self, message):
+        self.notifications.append(self.text(message))
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+@contextlib.contextmanager
+def handler_server(**options):
+    """A Server on a temporary data directory, with its data loaded but not
+    listening and without its background threads.
+    """
+    data_dir = tempfile.mkdtemp(prefix="bulletin-test-")
+    try:
+        server = Server("127.0.0.1", 0, data_dir=data_dir, **options)
+        server.restore_groups(server.storage.recover())
+        yield server
+        server.storage.close()
+    finally:
+        shutil.rmtree(data_dir)
+
+
+class HandlerClient:
+    """A session on a Server from handler_server. Commands run on the
+    calling thread, and command() returns the reply.
+    """
+
+    def __init__(self, server, name, group="default", framed=True) -> None:
+        self.server = server
+        self.connection = RecordingConnection(framed)
+        self.connection.client_id = server.register_client("%s %s" % (name, group), self.connection)
+        self.hello = self.connection.replies.pop()
+
+    def command(self, command):
+        self.server.handle_command(self.connection.client_id, command)
+        return self.connection.replies.pop()
@@ -0,0 +1,82 @@
+"""What clients see, run against the threaded server and the asyncio one."""
+
+import datetime
+import unittest
+
+from support import FramedClient, PlainClient, ServerProcess
+
+
+class BehaviorTest(unittest.TestCase):
+    mode = ()
+
+    def start_server(self, *args):
+        server = ServerProcess(*(self.mode + args))
+        self.addCleanup(server.cleanup)
+        return server
+
+    def connect(self, server, client_class, name, group="default"):
+        client = client_class(server.port, name, group)
+        self.addCleanup(client.close)
+        return client
+
+    def test_commands(self):
+        server = self.start_server()
+        today = datetime.date.today().isoformat()
+        alice = self.connect(server, PlainClient, "alice")
+        self.assertEqual(alice.hello, "id 0 Current server groups: default")
+        bob = self.connect(server, PlainClient, "bob", "g1")
+        self.assertEqual(bob.hello, "id 1 Current server groups: default, g1")
+        self.assertEqual(alice.read_until("bob"), "bob has joined the server (client ID #1). ")
+
+        self.assertEqual(alice.command("groups", "Available"), "Available groups: default, g1")
+        self.assertEqual(alice.command("post hi hello world", "ID#0."), "New message posted in default by alice with ID#0.")
+        self.assertEqual(alice.command("message 0", "world"), "alice on %s (hi): hello world" % (today))
+        self.assertEqual(alice.command("users", "alice"), "Users in 'default': alice")
+        self.assertEqual(alice.command("groupjoin g1", "alice"), "Added to group 'g1'.\nCurrent Members: bob, alice")
+        self.assertEqual(bob.read_until("has joined"), "New member alice has joined group 'g1'.")
+
+        for number in range(2):
+            reply = alice.command("grouppost g1 s%d body %d" % (number, number), "ID#%d." % (number))
+            self.assertEqual(reply, "New message posted in g1 by alice with ID#%d." % (number))
+            self.assertEqual(bob.read_until("ID#%d." % (number)), reply)
+        self.assertEqual(alice.command("groupmessage g1 1", "body 1"), "alice on %s (s1): body 1" % (today))
+        self.assertEqual(alice.command("groupusers g1", "alice"), "Users in 'g1': bob, alice")
+        self.assertEqual(alice.command("latest g1 5", "listed from"), "#0 alice on %s (s0)\n#1 alice on %s (s1)\n2 message(s) listed from 'g1'." % (today, today))
+        self.assertIn("best first: 1", alice.command("search g1 body 1", "best first"))
+        self.assertEqual(alice.command("groupleave g1", "left"), "You have left group 'g1'.")
+        self.assertEqual(bob.read_until("has left"), "User alice has left group 'g1'.")
+        self.assertEqual(alice.command("bogus", "Invalid"), "Invalid command.")
+
+        self.assertEqual(bob.command("groupmessage g1 0", "body 0"), "alice on %s (s0): body 0" % (today))
+        self.assertEqual(bob.command("exit", "disconnected"), "You have been disconnected from the server.")
+        self.assertEqual(alice.command("exit", "disconnected"), "You have been disconnected from the server.")
+        self.assertEqual(server.stop(), 0)
+        self.assertNotIn("Traceback", server.log())
+
+    def test_framed(self):
+        server = self.start_server()
+        alice = self.connect(server, FramedClient, "alice", "g")
+        self.assertTrue(alice.hello.startswith("id 0 token "))
+        bob = self.connect(server, FramedClient, "bob", "g")
+        self.assertEqual(alice.request("grouppost g s body"), "New message posted in g by alice with ID#0.")
+        self.assertEqual(bob.request("groupusers g"), "Users in 'g': alice, bob")
+        self.assertIn("New message posted in g by alice with ID#0.", bob.notifications)
+        self.assertEqual(bob.request("exit"), "You have been disconnected from the server.")
+
+    def test_server_full(self):
+        server = self.start_server("--max-sessions", "1")
+        self.connect(server, PlainClient, "alice")
+        # The second client is turned away in the protocol it speaks.
+        with self.assertRaisesRegex(AssertionError, "Server is full"):
+            PlainClient(server.port, "bob")
+        framed = self.connect(server, FramedClient, "carol")
+        self.assertEqual(framed.hello, "Error: Server is full, try again later.")
+        self.assertNotIn("Traceback", server.log())
+
+
+class AsyncioBehaviorTest(BehaviorTest):
+    mode = ("--asyncio",)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Sessions coming and going in every way a session can end, after which the
+server must be back where it started: no sessions, file descriptors or
+threads left behind.
+"""
+
+import os
+import re
+import socket
+import unittest
+
+from support import FramedClient, PlainClient, ServerProcess, wait_until
+
+import protocol  # found through the path support.py sets up
+
+ROUNDS = 5
+SESSIONS = 4
+# Short timeouts, so the silent sessions are dropped (and their sessions
+# expire) within a few seconds.
+TIMEOUTS = ("--heartbeat-interval", "1", "--read-timeout", "1", "--resume-timeout", "1")
+ADMIN_KEY = "secret"
+
+
+@unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs Linux's /proc")
+class ChurnTest(unittest.TestCase):
+    mode = ()
+
+    def setUp(self):
+        self.server = ServerProcess(*(self.mode + TIMEOUTS + ("--admin", "root")), env={"BULLETIN_ADMIN_KEY": ADMIN_KEY})
+        self.addCleanup(self.server.cleanup)
+        self.admin = PlainClient(self.server.port, "root")
+        self.addCleanup(self.admin.close)
+        self.sockets = []
+
+    def tearDown(self):
+        for client_socket in self.sockets:
+            client_socket.close()
+
+    def sample(self):
+        """Return the server's (sessions, file descriptors, threads), not
+        counting the admin's own session.
+        """
+        stats = self.admin.command("stats " + ADMIN_KEY, "Groups:")
+        sessions = int(re.search(r"(\d+) sessions open", stats).group(1)) - 1
+        fds = len(os.listdir("/proc/%d/fd" % (self.server.pid)))
+        with open("/proc/%d/status" % (self.server.pid)) as status:
+            threads = int(re.search(r"^Threads:\s+(\d+)", status.read(), re.MULTILINE).group(1))
+        return sessions, fds, threads
+
+    def churn(self, number):
+        port = self.server.port
+        for index in range(SESSIONS):
+            name = "user%d-%d" % (number, index)
+            # %exit.
+            client = PlainClient(port, name, "g%d" % (index))
+            client.command("grouppost g%d subject message" % (index), "ID#")
+            client.command("exit", "disconnected")
+            client.close()
+            # Hanging up: the session waits to be resumed, then expires.
+            client = FramedClient(port, name, "g%d" % (index))
+            client.request("groupusers g%d" % (index))
+            client.close()
+            # Going silent: heartbeats go unanswered until the server drops it.
+            silent = socket.create_connection(("127.0.0.1", port))
+            silent.sendall(protocol.encode_frame(protocol.REQUEST, protocol.HANDSHAKE_REQUEST_ID, name + " default"))
+            self.sockets.append(silent)
+            # A handshake the server refuses, and no handshake at all.
+            garbage = socket.create_connection(("127.0.0.1", port))
+            garbage.sendall(b"nobody")
+            self.sockets.append(garbage)
+            self.sockets.append(socket.create_connection(("127.0.0.1", port)))
+
+    def test_churn_returns_to_baseline(self):
+        # One round first, so anything started on first use is running
+        # before the baseline is taken.
+        self.churn(0)
+        self.assertTrue(wait_until(lambda: self.sample()[0] == 0, timeout=15))
+        baseline = self.sample()
+        for number in range(1, ROUNDS + 1):
+            self.churn(number)
+        self.assertNotEqual(self.sample(), baseline)
+        samples = []
+        self.assertTrue(wait_until(lambda: samples.append(self.sample()) or samples[-1] == baseline, timeout=20), (baseline, samples[-1]))
+        self.assertNotIn("Traceback", self.server.log())
+
+
+class AsyncioChurnTest(ChurnTest):
+    # The command threads are started as needed, up to --command-threads; with
+    # one, it's already running when the baseline is taken.
+    mode = ("--asyncio", "--command-threads", "1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""Commands run by driving Server's handlers directly (see support.handler_server)."""
+
+import datetime
+import re
+import unittest
+from unittest import mock
+
+from support import HandlerClient, handler_server
+
+import server as server_module  # found through the path support.py sets up
+
+HUGE = 2**63
+ADMIN_KEY = "secret"
+
+
+class HandlerTest(unittest.TestCase):
+    storage = "pickle"
+
+    def setUp(self):
+        context = handler_server(
+            storage_engine=self.storage, fsync_policy="interval", admins=("root",), admin_key=ADMIN_KEY.encode()
+        )
+        self.server = context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+    def test_message_ids_out_of_range(self):
+        alice = HandlerClient(self.server, "alice")
+        for number in range(2):
+            alice.command("post subject message %d" % (number))
+        today = datetime.date.today().isoformat()
+        self.assertEqual(alice.command("message 1"), "alice on %s (subject): message 1" % (today))
+        # Past the newest post, negative, or too big for any storage engine.
+        for message_id in (2, -1, HUGE, 2**100):
+            self.assertEqual(alice.command("message %d" % (message_id)), "Error: Message ID does not exist.")
+            self.assertEqual(
+                alice.command("groupmessage default %d" % (message_id)), "Error: Message ID does not exist."
+            )
+        self.assertEqual(alice.command("since default %d" % (HUGE)), "0 message(s) listed from 'default'.")
+        self.assertEqual(
+            alice.command("messages default %d %d" % (HUGE, HUGE + 5)), "0 message(s) listed from 'default'."
+        )
+        listing = alice.command("messages default 1 %d" % (HUGE))
+        self.assertEqual(listing, "#1 alice on %s (subject)\n1 message(s) listed from 'default'." % (today))
+
+    def listed(self, client, command):
+        """Run a listing command and return (listed IDs, summary line, pages
+        streamed before the reply).
+        """
+        with mock.patch.object(client.connection, "reply_part", wraps=client.connection.reply_part) as reply_part:
+            reply = client.command(command)
+        lines = reply.split("\n")
+        return [int(re.match(r"#(\d+) ", line).group(1)) for line in lines[:-1]], lines[-1], reply_part.call_count
+
+    def test_since_and_latest_paging(self):
+        limit, page = server_module.MESSAGES_LIMIT, server_module.MESSAGES_PAGE_SIZE
+        count = limit + 30
+        alice = HandlerClient(self.server, "alice")
+        lines = ["subject%d message %d" % (number, number) for number in range(count)]
+        alice.command("\n".join(["bulkpost default"] + lines))
+
+        # %since from the start stops at the cap and says where to go on from.
+        ids, summary, pages = self.listed(alice, "since default -1")
+        self.assertEqual(ids, list(range(limit)))
+        self.assertEqual(summary, "%d message(s) listed from 'default'. More messages from ID#%d." % (limit, limit))
+        self.assertEqual(pages, limit // page - 1)
+        ids, summary, pages = self.listed(alice, "since default %d" % (limit - 1))
+        self.assertEqual(ids, list(range(limit, count)))
+        self.assertEqual(summary, "30 message(s) listed from 'default'.")
+        self.assertEqual(pages, 0)
+        self.assertEqual(
+            self.listed(alice, "since default %d" % (count - 1))[:2], ([], "0 message(s) listed from 'default'.")
+        )
+        # Pages that don't start on a multiple of the page size.
+        ids, summary, pages = self.listed(alice, "since default %d" % (page - 3))
+        self.assertEqual(ids, list(range(page - 2, count)))
+        self.assertEqual(pages, -(-len(ids) // page) - 1)
+
+        # %latest lists the newest posts, at most the cap of them.
+        self.assertEqual(self.listed(alice, "latest default 5")[0], list(range(count - 5, count)))
+        ids, summary, pages = self.listed(alice, "latest default %d" % (10 * count))
+        self.assertEqual(ids, list(range(count - limit, count)))
+        self.assertEqual(summary, "%d message(s) listed from 'default'." % (limit))
+        self.assertEqual(self.listed(alice, "latest default 0")[0], [])
+        reply = alice.command("latest default 2 --bodies")
+        self.assertIn("(subject%d): message %d" % (count - 1, count - 1), reply)
+        self.assertNotIn("message", alice.command("latest default 2").split("\n")[0])
+
+        # Members who joined later only get the posts they may view.
+        bob = HandlerClient(self.server, "bob")
+        history = server_module.HISTORY_LIMIT
+        self.assertEqual(self.listed(bob, "latest default 10")[0], list(range(count - history, count)))
+        self.assertEqual(
+            self.listed(bob, "since default -1")[:2],
+            ([], "0 message(s) listed from 'default'. More messages from ID#%d." % (limit)),
+        )
+
+    def test_bulkpost_needs_framed_protocol(self):
+        framed = HandlerClient(self.server, "alice")
+        plain = HandlerClient(self.server, "bob", framed=False)
+        lines = ["subject%d message %d" % (number, number) for number in range(3)]
+        reply = plain.command("\n".join(["bulkpost default"] + lines))
+        self.assertEqual(reply, "Error: %bulkpost needs the framed protocol.")
+        self.assertEqual(self.server.board_seqs["default"], 0)
+        reply = framed.command("\n".join(["bulkpost default"] + lines))
+        self.assertEqual(reply, "3 new messages posted in default (IDs 0-2) by alice.")
+        self.assertEqual(plain.command("message 2").split(" (")[1], "subject2): message 2")
+
+    def test_stats_needs_admin_key(self):
+        root = HandlerClient(self.server, "root")
+        alice = HandlerClient(self.server, "alice")
+        refused = "Error: %stats is only available to admins."
+        # The name alone isn't enough, and only admins get to try the key.
+        for client, command in ((root, "stats"), (root, "stats wrong"), (alice, "stats " + ADMIN_KEY)):
+            self.assertEqual(client.command(command), refused)
+        self.assertIn("sessions open", root.command("stats " + ADMIN_KEY))
+
+
+
+class SQLiteHandlerTest(HandlerTest):
+    storage = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""The framed protocol's FrameDecoder, fed bytes the way recv() returns them."""
+
+import unittest
+
+import support  # noqa: F401 (puts the repository on sys.path)
+import protocol
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def setUp(self):
+        self.decoder = protocol.FrameDecoder()
+
+    def test_frame_split_across_reads(self):
+        frame = protocol.encode_frame(protocol.REQUEST, 7, "post subject message")
+        # A byte at a time, including through the header.
+        for index in range(len(frame) - 1):
+            self.assertEqual(self.decoder.feed(frame[index : index + 1]), [])
+        self.assertEqual(self.decoder.feed(frame[-1:]), [(protocol.REQUEST, 7, b"post subject message")])
+        self.assertEqual(self.decoder.buffer, b"")
+
+    def test_frames_merged_in_one_read(self):
+        frames = [
+            protocol.encode_frame(protocol.RESPONSE, 1, "first"),
+            protocol.encode_frame(protocol.HEARTBEAT, 0, b""),
+            protocol.encode_frame(protocol.NOTIFICATION, 0, "café"),
+        ]
+        second = protocol.encode_frame(protocol.RESPONSE, 2, "second")
+        # Three whole frames and the start of a fourth, then the rest of it.
+        received = self.decoder.feed(b"".join(frames) + second[:12])
+        self.assertEqual(
+            received,
+            [
+                (protocol.RESPONSE, 1, b"first"),
+                (protocol.HEARTBEAT, 0, b""),
+                (protocol.NOTIFICATION, 0, "café".encode()),
+            ],
+        )
+        self.assertEqual(self.decoder.feed(second[12:]), [(protocol.RESPONSE, 2, b"second")])
+
+    def test_oversized_length(self):
+        header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.REQUEST, 1, protocol.MAX_PAYLOAD + 1)
+        # Refused as soon as the header is in, without waiting for the payload.
+        with self.assertRaises(protocol.ProtocolError):
+            self.decoder.feed(header)
+        largest = protocol.FrameDecoder()
+        header = protocol.HEADER.pack(protocol.PROTOCOL_VERSION, protocol.REQUEST, 1, protocol.MAX_PAYLOAD)
+        self.assertEqual(largest.feed(header), [])
+
+    def test_bad_version(self):
+        frame = protocol.encode_frame(protocol.REQUEST, 1, "help")
+        with self.assertRaises(protocol.ProtocolError):
+            self.decoder.feed(bytes([protocol.PROTOCOL_VERSION + 1]) + frame[1:])
+        # A plain text handshake is never taken for a frame.
+        self.assertFalse(protocol.is_framed(b"alice default"[0]))
+        self.assertTrue(protocol.is_framed(frame[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""A primary and a read replica in two processes (see replication.py)."""
+
+import unittest
+
+from support import PlainClient, ServerProcess, free_port, wait_until
+
+KEY = {"BULLETIN_REPLICATION_KEY": "test-key"}
+
+
+class ReplicationTest(unittest.TestCase):
+    storage = "pickle"
+
+    def setUp(self):
+        self.replication_port = free_port()
+        self.primary = ServerProcess(
+            "--storage", self.storage, "--replication-port", str(self.replication_port), env=KEY
+        )
+        self.addCleanup(self.primary.cleanup)
+        self.replicas = []
+
+    def start_replica(self, data_dir=None):
+        replica = ServerProcess(
+            "--storage", self.storage, "--follow", "127.0.0.1:%d" % self.replication_port, data_dir=data_dir, env=KEY
+        )
+        self.addCleanup(replica.cleanup)
+        self.replicas.append(replica)
+        return replica
+
+    def users(self, client, group):
+        return client.command("groupusers %s" % group, "Users in").strip()
+
+    def assert_users(self, client, group, users):
+        expected = "Users in '%s': %s" % (group, ", ".join(users))
+        self.assertEqual(wait_until(lambda: self.users(client, group) == expected) and expected, expected)
+
+    def test_follow_restart(self):
+        alice = PlainClient(self.primary.port, "alice", "g")
+        bob = PlainClient(self.primary.port, "bob", "g")
+        alice.command("grouppost g first one", "with ID#0")
+        alice.command("grouppost g second two", "with ID#1")
+
+        # alice and bob come with the snapshot, carol's join and bob's leave
+        # with the stream of changes.
+        replica = self.start_replica()
+        reader = PlainClient(replica.port, "reader", "g")
+        self.assert_users(reader, "g", ["alice", "bob", "reader"])
+        carol = PlainClient(self.primary.port, "carol", "g")
+        bob.command("grouppost g third three", "with ID#2")
+        bob.command("groupleave g", "You have left group 'g'.")
+        self.assert_users(reader, "g", ["alice", "reader", "carol"])
+        self.assertIn("bob on", reader.command("groupmessage g 2", "(third)"))
+        reader.close()
+
+        # The replica's own storage has it all, even after a crash: it
+        # recovers without the snapshot's help, then follows on.
+        data_dir = replica.data_dir
+        replica.kill()
+        self.replicas.remove(replica)
+        alice.command("grouppost g fourth four", "with ID#3")
+        replica = self.start_replica(data_dir)
+        reader = PlainClient(replica.port, "reader", "g")
+        self.assert_users(reader, "g", ["alice", "reader", "carol"])
+        self.assertIn("alice on", reader.command("groupmessage g 0", "(first)"))
+        self.assertIn("alice on", reader.command("groupmessage g 3", "(fourth)"))
+        carol.command("groupleave g", "You have left group 'g'.")
+        alice.command("groupleave g", "You have left group 'g'.")
+        self.assert_users(reader, "g", ["reader"])
+
+        # Writes on the replica are run by the primary.
+        reader.command("grouppost g fifth five", "with ID#4")
+        self.assertIn("reader on", reader.command("groupmessage g 4", "(fifth)"))
+        for client in (reader, alice, bob, carol):
+            client.close()
+        for server in [self.primary] + self.replicas:
+            self.assertEqual(server.stop(), 0)
+            self.assertNotIn("Traceback", server.log())
+
+
+class SQLiteReplicationTest(ReplicationTest):
+    storage = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Search: GroupIndex's TF-IDF ranking, and %search run through the server's
+handlers (see support.handler_server).
+"""
+
+import unittest
+
+from support import HandlerClient, handler_server
+
+import search  # found through the path support.py sets up
+import server as server_module
+
+
+def indexed(*posts):
+    """Return a GroupIndex of posts given as (subject, message), in ID order."""
+    index = search.GroupIndex()
+    for message_id, (subject, message) in enumerate(posts):
+        index.add(message_id, {"sender": "alice", "subject": subject, "message": message})
+    return index
+
+
+def accept_all(message_id):
+    return True
+
+
+class GroupIndexTest(unittest.TestCase):
+    def test_term_count_ranks_single_term(self):
+        # A subject counts FIELD_WEIGHT times over one occurrence in the body.
+        index = indexed(("other", "apple"), ("other", "apple apple apple"), ("apple", "other"), ("other", "pear"))
+        self.assertEqual(index.search("apple", accept_all, 10), [1, 2, 0])
+        self.assertEqual(index.search("APPLE!", accept_all, 2), [1, 2])
+        self.assertEqual(index.search("apple", lambda message_id: message_id != 1, 10), [2, 0])
+
+    def test_rare_terms_count_for_more(self):
+        posts = [("filler", "common")] * 8
+        # Three common to one rare, against one common to two rare.
+        posts += [("filler", "common common common rare"), ("filler", "common rare rare")]
+        index = indexed(*posts)
+        self.assertEqual(index.search("common rare", accept_all, 10), [9, 8])
+        self.assertEqual(index.search("rare common", accept_all, 1), [9])
+
+    def test_every_term_must_match(self):
+        index = indexed(("a", "apple pear"), ("b", "apple"), ("c", "pear"))
+        self.assertEqual(index.search("pear apple", accept_all, 10), [0])
+        self.assertEqual(index.search("apple plum", accept_all, 10), [])
+        self.assertEqual(index.search("...", accept_all, 10), [])
+
+    def test_ties_newest_first(self):
+        index = indexed(("a", "apple pear"), ("b", "apple pear"), ("c", "apple pear"))
+        self.assertEqual(index.search("apple", accept_all, 10), [2, 1, 0])
+        self.assertEqual(index.search("apple pear", accept_all, 2), [2, 1])
+
+
+class SearchHandlerTest(unittest.TestCase):
+    storage = "pickle"
+
+    def setUp(self):
+        context = handler_server(storage_engine=self.storage, fsync_policy="interval")
+        self.server = context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+    def test_index_built_over_pages_and_updated_on_post(self):
+        alice = HandlerClient(self.server, "alice")
+        # Enough posts that the index is built a page at a time.
+        posts = 2 * server_module.MESSAGES_PAGE_SIZE + 1
+        alice.command("\n".join(["bulkpost default"] + ["filler post %d" % (number) for number in range(posts)]))
+        alice.command("post needle a needle in the haystack")
+        self.assertNotIn("default", self.server.search_indexes)
+        reply = alice.command("search default needle")
+        self.assertEqual(reply, "Messages in 'default' matching 'needle', best first: %d" % (posts))
+        self.assertEqual(self.server.search_indexes["default"].documents, posts + 1)
+
+        # Posts made once the index exists are added to it as they're made.
+        alice.command("post haystack needle")
+        alice.command("post needle needle needle")
+        reply = alice.command("search default needle")
+        self.assertEqual(
+            reply, "Messages in 'default' matching 'needle', best first: %d, %d, %d" % (posts + 2, posts, posts + 1)
+        )
+        self.assertEqual(alice.command("search default needle post"), "No messages in 'default' match 'needle post'.")
+
+
+class SQLiteSearchHandlerTest(SearchHandlerTest):
+    storage = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+"""The storage engines and their files, used directly (without a server)."""
+
+import datetime
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import support  # noqa: F401 (puts the repository on sys.path)
+import storage
+
+
+def post_record(group, message_id, size=100, date=None):
+    post = {
+        "sender": "alice",
+        "date": date or datetime.date.today(),
+        "subject": "subject%d" % (message_id),
+        "message": ("%d " % (message_id)) * (size // 2),
+    }
+    return ("post", group, message_id, post)
+
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix="bulletin-board-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, storage.LOG_PREFIX + "00000001")
+        self.records = [post_record("default", message_id) for message_id in range(3)]
+        log = storage.WriteAheadLog(self.path, fsync_policy="always")
+        for record in self.records:
+            log.append(record)
+        log.close()
+        with open(self.path, "rb") as log_file:
+            self.data = log_file.read()
+
+    def last_record_size(self):
+        return storage.RECORD_HEADER.size + len(pickle.dumps(self.records[-1], protocol=pickle.HIGHEST_PROTOCOL))
+
+    def rewrite(self, data):
+        with open(self.path, "wb") as log_file:
+            log_file.write(data)
+
+    def test_whole_log(self):
+        self.assertEqual(list(storage.WriteAheadLog.read(self.path)), self.records)
+
+    def test_torn_last_record(self):
+        start = len(self.data) - self.last_record_size()
+        # Cut off inside the header and inside the payload.
+        for end in (start + 1, start + storage.RECORD_HEADER.size, len(self.data) - 1):
+            self.rewrite(self.data[:end])
+            self.assertEqual(list(storage.WriteAheadLog.read(self.path)), self.records[:-1])
+
+    def test_crc_mismatch_in_last_record(self):
+        corrupt = bytearray(self.data)
+        corrupt[-1] ^= 0xFF
+        self.rewrite(bytes(corrupt))
+        self.assertEqual(list(storage.WriteAheadLog.read(self.path)), self.records[:-1])
+        # Recovery keeps the intact records and logs on to a new file.
+        store = storage.DurableStore(os.path.dirname(self.path), fsync_policy="always")
+        state, records = store.recover()
+        store.close()
+        self.assertIsNone(state)
+        self.assertEqual(records, self.records[:-1])
+        self.assertEqual(store.generation, 2)
+
+
+class RetentionPolicyTest(unittest.TestCase):
+    def test_parse(self):
+        policy = storage.RetentionPolicy.parse("posts=10,bytes=2048")
+        self.assertEqual((policy.max_posts, policy.max_days, policy.max_bytes), (10, None, 2048))
+        self.assertTrue(policy.limited)
+        self.assertFalse(storage.RetentionPolicy().limited)
+        for text in ("posts", "posts=-1", "posts=ten", "size=10", ""):
+            with self.assertRaises(ValueError):
+                storage.RetentionPolicy.parse(text)
+
+    def test_archive_cut(self):
+        today = datetime.date.today()
+        board = storage.Board()
+        # Posts 0-9, two a day, the newest today, each with a 10 byte body.
+        for message_id in range(10):
+            board.add(message_id, "alice", today - datetime.timedelta(days=(9 - message_id) // 2), "subject", 0, 10)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(), today), 0)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_posts=3), today), 7)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_days=1), today), 6)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_bytes=45), today), 6)
+        # The strictest limit wins.
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_posts=5, max_days=1, max_bytes=80), today), 6)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_posts=0), today), 10)
+        board.trim(6)
+        self.assertEqual((board.first, board.end, board.body_bytes), (6, 10, 40))
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_bytes=45), today), 6)
+        self.assertEqual(board.archive_cut(storage.RetentionPolicy(max_posts=3), today), 7)
+
+
+class ArchiveSegmentTest(unittest.TestCase):
+    def test_read_across_blocks(self):
+        directory = tempfile.mkdtemp(prefix="bulletin-board-test-")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "00000001.arc")
+        today = datetime.date.today()
+        # IDs 100-299 with 150 missing, so the blocks don't line up with round IDs.
+        rows = [
+            (message_id, "alice", today.toordinal(), "subject%d" % (message_id), "body %d" % (message_id))
+            for message_id in range(100, 300)
+            if message_id != 150
+        ]
+        storage.ArchiveSegment.write(path, "default", rows)
+        self.assertEqual(os.listdir(directory), ["00000001.arc"])
+        segment = storage.ArchiveSegment(path)
+        self.addCleanup(segment.close)
+        self.assertEqual(len(segment.blocks), -(-len(rows) // storage.ARCHIVE_BLOCK_POSTS))
+
+        def ids(first, last):
+            return [message_id for message_id, post in segment.read_posts(first, last, False)]
+
+        self.assertEqual(ids(0, 1000), [row[0] for row in rows])
+        self.assertEqual(ids(140, 230), [message_id for message_id in range(140, 230) if message_id != 150])
+        self.assertEqual(ids(150, 151), [])
+        self.assertEqual(ids(0, 100), [])
+        self.assertEqual(ids(299, 400), [299])
+        ((message_id, post),) = segment.read_posts(200, 201, True)
+        self.assertEqual(
+            (message_id, post), (200, {"sender": "alice", "date": today, "subject": "subject200", "message": "body 200"})
+        )
+        self.assertNotIn("message", segment.read_posts(200, 201, False)[0][1])
+
+
+class PickleStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix="bulletin-board-test-")
+        self.addCleanup(shutil.rmtree, self.data_dir, ignore_errors=True)
+
+    def open_storage(self):
+        engine = storage.PickleStorage(self.data_dir, fsync_policy="interval")
+        groups = engine.recover()
+        self.addCleanup(engine.close)
+        return engine, groups
+
+    def write(self, engine, groups, record):
+        storage.apply_record(groups, record)
+        engine.write(record)
+
+    def test_reads_across_archive_boundary(self):
+        engine, groups = self.open_storage()
+        old = datetime.date.today() - datetime.timedelta(days=30)
+        count = 2 * storage.ARCHIVE_BATCH + 10
+        records = [
+            post_record("default", message_id, date=old if message_id < 5 else None) for message_id in range(count)
+        ]
+        for record in records:
+            self.write(engine, groups, record)
+        expected = [(message_id, post) for _, _, message_id, post in records]
+        # Too few posts past the limit to be worth a segment, unless they're too old.
+        self.assertIsNone(engine.prepare_archive("default", storage.RetentionPolicy(max_posts=count - 10)))
+        self.assertIsNone(engine.prepare_archive("default", storage.RetentionPolicy()))
+        archive = engine.prepare_archive("default", storage.RetentionPolicy(max_days=7))
+        self.assertEqual(archive[:4], ("archive", "default", 0, 5))
+        engine.commit_archive(archive)
+        archive = engine.prepare_archive("default", storage.RetentionPolicy(max_posts=storage.ARCHIVE_BATCH))
+        self.assertEqual(archive[2:4], (5, count - storage.ARCHIVE_BATCH))
+        engine.commit_archive(archive)
+        self.assertEqual(engine.boards["default"].first, count - storage.ARCHIVE_BATCH)
+        self.assertEqual(len(engine.archives["default"]), 2)
+
+        for reopen in (False, True):
+            if reopen:
+                engine.close()
+                engine, groups = self.open_storage()
+            boundary = engine.boards["default"].first
+            self.assertEqual(engine.read_posts("default", 0, count), expected)
+            # Across both archive segments and into memory.
+            self.assertEqual(engine.read_posts("default", 3, boundary + 2), expected[3 : boundary + 2])
+            listed = engine.read_posts("default", boundary - 1, boundary + 1, False)
+            self.assertEqual([message_id for message_id, post in listed], [boundary - 1, boundary])
+            self.assertFalse(any("message" in post for message_id, post in listed))
+            for message_id in (0, 4, 5, boundary - 1, boundary, count - 1):
+                self.assertEqual(engine.read_post("default", message_id), expected[message_id][1])
+            self.assertEqual(engine.read_posts("default", count, count + 5), [])
+
+    def test_segment_compacted_after_archiving(self):
+        engine, groups = self.open_storage()
+        records = [post_record("default", message_id) for message_id in range(3 * storage.ARCHIVE_BATCH)]
+        for record in records:
+            self.write(engine, groups, record)
+        archive = engine.prepare_archive("default", storage.RetentionPolicy(max_posts=storage.ARCHIVE_BATCH))
+        engine.commit_archive(archive)
+        self.assertFalse(engine.compaction_due())
+        grown = os.path.getsize(os.path.join(self.data_dir, storage.SEGMENT_FILE))
+
+        with mock.patch.object(storage, "COMPACT_MIN_BYTES", 0):
+            self.assertTrue(engine.compaction_due())
+            engine.finish_snapshot(engine.begin_snapshot(groups, compact=True))
+            self.assertFalse(engine.compaction_due())
+        segments = [name for name in os.listdir(self.data_dir) if storage.is_segment_file(name)]
+        self.assertEqual(segments, [engine.segment_file])
+        compacted = os.path.getsize(os.path.join(self.data_dir, engine.segment_file))
+        self.assertEqual(compacted, engine.boards["default"].body_bytes)
+        self.assertLess(compacted * 2, grown)
+
+        # Posts made after compacting go to the new segment, and everything
+        # reads back the same after a restart.
+        record = post_record("default", len(records))
+        self.write(engine, groups, record)
+        records.append(record)
+        engine.close()
+        engine, groups = self.open_storage()
+        self.assertEqual(groups["default"]["next_message_id"], len(records))
+        expected = [(message_id, post) for _, _, message_id, post in records]
+        self.assertEqual(engine.read_posts("default", 0, len(records)), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Many clients posting to, joining and leaving groups at once."""
+
+import random
+import re
+import threading
+import unittest
+
+from support import FramedClient, ServerProcess
+
+CLIENTS = 16
+GROUPS = 6
+ROUNDS = 60
+
+POSTED = re.compile(r"New message posted in (\S+) by (\S+) with ID#(\d+)\.")
+
+
+class StressTest(unittest.TestCase):
+    mode = ()
+
+    def run_client(self, port, index, results, errors):
+        try:
+            name = "user%d" % (index)
+            client = FramedClient(port, name, "g%d" % (index % GROUPS))
+            rng = random.Random(index)
+            member_of = {"default", "g%d" % (index % GROUPS)}
+            posted = []
+            for _ in range(ROUNDS):
+                group = "g%d" % (rng.randrange(GROUPS))
+                action = rng.random()
+                if group not in member_of and action < 0.3:
+                    self.assertTrue(client.request("groupjoin " + group).startswith("Added to "))
+                    member_of.add(group)
+                elif group in member_of and action < 0.1:
+                    self.assertEqual(client.request("groupleave " + group), "You have left group '%s'." % (group))
+                    member_of.discard(group)
+                elif group in member_of:
+                    match = POSTED.fullmatch(client.request("grouppost %s subject from %s" % (group, name)))
+                    self.assertIsNotNone(match)
+                    posted.append((match.group(1), int(match.group(3))))
+            client.close()
+            results[name] = (member_of, posted)
+        except Exception as error:
+            errors.append(error)
+
+    def test_concurrent_posts_and_joins(self):
+        server = ServerProcess(*self.mode)
+        self.addCleanup(server.cleanup)
+        results, errors = {}, []
+        threads = [
+            threading.Thread(target=self.run_client, args=(server.port, index, results, errors)) for index in range(CLIENTS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # Every post got its own ID, and every group's IDs run from 0 with no gaps.
+        ids = {"g%d" % (index): [] for index in range(GROUPS)}
+        for member_of, posted in results.values():
+            for group, message_id in posted:
+                ids[group].append(message_id)
+        for group, message_ids in ids.items():
+            self.assertEqual(sorted(message_ids), list(range(len(message_ids))), group)
+
+        # And the server's memberships are what the clients did, before and
+        # after a restart.
+        for restart in (False, True):
+            if restart:
+                self.assertEqual(server.stop(), 0)
+                server = ServerProcess(*self.mode, data_dir=server.data_dir)
+                self.addCleanup(server.cleanup)
+            checker = FramedClient(server.port, "checker")
+            for group, message_ids in ids.items():
+                checker.request("groupjoin " + group)
+                users = checker.request("groupusers " + group)
+                expected = {name for name, (member_of, posted) in results.items() if group in member_of} | {"checker"}
+                self.assertEqual(set(users.split(": ", 1)[1].split(", ")), expected, group)
+                if message_ids:
+                    self.assertIn("#%d " % (len(message_ids) - 1), checker.request("latest %s 1" % (group)))
+                self.assertEqual(checker.request("groupmessage %s %d" % (group, len(message_ids))), "Error: Message ID does not exist.")
+                checker.request("groupleave " + group)
+            checker.close()
+        self.assertNotIn("Traceback", server.log())
+
+
+class AsyncioStressTest(StressTest):
+    mode = ("--asyncio",)
+
+
+class SQLiteStressTest(StressTest):
+    mode = ("--storage", "sqlite")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+timers.py
+---------
+Timer wheel used by the server to watch every connection for heartbeats and
+timeouts from a single thread.
+"""
+
+import logging
+import math
+import threading
+import time
+
+log = logging.getLogger("server")
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel (see TimerWheel.schedule)."""
+
+    __slots__ = ("callback", "args", "slot", "rounds")
+
+    def __init__(self, callback, args, slot, rounds) -> None:
+        self.callback = callback
+        self.args = args
+        self.slot = slot
+        # Turns of the wheel left before the timer is due.
+        self.rounds = rounds
+
+
+class TimerWheel:
+    """Runs callbacks after a delay, for any number of timers, from a single
+    thread. Timers are kept in a ring of slots, one per tick: scheduling and
+    cancelling a timer take constant time, and every tick only looks at the
+    timers in one slot. Delays are rounded up to whole ticks, so a timer runs
+    up to a tick late. Callbacks run on the wheel's thread and should be quick.
+    """
+
+    def __init__(self, tick=1.0, slots=512) -> None:
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        # Slot whose timers are looked at on the next tick.
+        self.current = 0
+        self.timers = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.timers
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) in delay seconds. Returns the Timer, for cancel()."""
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            slot = (self.current + ticks - 1) % len(self.slots)
+            timer = Timer(callback, args, slot, (ticks - 1) // len(self.slots))
+            self.slots[slot].add(timer)
+            self.timers += 1
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer from running, if it hasn't yet."""
+        with self.lock:
+            if timer in self.slots[timer.slot]:
+                self.slots[timer.slot].remove(timer)
+                self.timers -= 1
+
+    def advance(self):
+        """Move the wheel on by a tick and return the timers now due."""
+        with self.lock:
+            slot = self.slots[self.current]
+            due = [timer for timer in slot if timer.rounds == 0]
+            for timer in slot:
+                timer.rounds -= 1
+            slot.difference_update(due)
+            self.timers -= len(due)
+            self.current = (self.current + 1) % len(self.slots)
+        return due
+
+    def run(self):
+        """Wheel thread: run the timers due every tick. Ticks are counted from
+        the start, so a slow callback doesn't make the wheel drift.
+        """
+        began = time.monotonic()
+        ticks = 0
+        while True:
+            ticks += 1
+            delay = began + ticks * self.tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            for timer in self.advance():
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception("Timer callback failed.")